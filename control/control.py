@@ -39,12 +39,16 @@ def Q_value_iteration(
     s_grid = grids["states"]
     a_grid = grids["actions"]
     n_states = len(s_grid)
+    s_bin_shape = tuple(x + 1 for x in map(np.size, s_grid))
 
     if Q_on_grid is None:
+        # * Q_map does not change: look up the grid points enclosing each bin
+        # * once, in the order of np.ndenumerate(Q_map), not every iteration
+        grid_indices_of = [
+            get_grid_indices(np.unravel_index(next_s, s_bin_shape), s_grid)
+            for next_s in Q_map.flat
+        ]
         for qdx, next_s in np.ndenumerate(Q_map):
-            bin_idx = np.unravel_index(
-                next_s, tuple(x + 1 for x in map(np.size, s_grid))
-            )
             # pass transition through each reward function
             reward = 0.0
             s = [grid[qdx[i]] for i, grid in enumerate(s_grid)]
@@ -56,11 +60,9 @@ def Q_value_iteration(
         # iterate over each q
         for iteration in range(max_iter):
             max_change = 0.0  # for stopping
-            for qdx, next_s in np.ndenumerate(Q_map):
-                bin_idx = np.unravel_index(
-                    next_s, tuple(x + 1 for x in map(np.size, s_grid))
-                )
-                grid_indices = get_grid_indices(bin_idx, s_grid)
+            for (qdx, next_s), grid_indices in zip(
+                np.ndenumerate(Q_map), grid_indices_of
+            ):
                 # average bin value by neighboring q-values from grid
                 # bin_value = 0.0
                 # for g in grid_indices:
@@ -1,17 +1,29 @@
+import argparse
+import hashlib
+import os
+import pickle
+
+from math import radians
+
 import numpy as np
-import matplotlib.pyplot as plt
 
 import models.daslip as model
 import viability as vibly
 
 # * First, solve for the operating point to get an open-loop force traj
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the viable sets of the damped-actuated SLIP."
+    )
+    parser.add_argument("--plot", action="store_true", help="show the results")
+    args = parser.parse_args()
+
     p = {
         "mass": 80,  # kg
         "stiffness": 8200,  # K : N/m  just a guess, this will be fit
         "resting_length": 0.9,  # m
         "gravity": 9.81,  # N/kg
-        "angle_of_attack": 1 / 5 * np.pi,  # rad
+        "angle_of_attack": radians(36),  # rad
         "actuator_resting_length": 0.1,  # m
         "actuator_force": [],  # * 2 x M matrix of time and force
         "actuator_force_period": 10,  # * s
@@ -53,8 +65,26 @@ if __name__ == "__main__":
         "parameter_search_width": legStiffnessSearchWidth,
     }
 
+    # * the limit-cycle search is the most expensive setup step, so the fit is
+    # * cached, keyed on everything it depends on
+    cache_dir = "data/cache"
+    key = hashlib.blake2b(
+        pickle.dumps((p, x0.tolist(), limit_cycle_options)), digest_size=16
+    ).hexdigest()
+    filename = cache_dir + "/daslip_" + key + ".pkl"
+
     print(p["stiffness"], " N/m :Leg stiffness prior to fitting")
-    x0, p = model.create_open_loop_trajectories(x0, p, limit_cycle_options)
+    if os.path.exists(filename):
+        infile = open(filename, "rb")
+        x0, p = pickle.load(infile)
+        infile.close()
+    else:
+        x0, p = model.create_open_loop_trajectories(x0, p, limit_cycle_options)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        outfile = open(filename, "wb")
+        pickle.dump((x0, p), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        outfile.close()
     print(p["stiffness"], " N/m :Leg stiffness after fitting")
 
     p["x0"] = x0
@@ -68,15 +98,18 @@ if __name__ == "__main__":
     s_grid_height = np.linspace(0.5, 1.5, 26)
     s_grid_velocity = np.linspace(1, 6, 26)
     s_grid = (s_grid_height, s_grid_velocity)
-    a_grid = (np.linspace(20 / 180 * np.pi, 60 / 180 * np.pi, 25),)
+    a_grid = (np.linspace(radians(20), radians(60), 25),)
 
     grids = {"states": s_grid, "actions": a_grid}
-    result = vibly.compute_Q_map(grids, p_map, verbose=2, parallel=True)
+    # * the flattened (N, n_states + n_actions) state-action grid is built once
+    grids["sa_flat"] = vibly.get_state_actions(grids)
+    result = vibly.compute_Q_map(
+        grids, p_map, verbose=2, parallel=True, index_dtype=np.int16
+    )
     Q_map = result.q_map
     Q_F = result.q_fail
-    Q_V, S_V = vibly.compute_QV(Q_map, grids)
-    S_M = vibly.project_Q2S(Q_V, grids, proj_opt=np.mean)
-    Q_M = vibly.map_S2Q(Q_map, S_M, s_grid=s_grid, Q_V=Q_V)
+    # * Q_F=None: as in `compute_QV`, pairs with a nonzero Q_map are candidates
+    Q_V, S_V, S_M, Q_M = vibly.compute_viability_measures(Q_map, None, grids)
     print("non-failing portion of Q: " + str(np.sum(~Q_F) / Q_F.size))
     print("viable portion of Q: " + str(np.sum(Q_V) / Q_V.size))
 
@@ -95,8 +128,11 @@ if __name__ == "__main__":
     # data = pickle.load(infile)
     # infile.close()
 
-    plt.imshow(S_V, origin="lower")
-    plt.show()
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        plt.imshow(S_V, origin="lower")
+        plt.show()
 
-    plt.imshow(S_M, origin="lower")
-    plt.show()
+        plt.imshow(S_M, origin="lower")
+        plt.show()
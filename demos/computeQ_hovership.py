@@ -1,12 +1,24 @@
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
+from numba import cuda
 import models.hovership as sys
 from models.hovership import p_map
 import viability as vibly  # algorithms for brute-force viability
 
-# * here we choose the parameters to use
-# * we also put in a place-holder action (thrust)
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the viable sets of the hovership."
+    )
+    parser.add_argument("--plot", action="store_true", help="show the results")
+    parser.add_argument(
+        "--resume",
+        metavar="PICKLE",
+        help="reuse the state-action pairs already computed in a saved map",
+    )
+    args = parser.parse_args()
+
+    # * here we choose the parameters to use
+    # * we also put in a place-holder action (thrust)
     p = {
         "n_states": 1,
         "base_gravity": 0.1,
@@ -26,40 +38,59 @@ if __name__ == "__main__":
     p_map.x = x0
     p_map.sa2xp = sys.sa2xp
     p_map.xp2s = sys.xp2s
+    # * optionally, a vectorized map evaluating all state-action pairs at once
+    # * on a GPU, each pair is integrated by its own CUDA thread
+    if cuda.is_available():
+        p_map.batch = sys.p_map_batch_cuda
+    else:
+        p_map.batch = sys.p_map_batch
 
     # * determine the bounds and resolution of your grids
     # * note, the s_grid is a tuple of grids, such that each dimension can have
     # * different resolution, and we do not need to initialize the entire array
-    s_grid = (np.linspace(-0.0, p["ceiling"], 201),)
+    # * single precision is plenty for grids of this resolution, and halves
+    # * the memory of the state-action array used by `batched=True`
+    s_grid = (np.linspace(-0.0, p["ceiling"], 201, dtype=np.float32),)
     # * same thing for the actions
-    a_grid = (np.linspace(0.0, p["max_thrust"], 161),)
+    a_grid = (np.linspace(0.0, p["max_thrust"], 161, dtype=np.float32),)
 
     # * for convenience, both grids are placed in a dictionary
     grids = {"states": s_grid, "actions": a_grid}
+    # * the flattened (N, n_states + n_actions) state-action grid is built once
+    grids["sa_flat"] = vibly.get_state_actions(grids)
 
     # * compute_Q_map computes a gridded transition map, `Q_map`, which is used
     # * a look-up table for computing viable sets.
-    # * Enable `parallel=True` to use the multiprocessing version
+    # * Enable `parallel=True` to use the multiprocessing version, or
+    # * `batched=True` to use the vectorized `p_map.batch`
     # * Q_F is a grid marking all failing state-action pairs
     # * Q_on_grid is a helper grid, which marks if a state has not moved at all
     # * this is used to catch corner cases, and is not important for most
     # * systems with interesting dynamics
     # * setting `check_grid` to False will omit Q_on_grid
-    result = vibly.compute_Q_map(grids, p_map, check_grid=True, parallel=True)
+    # * with fewer than 2**15 state bins, Q_map fits in 16-bit indices
+    # * the reached states (`keep_coords`) are saved, so that a later run on
+    # * refined grids can resume from this one
+    result = vibly.compute_Q_map(
+        grids,
+        p_map,
+        check_grid=True,
+        keep_coords=True,
+        batched=True,
+        index_dtype=np.int16,
+        resume_from=args.resume,
+    )
     Q_map = result.q_map
     Q_F = result.q_fail
     Q_on_grid = result.q_on_grid
 
-    # * compute_QV computes the viable set and viability kernel
-    Q_V, S_V = vibly.compute_QV(Q_map, grids, ~Q_F, Q_on_grid=Q_on_grid)
-
-    # * project_Q2S takens a projection of the viable set onto state-space
-    # * for the computing the measure, you can use either `np.mean` or `np.sum`
-    # * as the projection operator
-    S_M = vibly.project_Q2S(Q_V, grids, proj_opt=np.mean)
-    # * map_S2Q maps the measure back into state-action space using the gridded
-    # * transition map
-    Q_M = vibly.map_S2Q(Q_map, S_M, s_grid, Q_V=Q_V)
+    # * compute_viability_measures computes the viable set and viability kernel,
+    # * the measure of each state (the share of viable actions, as projected by
+    # * `project_Q2S` with `np.mean`), and maps the measure back into
+    # * state-action space using the gridded transition map (as `map_S2Q`)
+    Q_V, S_V, S_M, Q_M = vibly.compute_viability_measures(
+        Q_map, Q_F, grids, Q_on_grid=Q_on_grid
+    )
 
     ###########################################################################
     # * save data as pickle
@@ -80,6 +111,8 @@ if __name__ == "__main__":
         "grids": grids,
         "Q_map": Q_map,
         "Q_F": Q_F,
+        "Q_reached": result.q_reached,
+        "fingerprint": result.fingerprint,
         "Q_V": Q_V,
         "Q_M": Q_M,
         "S_M": S_M,
@@ -87,14 +120,19 @@ if __name__ == "__main__":
         "x0": x0,
     }
     outfile = open(path_to_file + filename, "wb")
-    pickle.dump(data2save, outfile)
+    # * the highest protocol (5) pickles numpy arrays without extra copies of
+    # * their buffers
+    pickle.dump(data2save, outfile, protocol=pickle.HIGHEST_PROTOCOL)
     outfile.close()
     # to load this data, do:
     # infile = open(filename, 'rb')
     # data = pickle.load(infile)
     # infile.close()
 
-    plt.imshow(Q_M, origin="lower")  # visualize the Q-safety measure
-    plt.show()
-    # plt.imshow(Q_V) # visualize the viable set
-    # plt.show()
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        plt.imshow(Q_M, origin="lower")  # visualize the Q-safety measure
+        plt.show()
+        # plt.imshow(Q_V) # visualize the viable set
+        # plt.show()
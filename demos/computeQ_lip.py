@@ -50,16 +50,11 @@ if __name__ == "__main__":
     Q_F = result.q_fail
     time_elapsed = tictoc.toc()
     print("time elapsed: " + str(time_elapsed / 60.0))
-    # * compute_QV computes the viable set and viability kernel
-    Q_V, S_V = vibly.compute_QV(Q_map, grids, ~Q_F)
-
-    # * project_Q2S takens a projection of the viable set onto state-space
-    # * for the computing the measure, you can use either `np.mean` or `np.sum`
-    # * as the projection operator
-    S_M = vibly.project_Q2S(Q_V, grids, proj_opt=np.mean)
-    # * map_S2Q maps the measure back into state-action space using the gridded
-    # * transition map
-    Q_M = vibly.map_S2Q(Q_map, S_M, s_grid, Q_V=Q_V)
+    # * compute_viability_measures computes the viable set and viability kernel,
+    # * the measure of each state (the share of viable actions, as projected by
+    # * `project_Q2S` with `np.mean`), and maps the measure back into
+    # * state-action space using the gridded transition map (as `map_S2Q`)
+    Q_V, S_V, S_M, Q_M = vibly.compute_viability_measures(Q_map, Q_F, grids)
 
     ###########################################################################
     # * save data as pickle
@@ -1,3 +1,4 @@
+from math import radians
 import numpy as np
 import matplotlib.pyplot as plt
 from models import nslip
@@ -10,7 +11,7 @@ if __name__ == "__main__":
         "stiffness": 705.0,
         "resting_angle": 17 / 18 * np.pi,
         "gravity": 9.81,
-        "angle_of_attack": 1 / 5 * np.pi,
+        "angle_of_attack": radians(36),
         "upper_leg": 0.5,
         "lower_leg": 0.5,
     }
@@ -26,17 +27,15 @@ if __name__ == "__main__":
     p_map.sa2xp = nslip.sa2xp
     p_map.xp2s = nslip.xp2s
 
-    s_grid = np.linspace(0.1, 1.0, 61)
-    s_grid = (s_grid[:-1],)
-    a_grid = (np.linspace(-10 / 180 * np.pi, 70 / 180 * np.pi, 61),)
+    s_grid = (np.linspace(0.1, 1.0, 60, endpoint=False),)
+    a_grid = (np.linspace(radians(-10), radians(70), 61),)
     grids = {"states": s_grid, "actions": a_grid}
 
     result = vibly.compute_Q_map(grids, p_map, parallel=True)
     Q_map = result.q_map
     Q_F = result.q_fail
-    Q_V, S_V = vibly.compute_QV(Q_map, grids)
-    S_M = vibly.project_Q2S(Q_V, grids, proj_opt=np.mean)
-    Q_M = vibly.map_S2Q(Q_map, S_M, s_grid, Q_V=Q_V)
+    # * Q_F=None: as in `compute_QV`, pairs with a nonzero Q_map are candidates
+    Q_V, S_V, S_M, Q_M = vibly.compute_viability_measures(Q_map, None, grids)
 
     import pickle
     import os
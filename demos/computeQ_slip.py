@@ -1,16 +1,31 @@
+import argparse
+import os
+
+from math import radians
+
 import numpy as np
-import matplotlib.pyplot as plt
 from models import slip
 import viability as vibly
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the viable sets of the spring-loaded inverted pendulum."
+    )
+    parser.add_argument("--plot", action="store_true", help="show the results")
+    parser.add_argument(
+        "--resume",
+        metavar="PICKLE",
+        help="reuse the state-action pairs already computed in a saved map",
+    )
+    args = parser.parse_args()
+
     p = {
         "mass": 80.0,
         "stiffness": 8200.0,
         "resting_length": 1.0,
         "gravity": 9.81,
-        "angle_of_attack": 1 / 5 * np.pi,
+        "angle_of_attack": radians(36),
         "actuator_resting_length": 0,
     }
     x0 = np.array([0, 0.85, 5.5, 0, 0, 0, 0])
@@ -23,23 +38,39 @@ if __name__ == "__main__":
     p_map.sa2xp = slip.sa2xp
     p_map.xp2s = slip.xp2s
 
-    s_grid = np.linspace(0.1, 1, 181)
-    s_grid = (s_grid[:-1],)
-    a_grid = (np.linspace(-10 / 180 * np.pi, 70 / 180 * np.pi, 161),)
+    s_grid = (np.linspace(0.1, 1, 180, endpoint=False),)
+    a_grid = (np.linspace(radians(-10), radians(70), 161),)
     grids = {"states": s_grid, "actions": a_grid}
+    # * the flattened (N, n_states + n_actions) state-action grid is built once
+    grids["sa_flat"] = vibly.get_state_actions(grids)
     # Q_map, Q_F = vibly.compute_Q_map(grids, p_map)
-    result = vibly.compute_Q_map(grids, p_map, parallel=True)
+    if os.environ.get("VIBLY_JAX"):
+        # * optionally, evaluate the whole grid with the jax.vmap-ed JAX port
+        from models import slip_jax
+
+        p_map.batch = slip_jax.p_map_batch
+        options = {"batched": True}
+    else:
+        options = {"parallel": True}
+    # * the reached states (`keep_coords`) are saved, so that a later run on
+    # * refined grids can resume from this one
+    result = vibly.compute_Q_map(
+        grids,
+        p_map,
+        keep_coords=True,
+        index_dtype=np.int16,
+        resume_from=args.resume,
+        **options,
+    )
     Q_map = result.q_map
     Q_F = result.q_fail
-    Q_V, S_V = vibly.compute_QV(Q_map, grids)
-    S_M = vibly.project_Q2S(Q_V, grids, proj_opt=np.mean)
-    Q_M = vibly.map_S2Q(Q_map, S_M, s_grid, Q_V=Q_V)
+    # * Q_F=None: as in `compute_QV`, pairs with a nonzero Q_map are candidates
+    Q_V, S_V, S_M, Q_M = vibly.compute_viability_measures(Q_map, None, grids)
 
     ###########################################################################
     # * save data as pickle
     ###########################################################################
     import pickle
-    import os
 
     filename = "slip_map.pickle"
 
@@ -54,6 +85,8 @@ if __name__ == "__main__":
         "grids": grids,
         "Q_map": Q_map,
         "Q_F": Q_F,
+        "Q_reached": result.q_reached,
+        "fingerprint": result.fingerprint,
         "Q_V": Q_V,
         "Q_M": Q_M,
         "S_M": S_M,
@@ -61,7 +94,9 @@ if __name__ == "__main__":
         "x0": x0,
     }
     outfile = open(path_to_file + filename, "wb")
-    pickle.dump(data2save, outfile)
+    # * the highest protocol (5) pickles numpy arrays without extra copies of
+    # * their buffers
+    pickle.dump(data2save, outfile, protocol=pickle.HIGHEST_PROTOCOL)
     outfile.close()
     # to load this data, do:
     # infile = open(filename, 'rb')
@@ -72,5 +107,8 @@ if __name__ == "__main__":
     # * basic visualization
     ###########################################################################
 
-    plt.imshow(Q_map, origin="lower")
-    plt.show()
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        plt.imshow(Q_map, origin="lower")
+        plt.show()
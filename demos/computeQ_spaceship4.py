@@ -1,10 +1,17 @@
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
+from numba import cuda
 import models.spaceship4 as sys
 from models.spaceship4 import p_map
 import viability as vibly  # algorithms for brute-force viability
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the viable sets of the 2D spaceship."
+    )
+    parser.add_argument("--plot", action="store_true", help="show the results")
+    args = parser.parse_args()
+
     # * here we choose the parameters to use
     # * we also put in a place-holder action (thrust)
     p = {
@@ -31,16 +38,32 @@ if __name__ == "__main__":
     p_map.x = x0
     p_map.sa2xp = sys.sa2xp
     p_map.xp2s = sys.xp2s
+    # * optionally, a vectorized map evaluating all state-action pairs at once
+    # * on a GPU, each pair is integrated by its own CUDA thread
+    if cuda.is_available():
+        p_map.batch = sys.p_map_batch_cuda
+    else:
+        p_map.batch = sys.p_map_batch
 
     # * determine the bounds and resolution of your grids
     # * note, the s_grid is a tuple of grids, such that each dimension can have
     # * different resolution, and we do not need to initialize the entire array
-    s_grid = (np.linspace(0, p["ceiling"], 51), np.linspace(-1, 1, 41))
+    # * single precision is plenty for grids of this resolution, and halves
+    # * the memory of the state-action array used by `batched=True`
+    s_grid = (
+        np.linspace(0, p["ceiling"], 51, dtype=np.float32),
+        np.linspace(-1, 1, 41, dtype=np.float32),
+    )
     # * same thing for the actions
-    a_grid = (np.linspace(0.0, 1, 11), np.linspace(-0.1, 0.1, 17))
+    a_grid = (
+        np.linspace(0.0, 1, 11, dtype=np.float32),
+        np.linspace(-0.1, 0.1, 17, dtype=np.float32),
+    )
 
     # * for convenience, both grids are placed in a dictionary
     grids = {"states": s_grid, "actions": a_grid}
+    # * the flattened (N, n_states + n_actions) state-action grid is built once
+    grids["sa_flat"] = vibly.get_state_actions(grids)
 
     # * compute_Q_map computes a gridded transition map, `Q_map`, which is used as
     # * a look-up table for computing viable sets
@@ -48,26 +71,29 @@ if __name__ == "__main__":
     # * Q_on_grid is a helper grid, which marks if a state has not moved
     # * this is used to catch corner cases, and is not important for most systems
     # * setting `check_grid` to False will omit Q_on_grid
-    result = vibly.compute_Q_map(
+    # * the outputs are preallocated and filled in place, so that re-running
+    # * with new parameters (e.g. in IPython) reuses the same memory
+    shape = tuple(grid.size for grid in grids["states"] + grids["actions"])
+    Q_map = np.empty(shape, dtype=np.int16)  # fewer than 2**15 state bins
+    Q_F = np.empty(shape, dtype=bool)
+    Q_on_grid = np.empty(shape, dtype=bool)
+    vibly.compute_Q_map(
         grids,
         p_map,
         check_grid=True,
         verbose=1,
-        parallel=True,
+        batched=True,
+        out=Q_map,
+        out_F=Q_F,
+        out_on_grid=Q_on_grid,
+    )
+    # * compute_viability_measures computes the viable set and viability kernel,
+    # * the measure of each state (the share of viable actions, as projected by
+    # * `project_Q2S` with `np.mean`), and maps the measure back into
+    # * state-action space using the gridded transition map (as `map_S2Q`)
+    Q_V, S_V, S_M, Q_M = vibly.compute_viability_measures(
+        Q_map, Q_F, grids, Q_on_grid=Q_on_grid
     )
-    Q_map = result.q_map
-    Q_F = result.q_fail
-    Q_on_grid = result.q_on_grid
-    # * compute_QV computes the viable set and viability kernel
-    Q_V, S_V = vibly.compute_QV(Q_map, grids, ~Q_F, Q_on_grid=Q_on_grid)
-
-    # * project_Q2S takens a projection of the viable set onto state-space
-    # * for the computing the measure, you can use either `np.mean` or `np.sum`
-    # * as the projection operator
-    S_M = vibly.project_Q2S(Q_V, grids, proj_opt=np.mean)
-    # * map_S2Q maps the measure back into state-action space using the gridded
-    # * transition map
-    Q_M = vibly.map_S2Q(Q_map, S_M, s_grid, Q_V=Q_V, Q_on_grid=Q_on_grid)
 
     ###############################################################################
     # * save data as pickle
@@ -84,7 +110,10 @@ if __name__ == "__main__":
     # data = pickle.load(infile)
     # infile.close()
 
-    plt.imshow(S_M, origin="lower")  # visualize the Q-safety measure
-    plt.show()
-    # plt.imshow(Q_V) # visualize the viable set
-    # plt.show()
+    if args.plot:
+        import matplotlib.pyplot as plt
+
+        plt.imshow(S_M, origin="lower")  # visualize the Q-safety measure
+        plt.show()
+        # plt.imshow(Q_V) # visualize the viable set
+        # plt.show()
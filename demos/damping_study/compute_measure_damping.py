@@ -1,4 +1,5 @@
 import models.daslip as model
+from math import radians
 import numpy as np
 import matplotlib.pyplot as plt
 import pickle
@@ -64,7 +65,7 @@ if __name__ == "__main__":
         s_grid_height = np.linspace(0.05, 0.5, 91)
         s_grid_velocity = np.linspace(0, 10.0, 101)
         s_grid = (s_grid_height, s_grid_velocity)
-        a_grid_aoa = np.linspace(0 / 180 * np.pi, 90 / 180 * np.pi, 91)
+        a_grid_aoa = np.linspace(radians(0), radians(90), 91)
         a_grid = (a_grid_aoa,)
 
         # * if you use the representation `sa2xp_amp` (see above), the
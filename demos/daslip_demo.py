@@ -1,4 +1,5 @@
 import models.daslip as model
+from math import radians
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
@@ -43,7 +44,7 @@ p = {
     "stiffness": 8200.0,  # K : N/m
     "resting_length": 0.9,  # m
     "gravity": 9.81,  # N/kg
-    "angle_of_attack": 1 / 5 * np.pi,  # rad
+    "angle_of_attack": radians(36),  # rad
     "actuator_resting_length": 0.1,  # m
     "actuator_force": [],  # * 2 x M matrix of time and force
     "actuator_force_period": 10,  # * s
@@ -1,4 +1,5 @@
 import models.slip as true_model
+from math import radians
 import numpy as np
 import pickle
 
@@ -26,7 +27,7 @@ def run_demo(
     infile.close()
 
     # A prior state action pair that is considered safe (from system knowledge)
-    X_seed = np.atleast_2d(np.array([0.45, 38 / (180) * np.pi]))
+    X_seed = np.atleast_2d(np.array([0.45, radians(38)]))
     y_seed = np.array([[0.2]])
 
     seed_data = {"X": X_seed, "y": y_seed}
@@ -1,4 +1,5 @@
 from models import nslip
+from math import radians
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -9,7 +10,7 @@ p = {
     "stiffness": 705.0,
     "resting_angle": 17 / 18 * np.pi,
     "gravity": 9.81,
-    "angle_of_attack": 1 / 5 * np.pi,
+    "angle_of_attack": radians(36),
     "upper_leg": 0.5,
     "lower_leg": 0.5,
 }
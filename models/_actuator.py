@@ -0,0 +1,60 @@
+import numpy as np
+from numba import njit
+
+"""
+Periodic, open-loop actuator force trajectories of the actuated SLIP models
+(`daslip`, `parslip`), in a form for compiled dynamics. A parameter dict holds
+the trajectory as a 2 x M array `p["actuator_force"]` of times and forces,
+repeating with `p["actuator_force_period"]` and delayed by
+`p["activation_delay"]`, interpolated linearly in between.
+"""
+
+
+def force_table(p, delay=None):
+    """
+    The actuator force trajectory, shifted by the activation delay, wrapped
+    into one period and padded at both ends, as `np.interp(..., period=...)`
+    does internally on each call. The third row splits the period into as
+    many uniform buckets as there are knots, and holds the last knot at or
+    before the start of each bucket, so lookups take O(1) steps.
+    Empty without an actuator force.
+    delay: overrides `p["activation_delay"]`, e.g. 0 for a table shared by
+    parameter dicts that only differ in their delay
+    """
+    if np.shape(p["actuator_force"])[0] == 0:
+        return np.zeros((3, 0))
+    if delay is None:
+        delay = p["activation_delay"]
+    period = p["actuator_force_period"]
+    times = (p["actuator_force"][0, :] + delay) % period
+    order = np.argsort(times)
+    times = times[order]
+    forces = p["actuator_force"][1, order]
+    times = np.concatenate((times[-1:] - period, times, times[0:1] + period))
+    forces = np.concatenate((forces[-1:], forces, forces[0:1]))
+    bucket_starts = np.arange(times.size) / times.size * period
+    buckets = np.searchsorted(times, bucket_starts, side="right") - 1
+    return np.array([times, forces, buckets])
+
+
+@njit(cache=True)
+def interp_force(t, force_table, period):
+    """
+    the (unamplified) actuator force at time t, see `force_table`
+    """
+    n_knots = force_table.shape[1]
+    if n_knots == 0:
+        return 0.0
+    # * periodic linear interpolation, as np.interp(..., period=period): find
+    # * the knot interval from the bucket of the phase, then walk to it
+    phase = t % period
+    bucket = min(int(phase / period * n_knots), n_knots - 1)
+    idx = int(force_table[2, bucket])
+    while force_table[0, idx] > phase:
+        idx -= 1
+    while force_table[0, idx + 1] <= phase:
+        idx += 1
+    times = force_table[0]
+    forces = force_table[1]
+    slope = (forces[idx + 1] - forces[idx]) / (times[idx + 1] - times[idx])
+    return slope * (phase - times[idx]) + forces[idx]
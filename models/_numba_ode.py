@@ -0,0 +1,452 @@
+import math
+
+import numpy as np
+from numba import cuda, float64, njit
+
+"""
+Compiled ODE integration for the batched transition maps.
+
+`rk45` reproduces the step-size control of scipy's `solve_ivp(method="RK45")`
+with default tolerances, so that per-pair results of a compiled batch closely
+match the scalar `p_map`. The right-hand side is passed in as an `@njit`
+function `rhs(t, x, params)`.
+`make_cuda_rk45` builds the same integrator as a CUDA device function, for
+kernels integrating one state-action pair per thread.
+`rk45_events` adds a `max_step` and terminal events, located on the dense
+output as `solve_ivp(..., events=...)` does, for multi-phase (hybrid) models.
+The integrators are compiled for each right-hand side they are called with,
+and not cached on disk: numba cannot reliably update cache entries keyed on
+function arguments.
+"""
+
+SAFETY = 0.9
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10.0
+ERROR_EXPONENT = -1.0 / 5.0
+EPS = np.finfo(float).eps
+
+# Dormand-Prince coefficients, as in scipy.integrate.RK45
+C = np.array([0.0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0])
+A = np.array(
+    [
+        [0.0, 0.0, 0.0, 0.0, 0.0],
+        [1 / 5, 0.0, 0.0, 0.0, 0.0],
+        [3 / 40, 9 / 40, 0.0, 0.0, 0.0],
+        [44 / 45, -56 / 15, 32 / 9, 0.0, 0.0],
+        [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729, 0.0],
+        [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    ]
+)
+B = np.array([35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+# quartic dense output, as in scipy.integrate.RK45
+P = np.array(
+    [
+        [1, -8048581381 / 2820520608, 8663915743 / 2820520608],
+        [0, 0, 0],
+        [0, 131558114200 / 32700410799, -68118460800 / 10900136933],
+        [0, -1754552775 / 470086768, 14199869525 / 1410260304],
+        [0, 127303824393 / 49829197408, -318862633887 / 49829197408],
+        [0, -282668133 / 205662961, 2019193451 / 616988883],
+        [0, 40617522 / 29380423, -110615467 / 29380423],
+    ]
+)
+P = np.column_stack(
+    (
+        P,
+        [
+            -12715105075 / 11282082432,
+            0,
+            87487479700 / 32700410799,
+            -10690763975 / 1880347072,
+            701980252875 / 199316789632,
+            -1453857185 / 822651844,
+            69997945 / 29380423,
+        ],
+    )
+)
+E = np.array(
+    [-71 / 57600, 0.0, 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40]
+)
+
+
+@njit(cache=True)
+def _rms_norm(x):
+    return np.sqrt(np.sum(x * x) / x.size)
+
+
+@njit
+def _select_initial_step(rhs, t0, y0, f0, t_bound, params, rtol, atol):
+    interval_length = abs(t_bound - t0)
+    if interval_length == 0.0:
+        return 0.0
+    scale = atol + np.abs(y0) * rtol
+    d0 = _rms_norm(y0 / scale)
+    d1 = _rms_norm(f0 / scale)
+    if d0 < 1e-5 or d1 < 1e-5:
+        h0 = 1e-6
+    else:
+        h0 = 0.01 * d0 / d1
+    h0 = min(h0, interval_length)
+    f1 = rhs(t0 + h0, y0 + h0 * f0, params)
+    d2 = _rms_norm((f1 - f0) / scale) / h0
+    if d1 <= 1e-15 and d2 <= 1e-15:
+        h1 = max(1e-6, h0 * 1e-3)
+    else:
+        h1 = (0.01 / max(d1, d2)) ** (1.0 / 5.0)
+    return min(100 * h0, h1, interval_length)
+
+
+@njit
+def rk45(rhs, y0, t0, t_bound, params, rtol=1e-3, atol=1e-6):
+    """
+    Integrate `rhs` from t0 to t_bound, returning the final state.
+    """
+    n = y0.size
+    y = y0.copy()
+    t = t0
+    f = rhs(t, y, params)
+    h_abs = _select_initial_step(rhs, t, y, f, t_bound, params, rtol, atol)
+    # * work arrays of the steps, allocated once
+    K = np.empty((7, n))
+    y_stage = np.empty(n)
+    y_new = np.empty(n)
+    error = np.empty(n)
+    while t < t_bound:
+        min_step = 10 * abs(np.nextafter(t, np.inf) - t)
+        if h_abs < min_step:
+            h_abs = min_step
+        step_rejected = False
+        while True:
+            if h_abs < min_step:  # step size too small, give up
+                return y
+            t_new = t + h_abs
+            if t_new > t_bound:
+                t_new = t_bound
+            h = t_new - t
+            h_abs = abs(h)
+            # * single Dormand-Prince step
+            K[0] = f
+            for s in range(1, 6):
+                for i in range(n):
+                    dy = 0.0
+                    for j in range(s):
+                        dy += K[j, i] * A[s, j]
+                    y_stage[i] = y[i] + dy * h
+                K[s] = rhs(t + C[s] * h, y_stage, params)
+            for i in range(n):
+                y_step = 0.0
+                for j in range(6):
+                    y_step += K[j, i] * B[j]
+                y_new[i] = y[i] + h * y_step
+            f_new = rhs(t + h, y_new, params)
+            K[6] = f_new
+            # * error control
+            for i in range(n):
+                scale = atol + np.maximum(abs(y[i]), abs(y_new[i])) * rtol
+                e = 0.0
+                for j in range(7):
+                    e += K[j, i] * E[j]
+                error[i] = e * h / scale
+            error_norm = _rms_norm(error)
+            if error_norm < 1:
+                if error_norm == 0:
+                    factor = MAX_FACTOR
+                else:
+                    factor = min(MAX_FACTOR, SAFETY * error_norm**ERROR_EXPONENT)
+                if step_rejected:
+                    factor = min(1.0, factor)
+                h_abs *= factor
+                break
+            h_abs *= max(MIN_FACTOR, SAFETY * error_norm**ERROR_EXPONENT)
+            step_rejected = True
+        t = t_new
+        y, y_new = y_new, y
+        f = f_new
+    return y
+
+
+@njit(cache=True)
+def _dense_output(t, t_old, h, y_old, Q):
+    x = (t - t_old) / h
+    y = np.zeros(y_old.size)
+    power = 1.0
+    for j in range(Q.shape[1]):
+        power *= x
+        y += Q[:, j] * power
+    return y_old + h * y
+
+
+@njit
+def _event_root(events, k, t_old, h, y_old, Q, params, t_low, t_high):
+    """
+    root of the k-th event within [t_low, t_high] on the dense output, as
+    scipy's `brentq` with xtol=rtol=4*EPS
+    """
+    xtol = 4 * EPS
+    rtol = 4 * EPS
+    xpre = t_low
+    xcur = t_high
+    xblk = 0.0
+    fblk = 0.0
+    spre = 0.0
+    scur = 0.0
+    fpre = events(xpre, _dense_output(xpre, t_old, h, y_old, Q), params)[k]
+    fcur = events(xcur, _dense_output(xcur, t_old, h, y_old, Q), params)[k]
+    if fpre == 0:
+        return xpre
+    if fcur == 0:
+        return xcur
+    for _ in range(100):
+        if fpre != 0 and fcur != 0 and (np.signbit(fpre) != np.signbit(fcur)):
+            xblk = xpre
+            fblk = fpre
+            spre = scur = xcur - xpre
+        if abs(fblk) < abs(fcur):
+            xpre = xcur
+            xcur = xblk
+            xblk = xpre
+            fpre = fcur
+            fcur = fblk
+            fblk = fpre
+        delta = (xtol + rtol * abs(xcur)) / 2
+        sbis = (xblk - xcur) / 2
+        if fcur == 0 or abs(sbis) < delta:
+            return xcur
+        if abs(spre) > delta and abs(fcur) < abs(fpre):
+            if xpre == xblk:  # interpolate
+                stry = -fcur * (xcur - xpre) / (fcur - fpre)
+            else:  # extrapolate
+                dpre = (fpre - fcur) / (xpre - xcur)
+                dblk = (fblk - fcur) / (xblk - xcur)
+                stry = (
+                    -fcur * (fblk * dblk - fpre * dpre) / (dblk * dpre * (fblk - fpre))
+                )
+            if 2 * abs(stry) < min(abs(spre), 3 * abs(sbis) - delta):
+                spre = scur
+                scur = stry
+            else:
+                spre = sbis
+                scur = sbis
+        else:
+            spre = sbis
+            scur = sbis
+        xpre = xcur
+        fpre = fcur
+        if abs(scur) > delta:
+            xcur += scur
+        elif sbis > 0:
+            xcur += delta
+        else:
+            xcur -= delta
+        fcur = events(xcur, _dense_output(xcur, t_old, h, y_old, Q), params)[k]
+    return xcur
+
+
+@njit
+def rk45_events(
+    rhs, events, directions, y0, t0, t_bound, params, max_step, rtol=1e-3, atol=1e-6
+):
+    """
+    Integrate `rhs` from t0 until t_bound, or until the first of the terminal
+    `events(t, x, params)`, which returns an array of event values. Crossings
+    count as in `solve_ivp`, by the sign of `directions` (0 for both ways).
+    returns the final time and state, and the index of the event which ended
+    the integration (-1 if none)
+    """
+    n = y0.size
+    y = y0.copy()
+    t = t0
+    f = rhs(t, y, params)
+    h_abs = _select_initial_step(rhs, t, y, f, t_bound, params, rtol, atol)
+    h_abs = min(h_abs, max_step)
+    g = events(t, y, params)
+    # * work arrays of the steps, allocated once
+    K = np.empty((7, n))
+    y_stage = np.empty(n)
+    y_new = np.empty(n)
+    error = np.empty(n)
+    while t < t_bound:
+        min_step = 10 * abs(np.nextafter(t, np.inf) - t)
+        if h_abs > max_step:
+            h_abs = max_step
+        elif h_abs < min_step:
+            h_abs = min_step
+        step_rejected = False
+        while True:
+            if h_abs < min_step:  # step size too small, give up
+                return t, y, -1
+            t_new = t + h_abs
+            if t_new > t_bound:
+                t_new = t_bound
+            h = t_new - t
+            h_abs = abs(h)
+            # * single Dormand-Prince step
+            K[0] = f
+            for s in range(1, 6):
+                for i in range(n):
+                    dy = 0.0
+                    for j in range(s):
+                        dy += K[j, i] * A[s, j]
+                    y_stage[i] = y[i] + dy * h
+                K[s] = rhs(t + C[s] * h, y_stage, params)
+            for i in range(n):
+                y_step = 0.0
+                for j in range(6):
+                    y_step += K[j, i] * B[j]
+                y_new[i] = y[i] + h * y_step
+            f_new = rhs(t + h, y_new, params)
+            K[6] = f_new
+            # * error control
+            for i in range(n):
+                scale = atol + np.maximum(abs(y[i]), abs(y_new[i])) * rtol
+                e = 0.0
+                for j in range(7):
+                    e += K[j, i] * E[j]
+                error[i] = e * h / scale
+            error_norm = _rms_norm(error)
+            if error_norm < 1:
+                if error_norm == 0:
+                    factor = MAX_FACTOR
+                else:
+                    factor = min(MAX_FACTOR, SAFETY * error_norm**ERROR_EXPONENT)
+                if step_rejected:
+                    factor = min(1.0, factor)
+                h_abs *= factor
+                break
+            h_abs *= max(MIN_FACTOR, SAFETY * error_norm**ERROR_EXPONENT)
+            step_rejected = True
+        # * events, located on the dense output of the step
+        g_new = events(t_new, y_new, params)
+        first_event = -1
+        t_event = t_new
+        Q = np.empty((0, 0))
+        for k in range(g.size):
+            up = g[k] <= 0 and g_new[k] >= 0
+            down = g[k] >= 0 and g_new[k] <= 0
+            if (
+                (up and directions[k] > 0)
+                or (down and directions[k] < 0)
+                or ((up or down) and directions[k] == 0)
+            ):
+                if Q.size == 0:  # only steps with events need the dense output
+                    Q = K.T.dot(P)
+                root = _event_root(events, k, t, h, y, Q, params, t, t_new)
+                if first_event < 0 or root < t_event:
+                    first_event = k
+                    t_event = root
+        if first_event >= 0:
+            return t_event, _dense_output(t_event, t, h, y, Q), first_event
+        t = t_new
+        y, y_new = y_new, y
+        f = f_new
+        g = g_new
+    return t, y, -1
+
+
+def make_cuda_rk45(rhs, n_states):
+    """
+    Build a CUDA device version of `rk45`, integrating `n_states` states in
+    place from t=0 to t_bound. `rhs(t, x, params, out)` is a CUDA device
+    function writing the derivative into `out`, since device code cannot
+    allocate arrays. Only thread-local memory is used.
+    """
+
+    @cuda.jit(device=True)
+    def rms_norm(x, scale):
+        total = 0.0
+        for i in range(n_states):
+            total += (x[i] / scale[i]) ** 2
+        return math.sqrt(total / n_states)
+
+    @cuda.jit(device=True)
+    def rk45_device(y, t_bound, params):
+        rtol = 1e-3
+        atol = 1e-6
+        K = cuda.local.array((7, n_states), float64)
+        f = cuda.local.array(n_states, float64)
+        y_stage = cuda.local.array(n_states, float64)
+        y_new = cuda.local.array(n_states, float64)
+        err = cuda.local.array(n_states, float64)
+        scale = cuda.local.array(n_states, float64)
+
+        # * initial step, as in `_select_initial_step`
+        t = 0.0
+        rhs(t, y, params, f)
+        for i in range(n_states):
+            scale[i] = atol + abs(y[i]) * rtol
+        d0 = rms_norm(y, scale)
+        d1 = rms_norm(f, scale)
+        if d0 < 1e-5 or d1 < 1e-5:
+            h0 = 1e-6
+        else:
+            h0 = 0.01 * d0 / d1
+        h0 = min(h0, t_bound)
+        for i in range(n_states):
+            y_stage[i] = y[i] + h0 * f[i]
+        rhs(h0, y_stage, params, err)
+        for i in range(n_states):
+            err[i] = err[i] - f[i]
+        d2 = rms_norm(err, scale) / h0
+        if d1 <= 1e-15 and d2 <= 1e-15:
+            h1 = max(1e-6, h0 * 1e-3)
+        else:
+            h1 = (0.01 / max(d1, d2)) ** (1.0 / 5.0)
+        h_abs = min(100 * h0, h1, t_bound)
+
+        while t < t_bound:
+            # * float spacing bound, instead of nextafter, in device code
+            min_step = 10 * EPS * abs(t)
+            if h_abs < min_step:
+                h_abs = min_step
+            step_rejected = False
+            while True:
+                if h_abs < min_step:  # step size too small, give up
+                    return
+                t_new = min(t + h_abs, t_bound)
+                h = t_new - t
+                h_abs = abs(h)
+                # * single Dormand-Prince step
+                for i in range(n_states):
+                    K[0, i] = f[i]
+                for s in range(1, 7):
+                    for i in range(n_states):
+                        dy = 0.0
+                        for j in range(s):
+                            if s < 6:
+                                dy += K[j, i] * A[s, j]
+                            else:
+                                dy += K[j, i] * B[j]
+                        y_stage[i] = y[i] + dy * h
+                    if s < 6:
+                        rhs(t + C[s] * h, y_stage, params, err)
+                    else:
+                        for i in range(n_states):
+                            y_new[i] = y_stage[i]
+                        rhs(t + h, y_new, params, err)
+                    for i in range(n_states):
+                        K[s, i] = err[i]
+                # * error control
+                for i in range(n_states):
+                    scale[i] = atol + max(abs(y[i]), abs(y_new[i])) * rtol
+                    e = 0.0
+                    for j in range(7):
+                        e += K[j, i] * E[j]
+                    err[i] = e * h
+                error_norm = rms_norm(err, scale)
+                if error_norm < 1:
+                    if error_norm == 0:
+                        factor = MAX_FACTOR
+                    else:
+                        factor = min(MAX_FACTOR, SAFETY * error_norm**ERROR_EXPONENT)
+                    if step_rejected:
+                        factor = min(1.0, factor)
+                    h_abs *= factor
+                    break
+                h_abs *= max(MIN_FACTOR, SAFETY * error_norm**ERROR_EXPONENT)
+                step_rejected = True
+            t = t_new
+            for i in range(n_states):
+                y[i] = y_new[i]
+                f[i] = K[6, i]
+
+    return rk45_device
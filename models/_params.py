@@ -0,0 +1,35 @@
+from dataclasses import astuple, dataclass, fields
+
+import numpy as np
+
+"""
+Fixed-field parameter records for the compiled (Numba, CUDA, JAX) parts of the
+models. The models themselves take a parameter dict `p`, which the viability
+tools copy and update with every action. A frozen dataclass picks out the
+scalars a kernel needs, and packs them into a float array in field order, so
+kernels index parameters by position instead of looking up dict keys.
+"""
+
+
+@dataclass(frozen=True)
+class ModelParams:
+    @classmethod
+    def from_dict(cls, p, **values):
+        """
+        build the record from the entries of a parameter dict `p`; keyword
+        `values` take precedence. Other entries of `p` are ignored.
+        """
+        for field in fields(cls):
+            if field.name not in values:
+                values[field.name] = p[field.name]
+        return cls(**values)
+
+    def to_array(self):
+        """
+        the fields in declaration order, as a float array for compiled kernels.
+        Fields may also hold size-1 arrays, which are flattened.
+        """
+        values = np.hstack(astuple(self)).astype(float)
+        if values.size != len(fields(self)):
+            raise ValueError(f"all fields of {type(self).__name__} must be scalars")
+        return values
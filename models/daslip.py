@@ -1,6 +1,300 @@
+import math
+from dataclasses import dataclass, fields
+
 import numpy as np
 import scipy.integrate as integrate
+from numba import njit, prange
+
+import models._actuator as actuator
 import models.slip as slip
+from models._numba_ode import rk45_events
+from models._params import ModelParams
+
+# duration limit of each phase of a step
+MAX_TIME = 5.0
+# * flight is smooth, so with the default RK45 solver the flight phases take
+# * adaptive steps at tight tolerances, instead of the max_step of stance
+FLIGHT_SOLVER_OPTIONS = {"method": "RK45", "rtol": 1e-10, "atol": 1e-12}
+# trajectories from this many samples on are post-processed in compiled code
+PARALLEL_MIN_SAMPLES = 10_000
+
+
+@dataclass(frozen=True)
+class DaslipParams(ModelParams):
+    """
+    Scalar parameters of the damped-actuated SLIP, for compiled dynamics.
+    The offsets are set by `create_open_loop_trajectories`; the actuator force
+    trajectory stays in the parameter dict. The angle of attack is the action.
+    """
+
+    gravity: float
+    mass: float
+    stiffness: float
+    resting_length: float
+    actuator_resting_length: float
+    constant_normalized_damping: float
+    linear_normalized_damping: float
+    linear_minimum_normalized_damping: float
+    swing_velocity: float
+    swing_extension_velocity: float
+    angle_of_attack_offset: float
+    swing_leg_length_offset: float
+    activation_delay: float
+    activation_amplification: float
+    angle_of_attack: float
+
+
+N_PARAMS = len(fields(DaslipParams))
+# the kernels append the loop-invariant damping coefficients of the stance
+N_KERNEL_PARAMS = N_PARAMS + 2
+# phases of a step: flight till touchdown, stance till liftoff, flight till apex
+FLIGHT, STANCE, APEX = 0, 1, 2
+# directions of the fall and touchdown/liftoff/apex events of each phase
+PHASE_EVENT_DIRECTIONS = np.array([[-1.0, -1.0], [-1.0, 1.0], [-1.0, 0.0]])
+
+
+@njit(cache=True)
+def _flight_dynamics(t, x, params):
+    """
+    flight dynamics with swing leg retraction; params: see `DaslipParams`
+    """
+    swing_velocity = params[8]
+    swing_extension_velocity = params[9]
+
+    # * sine and cosine of the leg angle alpha = atan2(dy, dx) - pi/2, taken
+    # * directly from the leg vector instead of through the angle
+    dx = x[0] - x[4]
+    dy = x[1] - x[5]
+    leg_length = math.sqrt(dx * dx + dy * dy)
+    vPerp = swing_velocity * leg_length
+    vParallel = swing_extension_velocity
+    sA = -dx / leg_length
+    cA = dy / leg_length
+    vfx = vPerp * cA + vParallel * sA
+    vfy = vPerp * sA - vParallel * cA
+
+    # The actuator length does change!
+    # TODO actuator is displaced with activation!
+    out = np.zeros(10)
+    out[0] = x[2]
+    out[1] = x[3]
+    out[3] = -params[0]
+    out[4] = x[2] + vfx
+    out[5] = x[3] + vfy
+    return out
+
+
+@njit(cache=True)
+def _stance_dynamics(t, x, params, force_table, period):
+    """
+    stance dynamics of the spring in series with the damper-actuator;
+    params: see `_kernel_params`, force_table: see `actuator.force_table`,
+    period: of the actuator force
+    """
+    gravity = params[0]
+    mass = params[1]
+    stiffness = params[2]
+
+    # * leg angle alpha = atan2(dy, dx) - pi/2, see `_flight_dynamics`
+    dx = x[0] - x[4]
+    dy = x[1] - x[5]
+    leg_length = math.sqrt(dx * dx + dy * dy)
+    spring_length = leg_length - x[6]
+    spring_force = -stiffness * (spring_length - params[3])
+    actuator_force = _actuator_force(t, params, force_table, period)
+    actuator_damping_force = spring_force - actuator_force
+
+    ldotdot = spring_force / mass
+    xdotdot = ldotdot * dx / leg_length
+    ydotdot = ldotdot * dy / leg_length - gravity
+
+    damping_val = actuator_force * params[6]
+    actuator_damping_coefficient = params[N_PARAMS] + max(
+        params[N_PARAMS + 1], damping_val
+    )
+
+    ladot = -actuator_damping_force / actuator_damping_coefficient
+    out = np.zeros(10)
+    out[0] = x[2]
+    out[1] = x[3]
+    out[2] = xdotdot
+    out[3] = ydotdot
+    out[6] = ladot
+    out[7] = actuator_force * ladot
+    out[8] = actuator_damping_force * ladot
+    return out
+
+
+@njit(cache=True)
+def _actuator_force(t, params, force_table, period):
+    return actuator.interp_force(t, force_table, period) * params[13]
+
+
+def _kernel_params(p):
+    """
+    the fields of `DaslipParams`, followed by the viscous and the minimum
+    damping coefficients of the actuator, constant throughout a step
+    """
+    params = DaslipParams.from_dict(p).to_array()
+    viscous_damping = params[5] * params[2]
+    min_damping = params[6] * params[1] * params[0] * params[7]
+    return np.append(params, [viscous_damping, min_damping])
+
+
+def _pack_params(p):
+    """
+    one row per parameter dict of the tuple `p`: the `_kernel_params`, the
+    actuator force period, the length L of the actuator force table, and
+    the table (see `actuator.force_table`) row by row, padded to the
+    longest table
+    """
+    tables = [actuator.force_table(p0) for p0 in p]
+    width = max(table.shape[1] for table in tables)
+    rows = np.zeros((len(p), N_KERNEL_PARAMS + 2 + 3 * width))
+    for idx, (p0, table) in enumerate(zip(p, tables)):
+        rows[idx, :N_KERNEL_PARAMS] = _kernel_params(p0)
+        rows[idx, N_KERNEL_PARAMS] = p0["actuator_force_period"]
+        rows[idx, N_KERNEL_PARAMS + 1] = table.shape[1]
+        rows[idx, N_KERNEL_PARAMS + 2 :].reshape(3, width)[:, : table.shape[1]] = table
+    return rows
+
+
+@njit(cache=True)
+def _packed_stance_dynamics(t, x, row):
+    width = (row.size - N_KERNEL_PARAMS - 2) // 3
+    n_knots = int(row[N_KERNEL_PARAMS + 1])
+    force_table = row[N_KERNEL_PARAMS + 2 :].reshape((3, width))[:, :n_knots]
+    return _stance_dynamics(t, x, row, force_table, row[N_KERNEL_PARAMS])
+
+
+@njit(cache=True)
+def _phase_dynamics(t, x, params):
+    """
+    dynamics of the phase, for params = (packed row, phase)
+    """
+    row, phase = params
+    if phase == STANCE:
+        return _packed_stance_dynamics(t, x, row)
+    return _flight_dynamics(t, x, row)
+
+
+@njit(cache=True)
+def _phase_events(t, x, params):
+    """
+    fall and touchdown/liftoff/apex events of the phase, as in `step`, for
+    params = (packed row, phase)
+    """
+    row, phase = params
+    out = np.empty(2)
+    out[0] = x[1]
+    if phase == FLIGHT:
+        out[1] = x[5] - x[-1]
+    elif phase == STANCE:
+        dx = x[0] - x[4]
+        dy = x[1] - x[5]
+        out[1] = math.sqrt(dx * dx + dy * dy) - x[6] - row[3]
+    else:
+        out[1] = x[3]
+    return out
+
+
+@njit(cache=True)
+def _reset_leg(x, row):
+    leg_angle = row[14] + row[10]
+    base_length = row[4] + row[11]
+    leg_length = row[3] + base_length
+    x = x.copy()
+    x[4] = x[0] + math.sin(leg_angle) * leg_length
+    x[5] = x[1] - math.cos(leg_angle) * leg_length
+    x[6] = base_length
+    return x
+
+
+@njit
+def _apex_to_apex(x, row, tolerances):
+    """
+    the phases of `step` for a single column, keeping only the final state;
+    tolerances: see `_solver_tolerances`
+    """
+    if x[5] < x[-1] or x[1] < x[-1]:  # not feasible
+        return x.copy(), True
+    t = 0.0
+    y = x
+    phase = FLIGHT
+    while True:
+        # * like each solve_ivp of `step`, each phase starts a fresh integration
+        t, y, event = rk45_events(
+            _phase_dynamics,
+            _phase_events,
+            PHASE_EVENT_DIRECTIONS[phase],
+            y,
+            t,
+            t + MAX_TIME,
+            (row, phase),
+            tolerances[phase, 0],
+            tolerances[phase, 1],
+            tolerances[phase, 2],
+        )
+        if event == 0 or phase == APEX:  # fell, or done
+            break
+        if phase == STANCE:
+            y = _reset_leg(y, row)
+        phase += 1
+    # * check_failure
+    return y, y[1] <= 1e-8
+
+
+@njit(parallel=True)
+def _poincare_map_kernel(x, rows, tolerances):
+    """
+    Each state integrates with its own step-size control and events, so the
+    results match `step` per column, up to round-off. States are independent,
+    and distributed over threads.
+    x: (B, 10) array, one contiguous row per state
+    """
+    x_next = np.empty_like(x)
+    failed = np.zeros(x.shape[0], dtype=np.bool_)
+    for idx in prange(x.shape[0]):
+        x_next[idx], failed[idx] = _apex_to_apex(x[idx], rows[idx], tolerances)
+    return x_next, failed
+
+
+def poincare_map_batch(x, p, dtype=None):
+    """
+    Poincare map of a batch of independent columns, in parallel compiled code.
+    x: (10, B) array of states
+    p: tuple of B parameter dicts, all with the (default) RK45 solver
+    dtype: of the returned states, e.g. np.float32 for viability grids;
+    by default that of `x` (at least float32)
+    returns the next states (10, B) and failures (B,)
+    """
+    # * the integration of each column gathers its state at every stage, so
+    # * the kernel takes the states as contiguous rows instead of columns
+    x_next, failed = _poincare_map_kernel(
+        np.ascontiguousarray(x.T, dtype=float), _pack_params(p), _solver_tolerances()
+    )
+    # * integration is always in double precision: the flight tolerances and
+    # * the event location are below float32 resolution. The next states are
+    # * returned in the precision of the grids.
+    if dtype is None:
+        dtype = np.result_type(x, np.float32)
+    return x_next.T.astype(dtype, copy=False), failed
+
+
+def _solver_tolerances():
+    """
+    max_step, rtol and atol of the RK45 integration of each phase, with the
+    defaults of solve_ivp
+    """
+    stance_options = slip.get_solver_options("RK45")
+    tolerances = np.empty((3, 3))
+    for idx, options in enumerate(
+        (FLIGHT_SOLVER_OPTIONS, stance_options, FLIGHT_SOLVER_OPTIONS)
+    ):
+        tolerances[idx, 0] = options.get("max_step", np.inf)
+        tolerances[idx, 1] = options.get("rtol", 1e-3)
+        tolerances[idx, 2] = options.get("atol", 1e-6)
+    return tolerances
 
 
 def feasible(x, p):
@@ -8,15 +302,17 @@ def feasible(x, p):
     check if state is at all feasible (body/foot underground)
     returns a boolean
     """
-    if x[5] < x[-1] or x[1] < x[-1]:
-        return False
-    return True
+    return not (x[5] < x[-1] or x[1] < x[-1])
 
 
 def poincare_map(x, p):
     """
     Wrapper function for step function, returning only x_next, and -1 if failed
     Essentially, the Poincare map.
+    A tuple of parameter dicts maps the columns of x. With the default RK45
+    solver, this runs the compiled phases of `poincare_map_batch`, which is
+    compiled once for all parameter values. A single state runs `step`, which
+    is not worth compiling the kernel for in every process.
     """
     if type(p) is dict:
         if not feasible(x, p):
@@ -24,18 +320,19 @@ def poincare_map(x, p):
         sol = step(x, p)
         return sol.y[:, -1], check_failure(sol.y[:, -1])
     elif type(p) is tuple:
-        vector_of_x = np.zeros(x.shape)  # initialize result array
-        vector_of_fail = np.zeros(x.shape[1])
+        if all(p0.get("ode_solver", "RK45") == "RK45" for p0 in p):
+            return poincare_map_batch(x, p)
+        # * columns starting with the body or foot underground fail unchanged,
+        # * see `feasible`; only the others are integrated
+        feasible_mask = (x[5] >= x[-1]) & (x[1] >= x[-1])
+        vector_of_x = np.array(x, dtype=float)  # initialize result array
+        vector_of_fail = ~feasible_mask
         # TODO: for shorthand, allow just a single tuple to be passed in
         # this can be done easily with itertools
-        for idx, p0 in enumerate(p):
-            if not feasible(x, p):
-                vector_of_x[:, idx] = x[:, idx]
-                vector_of_fail[idx] = True
-            else:
-                sol = step(x[:, idx], p0)  # p0 = p[idx]
-                vector_of_x[:, idx] = sol.y[:, -1]
-                vector_of_fail[idx] = check_failure(sol.y[:, -1])
+        for idx in np.flatnonzero(feasible_mask):
+            sol = step(x[:, idx], p[idx])
+            vector_of_x[:, idx] = sol.y[:, -1]
+            vector_of_fail[idx] = check_failure(sol.y[:, -1])
         return (vector_of_x, vector_of_fail)
     else:
         print("WARNING: I got a parameter type that I don't understand.")
@@ -54,73 +351,16 @@ def step(x0, p, prev_sol=None):
 
     assert len(x0) == 10
 
-    # TODO: test what isn't being used
-    GRAVITY = p["gravity"]
-    MASS = p["mass"]
     SPRING_RESTING_LENGTH = p["resting_length"]
-    # STIFFNESS = p["stiffness"]
-
-    # ACTUATOR_RESTING_LENGTH = p["actuator_resting_length"]
-    SWING_VELOCITY = p["swing_velocity"]
-    SWING_EXTENSION_VELOCITY = p["swing_extension_velocity"]
-    # ACTUATOR_PERIOD = p["actuator_force_period"]
-    # VISCOUS_DAMPING = p["constant_normalized_damping"] * p["stiffness"]
-    # ACTIVE_DAMPING = p["linear_normalized_damping"]
-    # MIN_DAMPING = (
-    #     p["linear_normalized_damping"]
-    #     * p["mass"]
-    #     * p["gravity"]
-    #     * p["linear_minimum_normalized_damping"]
-    # )
-    # DELAY = p["activation_delay"]  # can also be negative
-    # AMPLI = p["activation_amplification"]
-
-    # @jit(nopython=True)
-    def flight_dynamics(t, x):
-        # swing leg retraction
-
-        alpha = np.arctan2(x[1] - x[5], x[0] - x[4]) - np.pi / 2.0
-        leg_length = compute_leg_length(x)
-        vPerp = SWING_VELOCITY * leg_length
-        vParallel = SWING_EXTENSION_VELOCITY
-        sA = np.sin(alpha)
-        cA = np.cos(alpha)
-        vfx = vPerp * cA + vParallel * sA
-        vfy = vPerp * sA - vParallel * cA
+    # * the compiled dynamics take all parameters packed in one array, as in
+    # * `poincare_map_batch`; fewer arguments make each call cheaper
+    row = _pack_params((p,))[0]
 
-        # The actuator length does change!
-        # TODO actuator is displaced with activation!
-        return np.array([x[2], x[3], 0, -GRAVITY, x[2] + vfx, x[3] + vfy, 0, 0, 0, 0])
+    def flight_dynamics(t, x):
+        return _flight_dynamics(t, x, row)
 
-    #    @jit(nopython=True)
     def stance_dynamics(t, x):
-        # stance dynamics
-        alpha = np.arctan2(x[1] - x[5], x[0] - x[4]) - np.pi / 2.0
-        spring_damper_actuator_forces = compute_leg_forces(t, x, p)
-
-        spring_force = spring_damper_actuator_forces[0]
-        actuator_damping_force = spring_damper_actuator_forces[1]
-        actuator_force = spring_damper_actuator_forces[2]
-
-        ldotdot = spring_force / MASS
-        xdotdot = -ldotdot * np.sin(alpha)
-        ydotdot = ldotdot * np.cos(alpha) - GRAVITY
-
-        actuator_damping_coefficient = p["constant_normalized_damping"] * p["stiffness"]
-        damping_min = (
-            p["linear_normalized_damping"]
-            * p["mass"]
-            * p["gravity"]
-            * p["linear_minimum_normalized_damping"]
-        )
-        damping_val = actuator_force * p["linear_normalized_damping"]
-        actuator_damping_coefficient += np.maximum([damping_min], [damping_val])[0]
-
-        ladot = -actuator_damping_force / actuator_damping_coefficient
-        wadot = actuator_force * ladot
-        wddot = actuator_damping_force * ladot
-
-        return np.array([x[2], x[3], xdotdot, ydotdot, 0, 0, ladot, wadot, wddot, 0])
+        return _packed_stance_dynamics(t, x, row)
 
     #    @jit(nopython=True)
     def fall_event(t, x):
@@ -175,6 +415,14 @@ def step(x0, p, prev_sol=None):
     # p is a dict with all the parameters
 
     # set integration options
+    # * p["ode_solver"] selects the solver of all phases, see `slip.SOLVER_OPTIONS`
+    # * only the default RK45 uses `FLIGHT_SOLVER_OPTIONS` for flight phases
+    solver = p.get("ode_solver", "RK45")
+    solver_options = slip.get_solver_options(solver)
+    if solver == "RK45":
+        flight_options = FLIGHT_SOLVER_OPTIONS
+    else:
+        flight_options = solver_options
 
     if prev_sol is not None:
         t0 = prev_sol.t[-1]
@@ -188,18 +436,14 @@ def step(x0, p, prev_sol=None):
         t_span=[t0, t0 + MAX_TIME],
         y0=x0,
         events=events,
-        max_step=0.001,
+        **flight_options,
     )
 
     # TODO Put each part of the step into a list, so you can concat them
     # TODO programmatically, and reduce code length.
     # if you fell, stop now
     if sol.t_events[0].size != 0:  # if empty
-        if prev_sol is not None:
-            sol.t = np.concatenate((prev_sol.t, sol.t))
-            sol.y = np.concatenate((prev_sol.y, sol.y), axis=1)
-            sol.t_events = prev_sol.t_events + sol.t_events
-        return sol
+        return _join_phases(prev_sol, sol)
 
     # * STANCE: simulate till liftoff
     events = [fall_event, liftoff_event]
@@ -209,20 +453,12 @@ def step(x0, p, prev_sol=None):
         t_span=[sol.t[-1], sol.t[-1] + MAX_TIME],
         y0=x0,
         events=events,
-        max_step=0.001,
+        **solver_options,
     )
 
     # if you fell, stop now
     if sol2.t_events[0].size != 0:  # if empty
-        # concatenate all solutions
-        sol.t = np.concatenate((sol.t, sol2.t))
-        sol.y = np.concatenate((sol.y, sol2.y), axis=1)
-        sol.t_events += sol2.t_events
-        if prev_sol is not None:  # concatenate to previous solution
-            sol.t = np.concatenate((prev_sol.t, sol.t))
-            sol.y = np.concatenate((prev_sol.y, sol.y), axis=1)
-            sol.t_events = prev_sol.t_events + sol.t_events
-        return sol
+        return _join_phases(prev_sol, sol, sol2)
 
     # * FLIGHT: simulate till apex
     events = [fall_event, apex_event]
@@ -232,19 +468,32 @@ def step(x0, p, prev_sol=None):
         t_span=[sol2.t[-1], sol2.t[-1] + MAX_TIME],
         y0=x0,
         events=events,
-        max_step=0.001,
+        **flight_options,
     )
 
-    # concatenate all solutions
-    sol.t = np.concatenate((sol.t, sol2.t, sol3.t))
-    sol.y = np.concatenate((sol.y, sol2.y, sol3.y), axis=1)
-    sol.t_events += sol2.t_events + sol3.t_events
+    return _join_phases(prev_sol, sol, sol2, sol3)
 
-    if prev_sol is not None:
-        sol.t = np.concatenate((prev_sol.t, sol.t))
-        sol.y = np.concatenate((prev_sol.y, sol.y), axis=1)
-        sol.t_events = prev_sol.t_events + sol.t_events
 
+def _join_phases(prev_sol, sol, *next_sols):
+    """
+    Append the trajectories and events of the following phases to `sol`, and
+    prepend those of `prev_sol` (if given). The joined trajectory is allocated
+    once and filled in place, instead of concatenating pairwise.
+    """
+    parts = [sol, *next_sols] if prev_sol is None else [prev_sol, sol, *next_sols]
+    if len(parts) == 1:
+        return sol
+    lengths = np.cumsum([0] + [part.t.size for part in parts])
+    t = np.empty(lengths[-1])
+    y = np.empty((sol.y.shape[0], lengths[-1]))
+    t_events = []
+    for part, start, end in zip(parts, lengths[:-1], lengths[1:]):
+        t[start:end] = part.t
+        y[:, start:end] = part.y
+        t_events += part.t_events
+    sol.t = t
+    sol.y = y
+    sol.t_events = t_events
     return sol
 
 
@@ -253,9 +502,8 @@ def check_failure(x):
     Check if a state is in the failure set.
     """
 
-    if np.less_equal(x[1], 0):
-        return True
-    if np.isclose(x[1], 0):
+    # * fallen: at or below the ground, or within 1e-8 of it (as np.isclose)
+    if x[1] <= 1e-8:
         return True
     # if np.less_equal(x[2], 0):  # check for direction reversal
     #     return True
@@ -271,21 +519,23 @@ def check_failure(x):
 
 
 def compute_leg_length(x):
-    return np.hypot(x[0] - x[4], x[1] - x[5])
+    # * no overflow guard of np.hypot needed for legs of about a meter
+    dx = x[0] - x[4]
+    dy = x[1] - x[5]
+    return np.sqrt(dx * dx + dy * dy)
 
 
 # TODO: make this consistent with SLIP model again (call with (x,p) as args)
 def compute_spring_length(x):
-    return np.hypot(x[0] - x[4], x[1] - x[5]) - x[6]
+    return compute_leg_length(x) - x[6]
 
 
 def create_force_trajectory(step_sol, p):
-    actuator_time_force = np.zeros(shape=(2, len(step_sol.t)))
-    for i in range(0, len(step_sol.t)):
-        spring_length = slip.compute_spring_length(step_sol.y[:, i], p)
-        spring_force = -p["stiffness"] * (spring_length - p["resting_length"])
-        actuator_time_force[0, i] = step_sol.t[i]
-        actuator_time_force[1, i] = spring_force
+    # * the SLIP spring length is computed row-wise over the whole trajectory
+    spring_length = slip.compute_spring_length(step_sol.y, p)
+    actuator_time_force = np.empty((2, step_sol.t.size))
+    actuator_time_force[0] = step_sol.t
+    actuator_time_force[1] = -p["stiffness"] * (spring_length - p["resting_length"])
 
     return actuator_time_force
 
@@ -342,9 +592,11 @@ def create_open_loop_trajectories(x0, p, options):
 def reset_leg(x, p):
     leg_angle = p["angle_of_attack"] + p["angle_of_attack_offset"]
     base_length = p["actuator_resting_length"] + p["swing_leg_length_offset"]
+    leg_length = p["resting_length"] + base_length
 
-    x[4] = x[0] + np.sin(leg_angle) * (p["resting_length"] + base_length)
-    x[5] = x[1] - np.cos(leg_angle) * (p["resting_length"] + base_length)
+    # * scalar math functions, this is called for every state-action pair
+    x[4] = x[0] + math.sin(leg_angle) * leg_length
+    x[5] = x[1] - math.cos(leg_angle) * leg_length
     x[6] = base_length
 
     return x
@@ -369,26 +621,45 @@ def compute_potential_kinetic_work_total(state_traj, p):
     Compute potential and kinetic energy, work, and total energy
     state_traj: trajectory of states (e.g. sol.y)
     """
-    cols = np.shape(state_traj)[1]
-    pkwt = np.zeros((5, cols))
-    for i in range(0, cols):
-        spring_length = compute_spring_length(state_traj[:, i])
-        work_actuator = 0
-        work_damper = 0
+    state_traj = np.asarray(state_traj)
+    if state_traj.shape[1] >= PARALLEL_MIN_SAMPLES:
+        return _pkwt_kernel(
+            np.asarray(state_traj, dtype=float),
+            p["stiffness"],
+            p["resting_length"],
+            p["mass"],
+            p["gravity"],
+        )
 
-        work_actuator = state_traj[7, i]
-        work_damper = state_traj[8, i]
+    spring_length = compute_spring_length(state_traj)
+    spring_energy = 0.5 * p["stiffness"] * (spring_length - p["resting_length"]) ** 2
 
-        spring_energy = (
-            0.5 * p["stiffness"] * (spring_length - p["resting_length"]) ** 2
-        )
+    pkwt = np.empty((5, state_traj.shape[1]))
+    pkwt[0] = p["mass"] / 2 * (state_traj[2] ** 2 + state_traj[3] ** 2)
+    pkwt[1] = p["gravity"] * p["mass"] * state_traj[1] + spring_energy
+    pkwt[2] = state_traj[7]  # work of the actuator
+    pkwt[3] = state_traj[8]  # work of the damper
+    pkwt[4] = pkwt[0] + pkwt[1]
 
-        pkwt[0, i] = p["mass"] / 2 * (state_traj[2, i] ** 2 + state_traj[3, i] ** 2)
-        pkwt[1, i] = p["gravity"] * p["mass"] * (state_traj[1, i]) + spring_energy
-        pkwt[2, i] = work_actuator
-        pkwt[3, i] = work_damper
-        pkwt[4, i] = pkwt[0, i] + pkwt[1, i]
+    return pkwt
 
+
+@njit(parallel=True, cache=True)
+def _pkwt_kernel(state_traj, stiffness, resting_length, mass, gravity):
+    """
+    `compute_potential_kinetic_work_total` in a single pass over the samples
+    """
+    pkwt = np.empty((5, state_traj.shape[1]))
+    for i in prange(state_traj.shape[1]):
+        dx = state_traj[0, i] - state_traj[4, i]
+        dy = state_traj[1, i] - state_traj[5, i]
+        spring_length = math.sqrt(dx * dx + dy * dy) - state_traj[6, i]
+        spring_energy = 0.5 * stiffness * (spring_length - resting_length) ** 2
+        pkwt[0, i] = mass / 2 * (state_traj[2, i] ** 2 + state_traj[3, i] ** 2)
+        pkwt[1, i] = gravity * mass * state_traj[1, i] + spring_energy
+        pkwt[2, i] = state_traj[7, i]
+        pkwt[3, i] = state_traj[8, i]
+        pkwt[4, i] = pkwt[0, i] + pkwt[1, i]
     return pkwt
 
 
@@ -416,6 +687,13 @@ def map2s_y_xdot_aoa(x, p):
 #     return x
 
 
+def _activation_time(actuator_force):
+    """
+    time of the first actuator force not close to zero (as np.isclose)
+    """
+    return actuator_force[0, np.flatnonzero(np.abs(actuator_force[1]) > 1e-8)[0]]
+
+
 def sa2xp_y_xdot_aoa(state_action, p_def):
     """
     Specifically map state_actions to x and p
@@ -423,10 +701,10 @@ def sa2xp_y_xdot_aoa(state_action, p_def):
     assert len(state_action) == 3
     p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = state_action[0]  # TODO: reimplement with ground ehight
     x[2] = state_action[1]
-    x = reset_leg(x, p).copy()
+    x = reset_leg(x, p)
     return x, p
 
 
@@ -437,16 +715,15 @@ def sa2xp_y_xdot_timedaoa(state_action, p_def):
     assert len(state_action) == 3
     p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = state_action[0]
     x[2] = state_action[1]
-    x = reset_leg(x, p).copy()
+    x = reset_leg(x, p)
 
     # time till foot touches down
     if feasible(x, p):
         time_to_touchdown = np.sqrt(2 * (x[5] - x[-1]) / p["gravity"])
-        start_idx = np.argwhere(~np.isclose(p["actuator_force"][1], 0))[0]
-        time_to_activation = p["actuator_force"][0, start_idx]
+        time_to_activation = _activation_time(p["actuator_force"])
         p["activation_delay"] = time_to_touchdown - time_to_activation
 
     return x, p
@@ -459,17 +736,16 @@ def sa2xp_amp(state_action, p_def):
     assert len(state_action) == 4
     p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = state_action[0]
     x[2] = state_action[1]
-    x = reset_leg(x, p).copy()
+    x = reset_leg(x, p)
     p["activation_amplification"] = state_action[3]
 
     # time till foot touches down
     if feasible(x, p):
         time_to_touchdown = np.sqrt(2 * (x[5] - x[-1]) / p["gravity"])
-        start_idx = np.argwhere(~np.isclose(p["actuator_force"][1], 0))[0]
-        time_to_activation = p["actuator_force"][0, start_idx]
+        time_to_activation = _activation_time(p["actuator_force"])
         p["activation_delay"] = time_to_touchdown - time_to_activation
 
     return x, p
@@ -489,17 +765,18 @@ def map2s_energy_normalizedheight_aoa(x, p):
     return np.array([total_energy, potential_energy / total_energy])
 
 
-def mapSA2xp_energy_normalizedheight_aoa(state_action, p):
+def mapSA2xp_energy_normalizedheight_aoa(state_action, p_def):
     """
     state_action[0]: total energy
     state_action[1]: potential energy / total energy
     state_action[2]: angle of attack
     """
+    p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
     total_energy = state_action[0]
     potential_energy = state_action[1] * total_energy
     kinetic_energy = (1 - state_action[1]) * total_energy
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = potential_energy / p["mass"] / p["gravity"]
     x[2] = np.sqrt(2 * kinetic_energy / p["mass"])
 
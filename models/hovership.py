@@ -1,5 +1,12 @@
+import math
+from dataclasses import dataclass, fields
+
 import numpy as np
 import scipy.integrate as integrate
+from numba import cuda, float64, njit, prange
+
+from models._numba_ode import make_cuda_rk45, rk45
+from models._params import ModelParams
 
 """
 A spaceship attempting to reconnoitre the surface of a planet.
@@ -8,6 +15,22 @@ the surface may result in getting sucked in, with no escape!
 """
 
 
+@dataclass(frozen=True)
+class HovershipParams(ModelParams):
+    """
+    Parameters of the continuous dynamics, in the layout of the compiled
+    kernels. The thrust is the action, set for each state-action pair.
+    """
+
+    thrust: float
+    base_gravity: float
+    gravity: float
+    ceiling: float
+
+
+N_PARAMS = len(fields(HovershipParams))
+
+
 # * Transition Map. This is your oracle.
 def p_map(x, p):
     """
@@ -64,6 +87,112 @@ def p_map(x, p):
     return sol.y[:, -1], check_failure(sol.y[:, -1], p)
 
 
+def p_map_batch(state_actions, p):
+    """
+    Vectorized transition map, evaluating a whole batch of state-action pairs
+    in parallel compiled code. This combines `sa2xp`, `p_map` and `xp2s`.
+    inputs:
+    state_actions: ndarray of shape (N, n_states + n_actions)
+    p: dict containing all parameters (the action in p is ignored)
+    outputs:
+    x: ndarray of shape (N, n_states), states at next iteration
+    failed: ndarray of shape (N,) of booleans indicating failure
+    """
+
+    x = np.ascontiguousarray(state_actions[:, 0], dtype=float)
+    thrust = np.minimum(p["max_thrust"], state_actions[:, p["n_states"]])
+    # * the compiled kernel takes the parameters as a plain array
+    params = HovershipParams.from_dict(p, thrust=0.0).to_array()
+    x_next = _p_map_kernel(
+        x, thrust.astype(float), params, 1.0 / p["control_frequency"]
+    )
+
+    # * integration is always in double precision, but the next states are
+    # * returned in the precision of the grids (e.g. float32)
+    x_next = x_next.astype(np.result_type(state_actions.dtype, np.float32))
+    return x_next.reshape(-1, 1), x_next < 0
+
+
+@njit(cache=True)
+def _continuous_dynamics(t, x, params):
+    # params: see `HovershipParams`
+    grav_field = max(0.0, np.tanh(0.75 * (params[3] - x[0]))) * params[2]
+    f = np.empty(1)
+    f[0] = -params[1] - grav_field + params[0]
+    return f
+
+
+@njit(parallel=True)
+def _p_map_kernel(x, thrust, params, max_time):
+    """
+    Integrate each pair independently. Instead of a terminal ceiling event,
+    we integrate through it: above the ceiling the dynamics are constant, so
+    any state which crossed it ends above it, and is capped as in `p_map`.
+    """
+    x_next = np.empty_like(x)
+    for idx in prange(x.size):
+        if x[idx] < 0:  # already failed
+            x_next[idx] = x[idx]
+            continue
+        pair_params = params.copy()
+        pair_params[0] = thrust[idx]
+        x_end = rk45(_continuous_dynamics, x[idx : idx + 1], 0.0, max_time, pair_params)
+        x_next[idx] = min(x_end[0], params[3])
+    return x_next
+
+
+def p_map_batch_cuda(state_actions, p, threads_per_block=128):
+    """
+    Same as `p_map_batch`, but integrating one state-action pair per CUDA
+    thread. Requires a CUDA device, check with `numba.cuda.is_available()`.
+    """
+    x = np.ascontiguousarray(state_actions[:, 0], dtype=float)
+    thrust = np.minimum(p["max_thrust"], state_actions[:, p["n_states"]])
+    params = HovershipParams.from_dict(p, thrust=0.0).to_array()
+    x_next = cuda.device_array_like(x)
+    blocks_per_grid = (x.size + threads_per_block - 1) // threads_per_block
+    _p_map_cuda_kernel[blocks_per_grid, threads_per_block](
+        cuda.to_device(x),
+        cuda.to_device(thrust.astype(float)),
+        cuda.to_device(params),
+        1.0 / p["control_frequency"],
+        x_next,
+    )
+    x_next = x_next.copy_to_host()
+
+    # * integration is always in double precision, but the next states are
+    # * returned in the precision of the grids (e.g. float32)
+    x_next = x_next.astype(np.result_type(state_actions.dtype, np.float32))
+    return x_next.reshape(-1, 1), x_next < 0
+
+
+@cuda.jit(device=True)
+def _continuous_dynamics_cuda(t, x, params, out):
+    grav_field = max(0.0, math.tanh(0.75 * (params[3] - x[0]))) * params[2]
+    out[0] = -params[1] - grav_field + params[0]
+
+
+_rk45_cuda = make_cuda_rk45(_continuous_dynamics_cuda, 1)
+
+
+@cuda.jit
+def _p_map_cuda_kernel(x, thrust, params, max_time, x_next):
+    idx = cuda.grid(1)
+    if idx >= x.size:
+        return
+    if x[idx] < 0:  # already failed
+        x_next[idx] = x[idx]
+        return
+    pair_params = cuda.local.array(N_PARAMS, float64)
+    for k in range(N_PARAMS):
+        pair_params[k] = params[k]
+    pair_params[0] = thrust[idx]
+    y = cuda.local.array(1, float64)
+    y[0] = x[idx]
+    _rk45_cuda(y, max_time, pair_params)
+    x_next[idx] = min(y[0], params[3])
+
+
 def check_failure(x, p):
     """
     Check if a state-action pair is in the failure set.
@@ -1,6 +1,334 @@
+import functools
+import math
+from dataclasses import dataclass, fields
+
 import numpy as np
 import scipy.integrate as integrate
+from numba import njit, prange
+
+import models._actuator as actuator
 import models.slip as slip
+from models._numba_ode import rk45_events
+from models._params import ModelParams
+
+# duration limit of each phase of a step
+MAX_TIME = 1.0
+# max_step of the integration of flight and (RK45, see `slip.SOLVER_OPTIONS`)
+# stance phases
+FLIGHT_MAX_STEP = 0.01
+STANCE_MAX_STEP = slip.SOLVER_OPTIONS["RK45"]["max_step"]
+# phases of a step: flight till touchdown, stance till liftoff, flight till apex
+FLIGHT, STANCE, APEX = 0, 1, 2
+PHASE_MAX_STEP = np.array([FLIGHT_MAX_STEP, STANCE_MAX_STEP, FLIGHT_MAX_STEP])
+# directions of the events of each phase, as in `step`: fall, touchdown;
+# fall, liftoff, reversal; fall, apex. The flight phases pad a third event,
+# which never fires.
+PHASE_EVENT_DIRECTIONS = np.array(
+    [[-1.0, -1.0, 0.0], [-1.0, 1.0, -1.0], [-1.0, 0.0, 0.0]]
+)
+
+
+@dataclass(frozen=True)
+class ParslipParams(ModelParams):
+    """
+    Scalar parameters of the SLIP with a parallel actuator, for compiled
+    dynamics. The actuator force trajectory stays in the parameter dict. The
+    angle of attack is the action.
+    """
+
+    gravity: float
+    mass: float
+    stiffness: float
+    resting_length: float
+    actuator_resting_length: float
+    activation_amplification: float
+    angle_of_attack: float
+
+
+N_PARAMS = len(fields(ParslipParams))
+# the kernels append the damping coefficient, see `compute_damping_coefficient`
+N_KERNEL_PARAMS = N_PARAMS + 1
+
+
+@njit(cache=True)
+def _flight_dynamics(t, x, params):
+    """
+    ballistic flight, the foot moving along; params: see `ParslipParams`
+    """
+    out = np.zeros(7)
+    out[0] = x[2]
+    out[1] = x[3]
+    out[3] = -params[0]
+    out[4] = x[2]
+    out[5] = x[3]
+    return out
+
+
+@njit(cache=True)
+def _stance_dynamics(t, x, params, force_table, period):
+    """
+    stance dynamics of the spring-damper in parallel with the actuator;
+    params: see `_kernel_params`, force_table: see `actuator.force_table`,
+    period: of the actuator force
+    """
+    gravity = params[0]
+    mass = params[1]
+    stiffness = params[2]
+
+    act_force = actuator.interp_force(t, force_table, period) * params[5]
+
+    # * the leg vector from the foot to the body, of length r; the leg angle
+    # * alpha = atan2(dy, dx) - pi/2 has sin(alpha) = -dx/r, cos(alpha) = dy/r
+    dx = x[0] - x[4]
+    dy = x[1] - x[5]
+    r = math.sqrt(dx * dx + dy * dy)
+
+    # * spring-damper force
+    # For numerical stability, we use a huntley-cross model
+    # see A COMPUTATIONALLY EFFICIENT MUSCLE MODEL (Millard & Delp 2012)
+    # For this, DAMPING * velocity should result in a dimensionless number
+    spring_length = r - params[4]
+    # * compression velocity: the body velocity towards the foot
+    r_dot = -(dx * x[2] + dy * x[3]) / r
+    sd_force = stiffness * (params[3] - spring_length) * (1 + params[N_PARAMS] * r_dot)
+    leg_force = (act_force + sd_force) / mass
+
+    out = np.zeros(7)
+    out[0] = x[2]
+    out[1] = x[3]
+    out[2] = leg_force * dx / r
+    out[3] = leg_force * dy / r - gravity
+    return out
+
+
+@njit(cache=True)
+def _stance_jacobian(t, x, params, force_table, period):
+    """
+    Jacobian of `_stance_dynamics` with respect to the state, for implicit
+    solvers. With the unit leg vector (ux, uy) of length r, the accelerations
+    are F/m*(ux, uy) - (0, g). The leg force F = act(t) + k*c*(1 + D*q)
+    depends on the compression c = l0 + la - r and the compression velocity
+    q = -(ux*vx + uy*vy).
+    """
+    mass = params[1]
+    stiffness = params[2]
+    damping = params[N_PARAMS]
+
+    dx = x[0] - x[4]
+    dy = x[1] - x[5]
+    r = math.hypot(dx, dy)
+    ux = dx / r
+    uy = dy / r
+    compression = params[3] + params[4] - r
+    q = -(ux * x[2] + uy * x[3])
+    act_force = actuator.interp_force(t, force_table, period) * params[5]
+    leg_force = act_force + stiffness * compression * (1 + damping * q)
+
+    # * derivatives of the leg force by the leg vector and the velocity
+    dforce_ddx = (
+        -stiffness * ux * (1 + damping * q)
+        + stiffness * compression * damping * (-x[2] - q * ux) / r
+    )
+    dforce_ddy = (
+        -stiffness * uy * (1 + damping * q)
+        + stiffness * compression * damping * (-x[3] - q * uy) / r
+    )
+    dforce_dvx = -stiffness * compression * damping * ux
+    dforce_dvy = -stiffness * compression * damping * uy
+
+    jac = np.zeros((7, 7))
+    jac[0, 2] = 1.0
+    jac[1, 3] = 1.0
+    jac[2, 0] = (dforce_ddx * ux + leg_force * uy * uy / r) / mass
+    jac[2, 1] = (dforce_ddy * ux - leg_force * ux * uy / r) / mass
+    jac[3, 0] = (dforce_ddx * uy - leg_force * ux * uy / r) / mass
+    jac[3, 1] = (dforce_ddy * uy + leg_force * ux * ux / r) / mass
+    jac[2, 2] = dforce_dvx * ux / mass
+    jac[2, 3] = dforce_dvy * ux / mass
+    jac[3, 2] = dforce_dvx * uy / mass
+    jac[3, 3] = dforce_dvy * uy / mass
+    # * the foot enters through the leg vector only
+    jac[2:4, 4] = -jac[2:4, 0]
+    jac[2:4, 5] = -jac[2:4, 1]
+    return jac
+
+
+def _kernel_params(p):
+    """
+    the fields of `ParslipParams`, followed by the damping coefficient
+    """
+    params = ParslipParams.from_dict(p).to_array()
+    return np.append(params, compute_damping_coefficient(p))
+
+
+def _pack_params(p):
+    """
+    one row per parameter dict of the tuple `p`: the `_kernel_params`, the
+    actuator force period and activation delay, and the index and length L
+    of its actuator force table; and the tables of the distinct actuator
+    force trajectories (see `actuator.force_table`, without the delay),
+    padded to the longest one. The dicts of a grid sweep are copies that
+    share the same `p["actuator_force"]` array, so they share its table.
+    returns rows (B, N_KERNEL_PARAMS + 4) and tables (T, 3, max L)
+    """
+    table_idx = {}
+    tables = []
+    rows = np.zeros((len(p), N_KERNEL_PARAMS + 4))
+    for idx, p0 in enumerate(p):
+        # * within the call, all arrays are alive, so their ids are unique
+        key = (id(p0["actuator_force"]), p0["actuator_force_period"])
+        if key not in table_idx:
+            table_idx[key] = len(tables)
+            tables.append(actuator.force_table(p0, delay=0.0))
+        rows[idx, :N_KERNEL_PARAMS] = _kernel_params(p0)
+        rows[idx, N_KERNEL_PARAMS] = p0["actuator_force_period"]
+        rows[idx, N_KERNEL_PARAMS + 1] = p0["activation_delay"]
+        rows[idx, N_KERNEL_PARAMS + 2] = table_idx[key]
+        rows[idx, N_KERNEL_PARAMS + 3] = tables[table_idx[key]].shape[1]
+    width = max(table.shape[1] for table in tables)
+    packed_tables = np.zeros((len(tables), 3, width))
+    for idx, table in enumerate(tables):
+        packed_tables[idx, :, : table.shape[1]] = table
+    return rows, packed_tables
+
+
+@njit(cache=True)
+def _stance_args(row, tables):
+    """
+    the arguments of the packed stance functions: the row of
+    `_pack_params`, and its actuator force table
+    """
+    n_knots = int(row[N_KERNEL_PARAMS + 3])
+    return row, tables[int(row[N_KERNEL_PARAMS + 2]), :, :n_knots]
+
+
+@njit(cache=True)
+def _packed_stance_dynamics(t, x, args):
+    row, force_table = args
+    # * the table is not shifted by the activation delay, the time is
+    t_actuator = t - row[N_KERNEL_PARAMS + 1]
+    return _stance_dynamics(t_actuator, x, row, force_table, row[N_KERNEL_PARAMS])
+
+
+@njit(cache=True)
+def _packed_stance_jacobian(t, x, args):
+    row, force_table = args
+    t_actuator = t - row[N_KERNEL_PARAMS + 1]
+    return _stance_jacobian(t_actuator, x, row, force_table, row[N_KERNEL_PARAMS])
+
+
+@njit(cache=True)
+def _spring_extension(x, row):
+    """
+    spring length beyond its resting length, positive after liftoff
+    """
+    return math.hypot(x[0] - x[4], x[1] - x[5]) - row[4] - row[3]
+
+
+@njit(cache=True)
+def _phase_dynamics(t, x, params):
+    """
+    dynamics of the phase, for params = (packed row, force table, phase)
+    """
+    row, force_table, phase = params
+    if phase == STANCE:
+        return _packed_stance_dynamics(t, x, (row, force_table))
+    return _flight_dynamics(t, x, row)
+
+
+@njit(cache=True)
+def _phase_events(t, x, params):
+    """
+    events of the phase, see `PHASE_EVENT_DIRECTIONS`, for
+    params = (packed row, force table, phase)
+    """
+    row, _, phase = params
+    out = np.empty(3)
+    out[0] = x[1]
+    out[2] = 1.0
+    if phase == FLIGHT:
+        out[1] = x[5] - x[-1]
+    elif phase == STANCE:
+        out[1] = _spring_extension(x, row)
+        out[2] = x[2] + 1e-5
+    else:
+        out[1] = x[3]
+    return out
+
+
+@njit(cache=True)
+def _reset_leg(x, row):
+    leg_length = row[3] + row[4]
+    x = x.copy()
+    x[4] = x[0] + math.sin(row[6]) * leg_length
+    x[5] = x[1] - math.cos(row[6]) * leg_length
+    return x
+
+
+@njit
+def _apex_to_apex(x, row, tables):
+    """
+    the phases of `step` for a single state, keeping only the final state
+    """
+    if x[5] < x[-1] or x[1] < x[-1]:  # not feasible
+        return x.copy(), True
+    row, force_table = _stance_args(row, tables)
+    t = 0.0
+    y = x
+    phase = FLIGHT
+    while True:
+        # * like each solve_ivp of `step`, each phase starts a fresh integration
+        t, y, event = rk45_events(
+            _phase_dynamics,
+            _phase_events,
+            PHASE_EVENT_DIRECTIONS[phase],
+            y,
+            t,
+            t + MAX_TIME,
+            (row, force_table, phase),
+            PHASE_MAX_STEP[phase],
+        )
+        if event == 0 or phase == APEX:  # fell, or done
+            break
+        if phase == STANCE:  # after liftoff or reversal
+            y = _reset_leg(y, row)
+        phase += 1
+    # * check_failure
+    return y, y[1] <= 1e-8 or y[2] <= 0
+
+
+@njit(parallel=True)
+def _poincare_map_kernel(x, rows, tables):
+    """
+    Each state integrates with its own step-size control and events, so the
+    results match `step` per column, up to round-off. States are independent,
+    and distributed over threads.
+    x: (B, 7) array, one contiguous row per state
+    """
+    x_next = np.empty_like(x)
+    failed = np.zeros(x.shape[0], dtype=np.bool_)
+    for idx in prange(x.shape[0]):
+        x_next[idx], failed[idx] = _apex_to_apex(x[idx], rows[idx], tables)
+    return x_next, failed
+
+
+def poincare_map_batch(x, p, dtype=None):
+    """
+    Poincare map of a batch of independent columns, in parallel compiled code.
+    x: (7, B) array of states
+    p: tuple of B parameter dicts
+    dtype: of the returned states, e.g. np.float32 for viability grids;
+    by default that of `x` (at least float32)
+    returns the next states (7, B) and failures (B,)
+    """
+    x_next, failed = _poincare_map_kernel(
+        np.ascontiguousarray(x.T, dtype=float), *_pack_params(p)
+    )
+    # * integration is always in double precision: the touchdown and liftoff
+    # * events of the stance phase resolve well below float32 resolution
+    if dtype is None:
+        dtype = np.result_type(x, np.float32)
+    return x_next.T.astype(dtype, copy=False), failed
 
 
 def feasible(x, p):
@@ -17,6 +345,10 @@ def poincare_map(x, p):
     """
     Wrapper function for step function, returning only x_next, and -1 if failed
     Essentially, the Poincare map.
+    A tuple of parameter dicts maps the columns of x. With the default RK45
+    stance solver, this runs the compiled phases of `poincare_map_batch`
+    instead of `step`. A single state runs `step`, which is not worth
+    compiling the kernel for in every process.
     """
     if type(p) is dict:
         if not feasible(x, p):
@@ -24,24 +356,70 @@ def poincare_map(x, p):
         sol = step(x, p)
         return sol.y[:, -1], check_failure(sol.y[:, -1])
     elif type(p) is tuple:
-        vector_of_x = np.zeros(x.shape)  # initialize result array
-        vector_of_fail = np.zeros(x.shape[1])
-        # TODO: for shorthand, allow just a single tuple to be passed in
-        # this can be done easily with itertools
-        for idx, p0 in enumerate(p):
-            if not feasible(x, p):
-                vector_of_x[:, idx] = x[:, idx]
-                vector_of_fail[idx] = True
-            else:
-                sol = step(x[:, idx], p0)  # p0 = p[idx]
-                vector_of_x[:, idx] = sol.y[:, -1]
-                vector_of_fail[idx] = check_failure(sol.y[:, -1])
-        return (vector_of_x, vector_of_fail)
+        if all(p0.get("stance_solver", "RK45") == "RK45" for p0 in p):
+            # * the columns are independent, and integrated in parallel
+            return poincare_map_batch(x, p)
+        # * columns starting with the body or foot underground fail unchanged,
+        # * see `feasible`; only the others are integrated
+        feasible_mask = (x[5] >= x[-1]) & (x[1] >= x[-1])
+        vector_of_x = np.array(x, dtype=float)  # initialize result array
+        for idx in np.flatnonzero(feasible_mask):
+            sol = step(x[:, idx], p[idx])
+            vector_of_x[:, idx] = sol.y[:, -1]
+        return (vector_of_x, ~feasible_mask | check_failure_batch(vector_of_x))
     else:
         print("WARNING: I got a parameter type that I don't understand.")
         return x, True
 
 
+# * the events of `step` that do not depend on the parameters, defined once
+
+
+def fall_event(t, x):
+    """
+    Event function to detect the body hitting the floor (failure)
+    """
+    return x[1]
+
+
+fall_event.terminal = True
+fall_event.direction = -1
+
+
+def touchdown_event(t, x):
+    """
+    Event function for foot touchdown (transition to stance)
+    """
+    # x[1]- np.cos(p['angle_of_attack'])*SPRING_RESTING_LENGTH
+    # (which is = x[5])
+    return x[5] - x[-1]  # final state is ground height
+
+
+touchdown_event.terminal = True  # no longer actually necessary...
+touchdown_event.direction = -1
+
+
+def apex_event(t, x):
+    """
+    Event function to reach apex
+    """
+    return x[3]
+
+
+apex_event.terminal = True
+
+
+def reversal_event(t, x):
+    """
+    Event function for direction reversal
+    """
+    return x[2] + 1e-5  # for numerics, allow for "straight up"
+
+
+reversal_event.terminal = True
+reversal_event.direction = -1
+
+
 def step(x0, p, prev_sol=None):
     """
     Take one step from apex to apex/failure.
@@ -50,115 +428,32 @@ def step(x0, p, prev_sol=None):
 
     # * nested functions - scroll down to step code * #
     # unpacking constants
-    MAX_TIME = 1
-
     # assert(len(x0) == 10)
 
-    # TODO: test what isn't being used
-    GRAVITY = p["gravity"]
-    MASS = p["mass"]
-    SPRING_RESTING_LENGTH = p["resting_length"]
-    STIFFNESS = p["stiffness"]
-    ACTUATOR_PERIOD = p["actuator_force_period"]
-    DAMPING = compute_damping_coefficient(p)
-    DELAY = p["activation_delay"]  # can also be negative
-    AMPLI = p["activation_amplification"]
+    # * the compiled dynamics take all parameters packed in one array, as in
+    # * `poincare_map_batch`
+    rows, tables = _pack_params((p,))
+    row = rows[0]
+    stance_args = _stance_args(row, tables)
 
-    # @jit(nopython=True)
     def flight_dynamics(t, x):
-        return np.array([x[2], x[3], 0, -GRAVITY, x[2], x[3], 0])
+        return _flight_dynamics(t, x, row)
 
-    def compute_leg_forces(t, x, p):
-        """
-        Computes the forces developed by the leg spring, and the damper
-        and actuator, all of which are parallel.
-        """
-
-        # * actuator_force
-        if np.shape(p["actuator_force"])[0] > 0:
-            act_force = np.interp(
-                t,
-                p["actuator_force"][0, :] + DELAY,
-                p["actuator_force"][1, :],  # force
-                period=ACTUATOR_PERIOD,
-            )
-            act_force *= AMPLI
-        else:
-            act_force = 0
-
-        # * spring-damper force
-        # For numerical stability, we use a huntley-cross model
-        # see A COMPUTATIONALLY EFFICIENT MUSCLE MODEL (Millard & Delp 2012)
-        # For this, DAMPING * velocity should result in a dimensionless number
-
-        spring_compression = SPRING_RESTING_LENGTH - compute_spring_length(x, p)
-        r_dot = compute_spring_velocity(x, p)
-        sd_force = STIFFNESS * (spring_compression) * (1 + DAMPING * r_dot)
-
-        return act_force + sd_force
-
-    #    @jit(nopython=True)
     def stance_dynamics(t, x):
-        # stance dynamics
-        alpha = np.arctan2(x[1] - x[5], x[0] - x[4]) - np.pi / 2.0
-        leg_force = compute_leg_forces(t, x, p) / MASS
-        xdotdot = -leg_force * np.sin(alpha)
-        ydotdot = leg_force * np.cos(alpha) - GRAVITY
+        return _packed_stance_dynamics(t, x, stance_args)
 
-        return np.array([x[2], x[3], xdotdot, ydotdot, 0, 0, 0])
+    def stance_jacobian(t, x):
+        return _packed_stance_jacobian(t, x, stance_args)
 
-    #    @jit(nopython=True)
-    def fall_event(t, x):
-        """
-        Event function to detect the body hitting the floor (failure)
-        """
-        return x[1]
-
-    fall_event.terminal = True
-    fall_event.terminal = -1
-
-    #    @jit(nopython=True)
-    def touchdown_event(t, x):
-        """
-        Event function for foot touchdown (transition to stance)
-        """
-        # x[1]- np.cos(p['angle_of_attack'])*SPRING_RESTING_LENGTH
-        # (which is = x[5])
-        return x[5] - x[-1]  # final state is ground height
-
-    touchdown_event.terminal = True  # no longer actually necessary...
-    touchdown_event.direction = -1
-
-    #    @jit(nopython=True)
     def liftoff_event(t, x):
         """
         Event function to reach maximum spring extension (transition to flight)
         """
-        spring_length = compute_spring_length(x, p)
-        event_val = spring_length - SPRING_RESTING_LENGTH
-        return event_val
+        return _spring_extension(x, row)
 
     liftoff_event.terminal = True
     liftoff_event.direction = 1
 
-    #    @jit(nopython=True)
-    def apex_event(t, x):
-        """
-        Event function to reach apex
-        """
-        return x[3]
-
-    apex_event.terminal = True
-
-    def reversal_event(t, x):
-        """
-        Event function for direction reversal
-        """
-        return x[2] + 1e-5  # for numerics, allow for "straight up"
-
-    reversal_event.terminal = True
-    reversal_event.direction = -1
-
     # * Start of step code * #
 
     # TODO: properly update sol object with all info, not just the trajectories
@@ -169,6 +464,11 @@ def step(x0, p, prev_sol=None):
     # p is a dict with all the parameters
 
     # set integration options
+    # * p["stance_solver"] selects the stance solver, see `slip.SOLVER_OPTIONS`;
+    # * LSODA switches to implicit steps when stiff, with the exact Jacobian
+    stance_options = slip.get_solver_options(p.get("stance_solver", "RK45"))
+    if stance_options["method"] == "LSODA":
+        stance_options = dict(stance_options, jac=stance_jacobian)
 
     if prev_sol is not None:
         t0 = prev_sol.t[-1]
@@ -178,18 +478,16 @@ def step(x0, p, prev_sol=None):
     # * FLIGHT: simulate till touchdown
     events = [fall_event, touchdown_event]
     sol = integrate.solve_ivp(
-        flight_dynamics, t_span=[t0, t0 + MAX_TIME], y0=x0, events=events, max_step=0.01
+        flight_dynamics,
+        t_span=[t0, t0 + MAX_TIME],
+        y0=x0,
+        events=events,
+        max_step=FLIGHT_MAX_STEP,
     )
 
-    # TODO Put each part of the step into a list, so you can concat them
-    # TODO programmatically, and reduce code length.
     # if you fell, stop now
     if sol.t_events[0].size != 0:  # if empty
-        if prev_sol is not None:
-            sol.t = np.concatenate((prev_sol.t, sol.t))
-            sol.y = np.concatenate((prev_sol.y, sol.y), axis=1)
-            sol.t_events = prev_sol.t_events + sol.t_events
-        return sol
+        return _join_phases(prev_sol, sol)
 
     # * STANCE: simulate till liftoff
     events = [fall_event, liftoff_event, reversal_event]
@@ -199,20 +497,12 @@ def step(x0, p, prev_sol=None):
         t_span=[sol.t[-1], sol.t[-1] + MAX_TIME],
         y0=x0,
         events=events,
-        max_step=0.001,
+        **stance_options,
     )
 
     # if you fell, stop now
     if sol2.t_events[0].size != 0:  # if empty
-        # concatenate all solutions
-        sol.t = np.concatenate((sol.t, sol2.t))
-        sol.y = np.concatenate((sol.y, sol2.y), axis=1)
-        sol.t_events += sol2.t_events
-        if prev_sol is not None:  # concatenate to previous solution
-            sol.t = np.concatenate((prev_sol.t, sol.t))
-            sol.y = np.concatenate((prev_sol.y, sol.y), axis=1)
-            sol.t_events = prev_sol.t_events + sol.t_events
-        return sol
+        return _join_phases(prev_sol, sol, sol2)
 
     # * FLIGHT: simulate till apex
     events = [fall_event, apex_event]
@@ -222,34 +512,41 @@ def step(x0, p, prev_sol=None):
         t_span=[sol2.t[-1], sol2.t[-1] + MAX_TIME],
         y0=x0,
         events=events,
-        max_step=0.01,
+        max_step=FLIGHT_MAX_STEP,
     )
 
-    # concatenate all solutions
-    sol.t = np.concatenate((sol.t, sol2.t, sol3.t))
-    sol.y = np.concatenate((sol.y, sol2.y, sol3.y), axis=1)
-    sol.t_events += sol2.t_events + sol3.t_events
+    return _join_phases(prev_sol, sol, sol2, sol3)
 
-    if prev_sol is not None:
-        sol.t = np.concatenate((prev_sol.t, sol.t))
-        sol.y = np.concatenate((prev_sol.y, sol.y), axis=1)
-        sol.t_events = prev_sol.t_events + sol.t_events
 
+def _join_phases(prev_sol, sol, *next_sols):
+    """
+    Append the trajectories and events of the following phases to `sol`, and
+    prepend those of `prev_sol` (if given), with a single concatenation.
+    The event times stay one array per event of each phase, in order (see
+    `plotting.single_trials`), rather than being merged across phases.
+    """
+    parts = [sol, *next_sols] if prev_sol is None else [prev_sol, sol, *next_sols]
+    if len(parts) == 1:
+        return sol
+    sol.t = np.concatenate([part.t for part in parts])
+    sol.y = np.concatenate([part.y for part in parts], axis=1)
+    sol.t_events = [event for part in parts for event in part.t_events]
     return sol
 
 
+def check_failure_batch(x):
+    """
+    Check which columns of a (7, N) array of states are in the failure set:
+    fallen, at or within 1e-8 of the ground (as np.isclose), or reversed.
+    """
+    return (x[1] <= 1e-8) | (x[2] <= 0)
+
+
 def check_failure(x):
     """
     Check if a state is in the failure set.
     """
-
-    if np.less_equal(x[1], 0):
-        return True
-    if np.isclose(x[1], 0):
-        return True
-    if np.less_equal(x[2], 0):  # check for direction reversal
-        return True
-    return False
+    return bool(x[1] <= 1e-8 or x[2] <= 0)
 
 
 def compute_leg_length(x, p):
@@ -257,14 +554,17 @@ def compute_leg_length(x, p):
 
 
 def compute_spring_length(x, p):
-    return np.hypot(x[0] - x[4], x[1] - x[5]) - p["actuator_resting_length"]
+    return compute_leg_length(x, p) - p["actuator_resting_length"]
 
 
 def compute_spring_velocity(x, p):
-    beta = np.arctan2(x[5] - x[1], x[4] - x[0])  # aoa
-    delta = np.arctan2(x[3], x[2])
-    gamma = beta - delta  # + np.pi/2
-    return np.hypot(x[2], x[3]) * np.cos(gamma)
+    """
+    the compression velocity of the leg, the body velocity towards the foot
+    (as in `_stance_dynamics`); x can also be a trajectory
+    """
+    dx = x[0] - x[4]
+    dy = x[1] - x[5]
+    return -(dx * x[2] + dy * x[3]) / np.hypot(dx, dy)
 
 
 def compute_damping_coefficient(p):
@@ -283,21 +583,32 @@ def compute_damping_coefficient(p):
     # * option 2 (normalize with mass and gravity)
     # return p['damping']*2*np.sqrt(p['stiffness']/p['mass'])/p['gravity']
     # * option 1 (normalize with stiffness and resting length)
-    return p["damping"] * 2 * np.sqrt(p["mass"] / p["stiffness"]) / p["resting_length"]
+    return _damping_coefficient(
+        float(p["damping"]),
+        float(p["mass"]),
+        float(p["stiffness"]),
+        float(p["resting_length"]),
+    )
 
 
-def create_force_trajectory(step_sol, p):
-    actuator_time_force = np.zeros(shape=(2, len(step_sol.t)))
+@functools.lru_cache(maxsize=256)
+def _damping_coefficient(damping, mass, stiffness, resting_length):
+    # * cached, since it is constant over the parameter dicts of a grid sweep
+    return damping * 2 * math.sqrt(mass / stiffness) / resting_length
 
+
+def create_force_trajectory(step_sol, p):
     # DAMPING = p['damping']*2*np.sqrt(p['stiffness']/p['mass'])/p['gravity']
     DAMPING = compute_damping_coefficient(p)
-    for i in range(0, len(step_sol.t)):
-        spring_length = slip.compute_spring_length(step_sol.y[:, i], p)
-        spring_force = -p["stiffness"] * (spring_length - p["resting_length"])
-        spring_velocity = compute_spring_velocity(step_sol.y[:, i], p)
-        actuator_time_force[0, i] = step_sol.t[i]  # first column: time
-        actuator_time_force[1, i] = -spring_force * DAMPING * spring_velocity
-        # force: -b*k*x*xdot: Hunt-Crossley model
+    # * the spring states of the whole trajectory at once
+    spring_length = slip.compute_spring_length(step_sol.y, p)
+    spring_force = -p["stiffness"] * (spring_length - p["resting_length"])
+    spring_velocity = compute_spring_velocity(step_sol.y, p)
+
+    actuator_time_force = np.empty((2, len(step_sol.t)))
+    actuator_time_force[0] = step_sol.t  # first row: time
+    # force: -b*k*x*xdot: Hunt-Crossley model
+    actuator_time_force[1] = -spring_force * DAMPING * spring_velocity
     return actuator_time_force
 
 
@@ -344,31 +655,39 @@ def create_open_loop_trajectories(x0, p, options):
 
 def reset_leg(x, p):
     leg_length = p["resting_length"] + p["actuator_resting_length"]
-    x[4] = x[0] + np.sin(p["angle_of_attack"]) * leg_length
-    x[5] = x[1] - np.cos(p["angle_of_attack"]) * leg_length
+    # * scalar math functions, this is called for every state-action pair
+    x[4] = x[0] + math.sin(p["angle_of_attack"]) * leg_length
+    x[5] = x[1] - math.cos(p["angle_of_attack"]) * leg_length
 
     return x
 
 
+def reset_leg_batch(x, p):
+    """
+    `reset_leg` for the columns of a (7, B) array of states, in place, with
+    a single parameter dict or a tuple of B dicts (as for `poincare_map`)
+    """
+    if type(p) is dict:
+        p = (p,)
+    angles = np.array([p0["angle_of_attack"] for p0 in p])
+    leg_lengths = np.array(
+        [p0["resting_length"] + p0["actuator_resting_length"] for p0 in p]
+    )
+    x[4] = x[0] + np.sin(angles) * leg_lengths
+    x[5] = x[1] - np.cos(angles) * leg_lengths
+    return x
+
+
 def compute_total_energy(x, p):
-    # TODO: make this accept a trajectory, and output parts as well
-    if len(x.shape) == 1:
-        spring_length = compute_spring_length(x, p)
-        energy = (
-            p["mass"] / 2 * (x[2] ** 2 + x[3] ** 2)
-            + p["gravity"] * p["mass"] * (x[1])
-            + p["stiffness"] / 2 * (spring_length - p["resting_length"]) ** 2
-        )
-        return energy
-
-    energy = np.zeros(x.shape[1])
-    for idx in range(energy.size):
-        spring_length = compute_spring_length(x[:, idx], p)
-        energy[idx] = (
-            p["mass"] / 2 * (x[2, idx] ** 2 + x[3, idx] ** 2)
-            + p["gravity"] * p["mass"] * (x[1, idx])
-            + p["stiffness"] / 2 * (spring_length - p["resting_length"]) ** 2
-        )
+    """
+    total energy of a state, or of each state (column) of a trajectory
+    """
+    spring_length = compute_spring_length(x, p)
+    energy = (
+        p["mass"] / 2 * (x[2] ** 2 + x[3] ** 2)
+        + p["gravity"] * p["mass"] * (x[1])
+        + p["stiffness"] / 2 * (spring_length - p["resting_length"]) ** 2
+    )
 
     return energy
 
@@ -431,10 +750,10 @@ def sa2xp_y_xdot_aoa(state_action, p_def):
     assert len(state_action) == 3
     p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = state_action[0]  # TODO: reimplement with ground height
     x[2] = state_action[1]
-    x = reset_leg(x, p).copy()
+    x = reset_leg(x, p)
     return x, p
 
 
@@ -445,15 +764,15 @@ def sa2xp_y_xdot_timedaoa(state_action, p_def):
     assert len(state_action) == 3
     p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = state_action[0]
     x[2] = state_action[1]
-    x = reset_leg(x, p).copy()
+    x = reset_leg(x, p)
 
     # time till foot touches down
     if feasible(x, p):
-        time_to_touchdown = np.sqrt(2 * (x[5] - x[-1]) / p["gravity"])
-        start_idx = np.argwhere(~np.isclose(p["actuator_force"][1], 0))[0]
+        time_to_touchdown = math.sqrt(2 * (x[5] - x[-1]) / p["gravity"])
+        start_idx = np.argwhere(~np.isclose(p["actuator_force"][1], 0))[0, 0]
         time_to_activation = p["actuator_force"][0, start_idx]
         p["activation_delay"] = time_to_touchdown - time_to_activation
 
@@ -467,16 +786,16 @@ def sa2xp_amp(state_action, p_def):
     assert len(state_action) == 4
     p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = state_action[0]
     x[2] = state_action[1]
-    x = reset_leg(x, p).copy()
+    x = reset_leg(x, p)
     p["activation_amplification"] = state_action[3]
 
     # time till foot touches down
     if feasible(x, p):
-        time_to_touchdown = np.sqrt(2 * (x[5] - x[-1]) / p["gravity"])
-        start_idx = np.argwhere(~np.isclose(p["actuator_force"][1], 0))[0]
+        time_to_touchdown = math.sqrt(2 * (x[5] - x[-1]) / p["gravity"])
+        start_idx = np.argwhere(~np.isclose(p["actuator_force"][1], 0))[0, 0]
         time_to_activation = p["actuator_force"][0, start_idx]
         p["activation_delay"] = time_to_touchdown - time_to_activation
 
@@ -487,6 +806,24 @@ def xp2s_y_xdot(x, p):
     return np.array((x[1], x[2]))
 
 
+def p_map_batch(state_actions, p):
+    """
+    Vectorized transition map over an (N, 3) array of state-action pairs
+    (apex height, forward velocity, angle of attack), combining
+    `sa2xp_y_xdot_timedaoa`, `poincare_map` and `xp2s_y_xdot`, for
+    `compute_Q_map(..., batched=True)`. All pairs are mapped in a single
+    call of the batched `poincare_map`.
+    returns the next states (N, 2) and failures (N,)
+    """
+    x = np.empty((np.size(p["x0"]), len(state_actions)))
+    params = []
+    for idx, state_action in enumerate(state_actions):
+        x[:, idx], p_pair = sa2xp_y_xdot_timedaoa(state_action, p)
+        params.append(p_pair)
+    x_next, failed = poincare_map(x, tuple(params))
+    return xp2s_y_xdot(x_next, p).T, failed
+
+
 def map2s_energy_normalizedheight_aoa(x, p):
     """
     map an apex state to the low-dim state used for the viability comp
@@ -497,17 +834,18 @@ def map2s_energy_normalizedheight_aoa(x, p):
     return np.array([total_energy, potential_energy / total_energy])
 
 
-def mapSA2xp_energy_normalizedheight_aoa(state_action, p):
+def mapSA2xp_energy_normalizedheight_aoa(state_action, p_def):
     """
     state_action[0]: total energy
     state_action[1]: potential energy / total energy
     state_action[2]: angle of attack
     """
+    p = p_def.copy()
     p["angle_of_attack"] = state_action[2]
     total_energy = state_action[0]
     potential_energy = state_action[1] * total_energy
     kinetic_energy = (1 - state_action[1]) * total_energy
-    x = p["x0"]
+    x = p["x0"].copy()  # do not modify the default state
     x[1] = potential_energy / p["mass"] / p["gravity"]
     x[2] = np.sqrt(2 * kinetic_energy / p["mass"])
 
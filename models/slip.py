@@ -1,7 +1,46 @@
+from dataclasses import dataclass
+
 import numpy as np
 import scipy.integrate as integrate
 from numba import njit
 
+from models._params import ModelParams
+
+
+@dataclass(frozen=True)
+class SlipParams(ModelParams):
+    """
+    Scalar parameters of the SLIP, in the layout of the compiled maps (see
+    `slip_jax`). `total_energy` is set by `compute_total_energy`.
+    """
+
+    gravity: float
+    mass: float
+    stiffness: float
+    resting_length: float
+    actuator_resting_length: float
+    total_energy: float
+
+
+# * solve_ivp options for the numerically integrated phases, selected by name
+# * with p["stance_solver"]. The default RK45 caps the step size to locate
+# * events accurately; the compiled DOP853 and LSODA solvers instead use tight
+# * tolerances without a cap, and take far fewer steps (about 10x faster).
+SOLVER_OPTIONS = {
+    "RK45": {"method": "RK45", "max_step": 0.001},
+    "DOP853": {"method": "DOP853", "rtol": 1e-6, "atol": 1e-8},
+    "LSODA": {"method": "LSODA", "rtol": 1e-6, "atol": 1e-8},
+}
+
+
+def get_solver_options(name):
+    """
+    solve_ivp keyword arguments of the solver `name`, see `SOLVER_OPTIONS`
+    """
+    if name not in SOLVER_OPTIONS:
+        raise ValueError(f"Unsupported solver '{name}'")
+    return SOLVER_OPTIONS[name]
+
 
 @njit(cache=True)
 def _compute_flight_dynamics(x, gravity):
@@ -336,7 +375,7 @@ def step(x0, p, prev_sol=None, flight_mode=None):
         t_span=[sol.t[-1], sol.t[-1] + MAX_TIME],
         y0=x0,
         events=events,
-        max_step=0.001,
+        **get_solver_options(p.get("stance_solver", "RK45")),
     )
 
     # if you fell, stop now
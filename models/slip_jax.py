@@ -0,0 +1,239 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import lax
+
+from models.slip import SlipParams
+
+"""
+JAX port of the SLIP transition map in `slip.py`, for computing Q-maps on
+entire state-action grids at once: the map is traced once, `jax.vmap`-ed over
+all pairs, and compiled by XLA (for CPU or GPU). JAX is an optional
+dependency, only needed for this module.
+
+Flight phases are solved in closed form, as in `slip.py`. Stance is integrated
+with fixed RK4 steps of `STANCE_STEP` (the `max_step` of the scipy stance
+integration) in a `lax.while_loop`, and events are located by bisection
+within the last step. Results therefore match `slip.p_map` closely, but not
+bit-for-bit.
+"""
+
+jax.config.update("jax_enable_x64", True)
+
+MAX_TIME = 5.0
+STANCE_STEP = 1e-3
+BISECTION_ITERATIONS = 40
+# fall, liftoff and reversal events, as in `slip.step`
+EVENT_DIRECTIONS = np.array([-1, 1, -1])
+
+
+def _params(p):
+    """
+    pack the parameter dict into an array, so changing values does not
+    trigger recompilation: the fields of `SlipParams`, then the horizontal
+    start and ground height of `x0`
+    """
+    x0 = p["x0"]
+    return jnp.array(np.append(SlipParams.from_dict(p).to_array(), [x0[0], x0[-1]]))
+
+
+def _reset_leg(x, aoa, params):
+    leg_length = params[3] + params[4]
+    x = x.at[4].set(x[0] + jnp.sin(aoa) * leg_length)
+    return x.at[5].set(x[1] - jnp.cos(aoa) * leg_length)
+
+
+def _s2x(s, aoa, params):
+    gravity, mass, total_energy = params[0], params[1], params[5]
+    y = total_energy * s / mass / gravity
+    vx = jnp.sqrt(total_energy * (1 - s) / mass * 2)
+    x = jnp.array([params[6], y, vx, 0.0, 0.0, 0.0, params[7]])
+    return _reset_leg(x, aoa, params)
+
+
+def _xp2s(x, params):
+    potential_energy = params[1] * params[0] * x[1]
+    kinetic_energy = params[1] / 2 * x[2] ** 2
+    return potential_energy / (potential_energy + kinetic_energy)
+
+
+def _ballistic_time(offset, velocity, gravity):
+    """
+    smallest non-negative dt solving offset + velocity*dt - gravity/2*dt^2 = 0,
+    or inf if there is none (see `slip._solve_ballistic_quadratic`)
+    """
+    discriminant = velocity**2 + 2 * gravity * offset
+    discriminant = jnp.where(discriminant > -1e-12, jnp.maximum(discriminant, 0), -1)
+    sqrt_disc = jnp.sqrt(jnp.maximum(discriminant, 0))
+    roots = jnp.array([(-velocity + sqrt_disc), (-velocity - sqrt_disc)]) / -gravity
+    roots = jnp.where((roots >= 0) & (discriminant >= 0), roots, jnp.inf)
+    return jnp.min(roots)
+
+
+def _apex_time(velocity, gravity):
+    apex_time = jnp.where(jnp.abs(velocity) <= 1e-8, 0.0, velocity / gravity)
+    return jnp.where(velocity < 0, jnp.inf, apex_time)
+
+
+def _flight_state(x, dt, gravity):
+    drop = x[3] * dt - 0.5 * gravity * dt**2
+    x = x.at[0].add(x[2] * dt).at[4].add(x[2] * dt)
+    x = x.at[1].add(drop).at[5].add(drop)
+    return x.at[3].add(-gravity * dt)
+
+
+def _first_event(times):
+    """
+    index and time of the first event within MAX_TIME; earlier events in the
+    sequence win ties. Without events, the flight lasts MAX_TIME.
+    """
+    times = jnp.where(times > MAX_TIME, jnp.inf, times)
+    idx = jnp.argmin(times)
+    return idx, jnp.where(jnp.isinf(times[idx]), MAX_TIME, times[idx])
+
+
+def _stance_dynamics(x, params):
+    gravity, mass, stiffness, resting_length, leg_length_offset = params[:5]
+    x_rel = x[0] - x[4]
+    y_rel = x[1] - x[5]
+    alpha = jnp.arctan2(y_rel, x_rel) - jnp.pi / 2.0
+    spring_length = jnp.hypot(x_rel, y_rel) - leg_length_offset
+    leg_force = stiffness / mass * (resting_length - spring_length)
+    zero = jnp.zeros(3)
+    return jnp.concatenate(
+        (
+            jnp.array(
+                [
+                    x[2],
+                    x[3],
+                    -leg_force * jnp.sin(alpha),
+                    leg_force * jnp.cos(alpha) - gravity,
+                ]
+            ),
+            zero,
+        )
+    )
+
+
+def _rk4_step(x, h, params):
+    k1 = _stance_dynamics(x, params)
+    k2 = _stance_dynamics(x + h / 2 * k1, params)
+    k3 = _stance_dynamics(x + h / 2 * k2, params)
+    k4 = _stance_dynamics(x + h * k3, params)
+    return x + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+def _stance_events(x, params):
+    spring_length = jnp.hypot(x[0] - x[4], x[1] - x[5]) - params[4]
+    return jnp.array([x[1], spring_length - params[3], x[2] + 1e-5])
+
+
+def _crossed(g, g_new):
+    # zero crossings in the direction of each event, as in scipy's solve_ivp
+    up = (g <= 0) & (g_new >= 0)
+    down = (g >= 0) & (g_new <= 0)
+    return jnp.where(EVENT_DIRECTIONS > 0, up, down)
+
+
+def _integrate_stance(x, params):
+    """
+    integrate stance until the first event; returns the final state and which
+    of the (fall, liftoff, reversal) events occurred
+    """
+
+    def not_done(carry):
+        t, _, _, done = carry
+        return ~done & (t < MAX_TIME)
+
+    def step(carry):
+        t, x, g, _ = carry
+        x_new = _rk4_step(x, STANCE_STEP, params)
+        g_new = _stance_events(x_new, params)
+        done = jnp.any(_crossed(g, g_new))
+        # keep the start of the step in which an event occurred
+        return (
+            jnp.where(done, t, t + STANCE_STEP),
+            jnp.where(done, x, x_new),
+            jnp.where(done, g, g_new),
+            done,
+        )
+
+    carry = (0.0, x, _stance_events(x, params), jnp.array(False))
+    _, x, g, done = lax.while_loop(not_done, step, carry)
+
+    def bisect(_, bounds):
+        lo, hi = bounds
+        mid = 0.5 * (lo + hi)
+        crossed = jnp.any(
+            _crossed(g, _stance_events(_rk4_step(x, mid, params), params))
+        )
+        return jnp.where(crossed, lo, mid), jnp.where(crossed, mid, hi)
+
+    _, h_event = lax.fori_loop(0, BISECTION_ITERATIONS, bisect, (0.0, STANCE_STEP))
+    x_event = _rk4_step(x, h_event, params)
+    events = _crossed(g, _stance_events(x_event, params)) & done
+    return jnp.where(done, x_event, x), events
+
+
+def p_map(state_action, params):
+    """
+    pure version of `slip.p_map`, composed with `sa2xp` and `xp2s`.
+    inputs:
+    state_action: array of (normalized height, angle of attack)
+    params: parameter array, see `_params`
+    outputs:
+    s: normalized apex height at the next step
+    failed: boolean indicating if the system has failed
+    """
+    gravity = params[0]
+    s, aoa = state_action[0], state_action[1]
+    x = _s2x(s, aoa, params)
+    infeasible = (x[5] < 0) | (x[1] < 0)
+
+    # * FLIGHT: till touchdown (or falling)
+    event_times = jnp.array(
+        [
+            _ballistic_time(x[1], x[3], gravity),
+            _ballistic_time(x[5] - x[6], x[3], gravity),
+        ]
+    )
+    event, duration = _first_event(event_times)
+    x_touchdown = _flight_state(x, duration, gravity)
+    fell = event == 0
+
+    # * STANCE: till liftoff (or falling/reversing)
+    x_stance, events = _integrate_stance(x_touchdown, params)
+    stance_failed = events[0] | events[2]
+
+    # * FLIGHT: till apex (or falling)
+    x_liftoff = _reset_leg(x_stance, aoa, params)
+    event_times = jnp.array(
+        [
+            _ballistic_time(x_liftoff[1], x_liftoff[3], gravity),
+            _apex_time(x_liftoff[3], gravity),
+        ]
+    )
+    _, duration = _first_event(event_times)
+    x_apex = _flight_state(x_liftoff, duration, gravity)
+
+    x_next = jnp.where(
+        infeasible,
+        x,
+        jnp.where(fell, x_touchdown, jnp.where(stance_failed, x_stance, x_apex)),
+    )
+    # * check_failure: falling or reversing direction
+    failed = infeasible | (x_next[1] <= 1e-8) | (x_next[2] <= 0)
+    return _xp2s(x_next, params), failed
+
+
+fill_qmap = jax.jit(jax.vmap(p_map, in_axes=(0, None)))
+
+
+def p_map_batch(state_actions, p):
+    """
+    Vectorized transition map over an (N, 2) array of state-action pairs,
+    for `compute_Q_map(..., batched=True)`.
+    returns the next states (N, 1) and failures (N,)
+    """
+    s_next, failed = fill_qmap(jnp.asarray(state_actions, dtype=float), _params(p))
+    return np.asarray(s_next).reshape(-1, 1), np.asarray(failed)
@@ -1,5 +1,12 @@
+import math
+from dataclasses import dataclass, fields
+
 import numpy as np
 import scipy.integrate as integrate
+from numba import cuda, float64, njit, prange
+
+from models._numba_ode import make_cuda_rk45, rk45
+from models._params import ModelParams
 
 """
 space attempting to reconnoitre the surface of a planet.
@@ -14,6 +21,24 @@ p: dict of parameters. For convenience, actions are also stored here.
 # map: x_k+1, failed = map
 
 
+@dataclass(frozen=True)
+class Spaceship4Params(ModelParams):
+    """
+    Parameters of the continuous dynamics, in the layout of the compiled
+    kernels. The thrusts are the actions, set for each state-action pair.
+    """
+
+    thrust_vertical: float
+    thrust_horizontal: float
+    wind: float
+    gravity: float
+    base_gravity: float
+    ceiling: float
+
+
+N_PARAMS = len(fields(Spaceship4Params))
+
+
 def p_map(x, p):
     """
     Dynamics function of your system
@@ -56,6 +81,129 @@ def p_map(x, p):
     return sol.y[:, -1], check_failure(sol.y[:, -1], p)
 
 
+def p_map_batch(state_actions, p):
+    """
+    Vectorized transition map over a batch of state-action pairs, combining
+    `sa2xp`, `p_map` and `xp2s`. Pairs are integrated in parallel compiled code.
+    state_actions: ndarray of shape (N, n_states + n_actions)
+    returns the next states (N, n_states) and failures (N,)
+    """
+    n_states = p["n_states"]
+    x = np.ascontiguousarray(state_actions[:, :n_states], dtype=float)
+    thrust = np.ascontiguousarray(state_actions[:, n_states:], dtype=float)
+    params = Spaceship4Params.from_dict(
+        p, thrust_vertical=0.0, thrust_horizontal=0.0
+    ).to_array()
+    started_failed = check_failure_batch(x, p)
+    x_next = _p_map_kernel(
+        x, thrust, started_failed, params, 1.0 / p["control_frequency"]
+    )
+    # * integration is always in double precision, but the next states are
+    # * returned in the precision of the grids (e.g. float32)
+    x_next = x_next.astype(np.result_type(state_actions.dtype, np.float32))
+    return x_next, check_failure_batch(x_next, p)
+
+
+@njit(cache=True)
+def _continuous_dynamics(t, x, params):
+    # params: see `Spaceship4Params`
+    grav_field = max(0.0, np.tanh(0.75 * (params[5] - x[0]))) * params[3]
+    f = np.empty(2)
+    f[0] = -params[4] - grav_field + params[0]
+    f[1] = params[2] * np.sin(x[0] * np.pi) + params[1]
+    return f
+
+
+@njit(parallel=True)
+def _p_map_kernel(x, thrust, started_failed, params, max_time):
+    """
+    Integrate each pair independently. There is no terminal ceiling event:
+    pairs crossing the ceiling stay above it, and are caught by the failure
+    check (the ceiling is above the upper bound).
+    """
+    x_next = x.copy()
+    for idx in prange(x.shape[0]):
+        if started_failed[idx]:
+            continue
+        pair_params = params.copy()
+        pair_params[0] = thrust[idx, 0]
+        pair_params[1] = thrust[idx, 1]
+        x_next[idx] = rk45(_continuous_dynamics, x[idx], 0.0, max_time, pair_params)
+        x_next[idx, 0] = min(x_next[idx, 0], params[5])
+    return x_next
+
+
+def p_map_batch_cuda(state_actions, p, threads_per_block=128):
+    """
+    Same as `p_map_batch`, but integrating one state-action pair per CUDA
+    thread. Requires a CUDA device, check with `numba.cuda.is_available()`.
+    """
+    n_states = p["n_states"]
+    x = np.ascontiguousarray(state_actions[:, :n_states], dtype=float)
+    thrust = np.ascontiguousarray(state_actions[:, n_states:], dtype=float)
+    params = Spaceship4Params.from_dict(
+        p, thrust_vertical=0.0, thrust_horizontal=0.0
+    ).to_array()
+    started_failed = check_failure_batch(x, p)
+    x_next = cuda.to_device(x)
+    blocks_per_grid = (x.shape[0] + threads_per_block - 1) // threads_per_block
+    _p_map_cuda_kernel[blocks_per_grid, threads_per_block](
+        cuda.to_device(thrust),
+        cuda.to_device(started_failed),
+        cuda.to_device(params),
+        1.0 / p["control_frequency"],
+        x_next,
+    )
+    x_next = x_next.copy_to_host()
+    # * integration is always in double precision, but the next states are
+    # * returned in the precision of the grids (e.g. float32)
+    x_next = x_next.astype(np.result_type(state_actions.dtype, np.float32))
+    return x_next, check_failure_batch(x_next, p)
+
+
+@cuda.jit(device=True)
+def _continuous_dynamics_cuda(t, x, params, out):
+    grav_field = max(0.0, math.tanh(0.75 * (params[5] - x[0]))) * params[3]
+    out[0] = -params[4] - grav_field + params[0]
+    out[1] = params[2] * math.sin(x[0] * math.pi) + params[1]
+
+
+_rk45_cuda = make_cuda_rk45(_continuous_dynamics_cuda, 2)
+
+
+@cuda.jit
+def _p_map_cuda_kernel(thrust, started_failed, params, max_time, x):
+    """
+    Integrates the states `x` in place, one pair per thread.
+    """
+    idx = cuda.grid(1)
+    if idx >= x.shape[0] or started_failed[idx]:
+        return
+    pair_params = cuda.local.array(N_PARAMS, float64)
+    for k in range(N_PARAMS):
+        pair_params[k] = params[k]
+    pair_params[0] = thrust[idx, 0]
+    pair_params[1] = thrust[idx, 1]
+    y = cuda.local.array(2, float64)
+    y[0] = x[idx, 0]
+    y[1] = x[idx, 1]
+    _rk45_cuda(y, max_time, pair_params)
+    x[idx, 0] = min(y[0], params[5])
+    x[idx, 1] = y[1]
+
+
+def check_failure_batch(x, p):
+    """
+    Check which rows of an (N, 2) array of states are in the failure set.
+    """
+    return (
+        (x[:, 0] >= p["x0_upper_bound"])
+        | (x[:, 0] < p["x0_lower_bound"])
+        | (x[:, 1] > p["x1_upper_bound"])
+        | (x[:, 1] < p["x1_lower_bound"])
+    )
+
+
 def check_failure(x, p):
     """
     Check if a state is in the failure set.
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from models import _actuator as actuator
+
+
+@pytest.mark.parametrize("delay", [0.0, 0.13, -0.4])
+def test_interp_force_matches_np_interp(delay):
+    rng = np.random.default_rng(0)
+    times = np.sort(rng.uniform(0, 0.8, 15))
+    forces = rng.uniform(0, 500, 15)
+    p = {
+        "actuator_force": np.array([times, forces]),
+        "actuator_force_period": 0.8,
+        "activation_delay": delay,
+    }
+    table = actuator.force_table(p)
+
+    for t in rng.uniform(-1, 3, 200):
+        expected = np.interp(t, times + delay, forces, period=0.8)
+        assert actuator.interp_force(t, table, 0.8) == expected
+
+
+def test_interp_force_without_actuator_force():
+    table = actuator.force_table({"actuator_force": []})
+
+    assert table.shape == (3, 0)
+    assert actuator.interp_force(0.3, table, 1.0) == 0.0
@@ -0,0 +1,93 @@
+import numpy as np
+
+from models import daslip
+
+
+def _build_default_params():
+    params = {
+        "mass": 80.0,
+        "stiffness": 8200.0,
+        "resting_length": 0.9,
+        "gravity": 9.81,
+        "angle_of_attack": 1 / 5 * np.pi,
+        "actuator_resting_length": 0.1,
+        "actuator_force_period": 1.0,
+        "activation_delay": 0.1,
+        "activation_amplification": 1.0,
+        "constant_normalized_damping": 0.75,
+        "linear_normalized_damping": 3.5,
+        "linear_minimum_normalized_damping": 0.05,
+        "swing_velocity": 0.0,
+        "angle_of_attack_offset": 0.0,
+        "swing_extension_velocity": 0.0,
+        "swing_leg_length_offset": 0.0,
+    }
+    times = np.linspace(0, 1, 21)
+    params["actuator_force"] = np.array([times, 500 * np.sin(np.pi * times) ** 2])
+    x0 = np.array([0, 1.0, 5.5, 0, 0, 0, 0.1, 0, 0, 0], dtype=float)
+    params["x0"] = daslip.reset_leg(x0, params)
+    return params
+
+
+def test_poincare_map_matches_step():
+    params = _build_default_params()
+    columns, param_tuple = [], []
+    for height, velocity, aoa in [(1.0, 5.5, 0.6), (0.9, 3.0, 0.4), (1.2, 4.0, 1.0)]:
+        p = dict(params, angle_of_attack=aoa)
+        x = params["x0"].copy()
+        x[1], x[2] = height, velocity
+        columns.append(daslip.reset_leg(x, p))
+        param_tuple.append(p)
+    x = np.array(columns).T
+
+    x_next, failed = daslip.poincare_map(x, tuple(param_tuple))
+
+    for idx, p in enumerate(param_tuple):
+        if daslip.feasible(x[:, idx], p):
+            x_ref = daslip.step(x[:, idx].copy(), p).y[:, -1]
+            failed_ref = daslip.check_failure(x_ref)
+        else:  # the foot starts underground
+            x_ref, failed_ref = x[:, idx], True
+        np.testing.assert_allclose(x_next[:, idx], x_ref, atol=1e-10)
+        assert failed[idx] == failed_ref
+        x_single, failed_single = daslip.poincare_map(x[:, idx].copy(), p)
+        np.testing.assert_array_equal(x_single, x_ref)
+        assert failed_single == failed_ref
+
+
+def test_sa2xp_leaves_default_state_unchanged():
+    params = _build_default_params()
+    x0 = params["x0"].copy()
+
+    x, p = daslip.sa2xp_y_xdot_timedaoa(np.array([1.2, 4.0, 0.5]), params)
+
+    np.testing.assert_array_equal(params["x0"], x0)
+    assert x is not params["x0"]
+    assert (x[1], x[2]) == (1.2, 4.0)
+    assert p["angle_of_attack"] == 0.5
+
+
+def test_poincare_map_batch_returns_grid_precision():
+    params = _build_default_params()
+    x = np.tile(params["x0"], (2, 1)).T
+
+    x_next, failed = daslip.poincare_map_batch(x, (params, params))
+    x_next32, failed32 = daslip.poincare_map_batch(x, (params, params), np.float32)
+
+    assert x_next.dtype == np.float64 and x_next32.dtype == np.float32
+    np.testing.assert_array_equal(x_next32, x_next.astype(np.float32))
+    np.testing.assert_array_equal(failed32, failed)
+
+
+def test_poincare_map_skips_infeasible_columns():
+    params = dict(_build_default_params(), ode_solver="DOP853")
+    x = np.tile(params["x0"], (2, 1)).T
+    x[5, 1] = -0.1  # the foot starts underground
+
+    x_next, failed = daslip.poincare_map(x, (params, params))
+
+    x_ref = daslip.step(x[:, 0].copy(), params).y[:, -1]
+    np.testing.assert_array_equal(x_next[:, 0], x_ref)
+    assert failed[0] == daslip.check_failure(x_ref)
+    np.testing.assert_array_equal(x_next[:, 1], x[:, 1])
+    assert failed[1]
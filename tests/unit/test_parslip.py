@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+
+from models import parslip
+
+
+def _build_default_params():
+    params = {
+        "mass": 80.0,
+        "stiffness": 8200.0,
+        "resting_length": 0.9,
+        "gravity": 9.81,
+        "angle_of_attack": 1 / 5 * np.pi,
+        "actuator_resting_length": 0.1,
+        "actuator_force_period": 1.0,
+        "activation_delay": 0.1,
+        "activation_amplification": 1.0,
+        "damping": 0.1,
+    }
+    times = np.linspace(0, 1, 21)
+    params["actuator_force"] = np.array([times, 500 * np.sin(np.pi * times) ** 2])
+    x0 = np.array([0, 1.0, 5.5, 0, 0, 0, 0], dtype=float)
+    params["x0"] = parslip.reset_leg(x0, params)
+    return params
+
+
+def test_poincare_map_matches_step():
+    params = _build_default_params()
+    states = [(1.0, 5.5, 0.6), (0.9, 3.0, 0.4), (1.2, 4.0, 1.0)]
+    param_tuple = tuple(dict(params, angle_of_attack=aoa) for _, _, aoa in states)
+    x = np.tile(params["x0"], (len(states), 1)).T
+    x[1:3] = np.array(states)[:, :2].T
+    x = parslip.reset_leg_batch(x, param_tuple)
+
+    x_next, failed = parslip.poincare_map(x, param_tuple)
+
+    for idx, p in enumerate(param_tuple):
+        if parslip.feasible(x[:, idx], p):
+            x_ref = parslip.step(x[:, idx].copy(), p).y[:, -1]
+            failed_ref = parslip.check_failure(x_ref)
+        else:  # the foot starts underground
+            x_ref, failed_ref = x[:, idx], True
+        np.testing.assert_allclose(x_next[:, idx], x_ref, atol=1e-10)
+        assert failed[idx] == failed_ref
+        x_single, failed_single = parslip.poincare_map(x[:, idx].copy(), p)
+        np.testing.assert_array_equal(x_single, x_ref)
+        assert failed_single == failed_ref
+        np.testing.assert_array_equal(x[:, idx], parslip.reset_leg(x[:, idx].copy(), p))
+
+
+def test_stance_jacobian_matches_finite_differences():
+    params = _build_default_params()
+    rows, tables = parslip._pack_params((params,))
+    args = parslip._stance_args(rows[0], tables)
+    x = np.array([0.1, 0.85, 4.0, -1.0, 0.4, 0.0, 0.0])
+    jac = parslip._packed_stance_jacobian(0.3, x, args)
+
+    jac_fd = np.empty((7, 7))
+    for k, dx in enumerate(1e-6 * np.eye(7)):
+        f_plus = parslip._packed_stance_dynamics(0.3, x + dx, args)
+        f_minus = parslip._packed_stance_dynamics(0.3, x - dx, args)
+        jac_fd[:, k] = (f_plus - f_minus) / 2e-6
+    np.testing.assert_allclose(jac, jac_fd, rtol=1e-6, atol=1e-4)
+
+
+@pytest.mark.parametrize("solver", ["DOP853", "LSODA"])
+def test_stance_solver_matches_default(solver):
+    params = _build_default_params()
+    expected = parslip.step(params["x0"].copy(), params)
+
+    sol = parslip.step(params["x0"].copy(), dict(params, stance_solver=solver))
+    np.testing.assert_allclose(sol.y[:, -1], expected.y[:, -1], atol=1e-3)
+
+    with pytest.raises(ValueError):
+        parslip.step(params["x0"].copy(), dict(params, stance_solver="Euler"))
+
+
+def test_total_energy_of_trajectory_matches_states():
+    params = _build_default_params()
+    sol = parslip.step(params["x0"].copy(), params)
+
+    energy = parslip.compute_total_energy(sol.y, params)
+
+    assert energy.shape == sol.t.shape
+    for idx in [0, sol.t.size // 2, -1]:
+        assert energy[idx] == parslip.compute_total_energy(sol.y[:, idx], params)
+
+
+def test_p_map_batch_matches_pairs():
+    params = _build_default_params()
+    state_actions = np.array([[1.0, 5.5, 0.6], [0.9, 3.0, 0.4], [1.1, 4.0, 0.7]])
+
+    s_next, failed = parslip.p_map_batch(state_actions, params)
+
+    assert s_next.shape == (3, 2)
+    for idx, state_action in enumerate(state_actions):
+        x, p = parslip.sa2xp_y_xdot_timedaoa(state_action, params)
+        x_next, failed_pair = parslip.poincare_map(x, p)
+        # * the pairs run `step`, the batch the compiled phases
+        np.testing.assert_allclose(
+            s_next[idx], parslip.xp2s_y_xdot(x_next, p), atol=1e-10
+        )
+        assert failed[idx] == failed_pair
+
+
+def test_sa2xp_leaves_default_state_unchanged():
+    params = _build_default_params()
+    x0 = params["x0"].copy()
+    state_actions = np.array([[1.0, 5.5, 0.6], [0.9, 3.0, 0.4]])
+
+    parslip.p_map_batch(state_actions, params)
+    parslip.sa2xp_y_xdot_aoa(state_actions[0], params)
+    parslip.sa2xp_amp(np.append(state_actions[0], 1.0), params)
+    parslip.mapSA2xp_energy_normalizedheight_aoa(np.array([900.0, 0.5, 0.6]), params)
+
+    np.testing.assert_array_equal(params["x0"], x0)
+    assert params["angle_of_attack"] == _build_default_params()["angle_of_attack"]
+
+
+def test_poincare_map_skips_infeasible_columns():
+    params = dict(_build_default_params(), stance_solver="DOP853")
+    x = np.tile(params["x0"], (2, 1)).T
+    x[5, 1] = -0.1  # the foot starts underground
+
+    x_next, failed = parslip.poincare_map(x, (params, params))
+
+    x_ref = parslip.step(x[:, 0].copy(), params).y[:, -1]
+    np.testing.assert_array_equal(x_next[:, 0], x_ref)
+    assert failed[0] == parslip.check_failure(x_ref)
+    np.testing.assert_array_equal(x_next[:, 1], x[:, 1])
+    assert failed[1]
+
+
+def test_check_failure_batch_matches_check_failure():
+    x = np.tile(_build_default_params()["x0"], (5, 1)).T
+    x[1, 1:3] = [0.0, 5e-9]  # fallen
+    x[2, 3] = -0.1  # reversed
+
+    failed = parslip.check_failure_batch(x)
+
+    assert failed.tolist() == [parslip.check_failure(x[:, idx]) for idx in range(5)]
+    assert failed.tolist() == [False, True, True, True, False]
+
+
+def test_poincare_map_batch_returns_grid_precision():
+    params = _build_default_params()
+    x = np.tile(params["x0"], (2, 1)).T
+
+    x_next, failed = parslip.poincare_map_batch(x, (params, params))
+    x_next32, failed32 = parslip.poincare_map_batch(x, (params, params), np.float32)
+
+    assert x_next.dtype == np.float64 and x_next32.dtype == np.float32
+    np.testing.assert_array_equal(x_next32, x_next.astype(np.float32))
+    np.testing.assert_array_equal(failed32, failed)
+
+
+def test_pack_params_shares_actuator_force_tables():
+    params = _build_default_params()
+    param_tuple = tuple(dict(params, activation_delay=d) for d in [0.0, 0.1, 0.35])
+    other = dict(params, actuator_force=params["actuator_force"].copy())
+
+    rows, tables = parslip._pack_params(param_tuple + (other,))
+
+    assert tables.shape[0] == 2
+    x = np.array([0.1, 0.85, 4.0, -1.0, 0.4, 0.0, 0.0])
+    for t in np.linspace(0, 2, 9):
+        for row, p in zip(rows, param_tuple + (other,)):
+            expected = parslip._stance_dynamics(
+                t, x, row, parslip.actuator.force_table(p), p["actuator_force_period"]
+            )
+            f = parslip._packed_stance_dynamics(t, x, parslip._stance_args(row, tables))
+            np.testing.assert_allclose(f, expected, rtol=1e-12, atol=1e-12)
+
+
+def test_spring_velocity_is_leg_compression_rate():
+    params = _build_default_params()
+    x = np.array([0.1, 0.85, 4.0, -1.0, 0.4, 0.0, 0.0])
+    dt = 1e-7
+    x_next = x.copy()
+    x_next[:2] += dt * x[2:4]  # the foot stays put during stance
+
+    compression_rate = (
+        parslip.compute_spring_length(x, params)
+        - parslip.compute_spring_length(x_next, params)
+    ) / dt
+
+    np.testing.assert_allclose(
+        parslip.compute_spring_velocity(x, params), compression_rate, rtol=1e-6
+    )
+    trajectory = np.tile(x, (3, 1)).T
+    np.testing.assert_array_equal(
+        parslip.compute_spring_velocity(trajectory, params),
+        np.full(3, parslip.compute_spring_velocity(x, params)),
+    )
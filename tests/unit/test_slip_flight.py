@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 
 from models import slip
 
@@ -35,3 +36,49 @@ def test_step_analytic_matches_numeric_flight():
             atol=1e-9,
             err_msg=f"event index {idx} diverged",
         )
+
+
+def test_jax_p_map_matches_p_map():
+    pytest.importorskip("jax")
+    from models import slip_jax
+
+    x0, params = _build_default_params()
+    state_actions = np.array(
+        [[0.3, 0.2], [0.5, 0.5], [0.8, 0.6], [0.9, -0.1], [0.2, 1.2]], dtype=float
+    )
+    s_next, failed = slip_jax.p_map_batch(state_actions, params)
+
+    for idx, state_action in enumerate(state_actions):
+        x, p = slip.sa2xp(state_action, params)
+        x_next, expected_failed = slip.p_map(x, p)
+        assert failed[idx] == expected_failed
+        if not expected_failed:
+            np.testing.assert_allclose(s_next[idx, 0], slip.xp2s(x_next, p), atol=1e-4)
+
+
+def test_slip_params_from_dict():
+    _, params = _build_default_params()
+    slip_params = slip.SlipParams.from_dict(params, stiffness=1.0)
+
+    assert slip_params.mass == params["mass"]
+    assert slip_params.stiffness == 1.0
+    np.testing.assert_array_equal(
+        slip_params.to_array(),
+        [9.81, 80.0, 1.0, 1.0, 0.0, params["total_energy"]],
+    )
+    with pytest.raises(KeyError):
+        slip.SlipParams.from_dict({"mass": 80.0})
+
+
+@pytest.mark.parametrize("solver", ["DOP853", "LSODA"])
+def test_stance_solver_matches_default(solver):
+    x0, params = _build_default_params()
+    expected = slip.step(x0, params)
+
+    params["stance_solver"] = solver
+    sol = slip.step(x0, params)
+    np.testing.assert_allclose(sol.y[:, -1], expected.y[:, -1], atol=1e-5)
+
+    params["stance_solver"] = "Euler"
+    with pytest.raises(ValueError):
+        slip.step(x0, params)
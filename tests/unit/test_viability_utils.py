@@ -1,4 +1,10 @@
+import pathlib
+import pickle
+import subprocess
+import sys
+
 import numpy as np
+import pytest
 
 from viability import viability as vibly
 
@@ -17,6 +23,55 @@ def test_digitize_s_handles_bins_and_coordinates():
     assert tuple(coord_indices) == (1, 1)
 
 
+@pytest.mark.parametrize("to_bin", [True, False])
+def test_digitize_s_batch_matches_numpy(to_bin):
+    s_grid = (np.linspace(0.0, 1.0, 5), np.array([1.0, 0.5, -1.0]))
+    if not to_bin:  # only monotonic grids can be binned
+        s_grid += (np.array([0.0, 1.0, 0.25, 0.75]),)
+    rng = np.random.default_rng(0)
+    S = rng.uniform(-1.5, 1.5, (50, len(s_grid)))
+    S[:5, 0] = s_grid[0][:5]  # on the grid
+    S[5:9, 0] = [0.125, 0.375, -0.0, 1.0 + 1e-12]  # ties and edges
+    S[:3, 1] = s_grid[1]  # on the decreasing grid
+    if not to_bin:
+        S[3:7, 2] = s_grid[2]
+
+    def expected_index(value, grid):
+        if to_bin:
+            return np.digitize(value, grid)
+        return np.argmin(np.abs(grid - value))
+
+    expected = np.array(
+        [[expected_index(s[dim], grid) for dim, grid in enumerate(s_grid)] for s in S]
+    )
+    assert np.array_equal(vibly.digitize_s_batch(S, s_grid, to_bin=to_bin), expected)
+    for s, expected_s in zip(S, expected):
+        assert np.array_equal(vibly.digitize_s(s, s_grid, to_bin=to_bin), expected_s)
+
+    shape = tuple(grid.size + to_bin for grid in s_grid)
+    assert np.array_equal(
+        vibly.digitize_s_batch(S, s_grid, shape=shape, to_bin=to_bin),
+        np.ravel_multi_index(tuple(expected.T), shape),
+    )
+
+
+def test_digitize_s_rejects_non_monotonic_bins():
+    s_grid = (np.array([0.0, 1.0, 0.5]),)
+    with pytest.raises(ValueError):
+        vibly.digitize_s(np.array([0.2]), s_grid)
+
+
+def test_match_grid_rows_finds_exact_grid_points():
+    s_grid = (np.linspace(0.0, 1.0, 5), np.array([1.0, -1.0, 0.5, -1.0]))
+    S = np.array([[0.25, -1.0], [0.3, 0.5], [1.0, 0.0], [-0.0, 1.0], [np.nan, 0.5]])
+
+    grid_idx = vibly._match_grid_rows(S, *vibly._pack_grids(s_grid))
+
+    assert grid_idx.tolist() == [[1, 1], [-1, 2], [4, -1], [0, 0], [-1, 2]]
+    for dim_idx, grid in enumerate(s_grid):
+        assert np.array_equal(grid_idx[:, dim_idx] >= 0, np.isin(S[:, dim_idx], grid))
+
+
 def test_get_grid_indices_returns_enclosing_vertices():
     s_grid = (np.arange(3), np.arange(4))
 
@@ -91,6 +146,59 @@ def test_compute_Q_map_and_compute_QV_simple_system():
     assert np.allclose(q_m, expected_q_m)
 
 
+class DummyBatchMap(DummyMap):
+    def batch(self, state_actions, params):
+        next_states = state_actions[:, 0] + state_actions[:, 1]
+        failed = (next_states < 0.0) | (next_states > 2.0)
+        return next_states.reshape(-1, 1), failed
+
+
+def test_compute_Q_map_batched_matches_pointwise():
+    grids = {
+        "states": (np.array([0.0, 0.5, 1.0, 2.0]),),
+        "actions": (np.array([-1.0, 0.25, 1.0]),),
+    }
+    p_map = DummyBatchMap()
+
+    reference = vibly.compute_Q_map(grids, p_map, check_grid=True, parallel=False)
+    batched = vibly.compute_Q_map(grids, p_map, check_grid=True, batched=True)
+
+    assert np.array_equal(batched.q_map, reference.q_map)
+    assert np.array_equal(batched.q_fail, reference.q_fail)
+    assert np.array_equal(batched.q_on_grid, reference.q_on_grid)
+
+
+def test_get_feasibility_mask_batched_matches_pointwise():
+    grids = {
+        "states": (np.array([0.0, 0.5, 1.0, 2.0]),),
+        "actions": (np.array([-1.0, 0.25, 1.0]),),
+    }
+    p_map = DummyMap()
+
+    def feasible(x, params):
+        return x[0] + x[1] >= 0.5
+
+    def feasible_batch(state_actions, params):
+        return state_actions.sum(axis=1) >= 0.5
+
+    reference = vibly.get_feasibility_mask(feasible, p_map.sa2xp, grids, None, {})
+    feasible.batch = feasible_batch
+    batched = vibly.get_feasibility_mask(feasible, p_map.sa2xp, grids, None, {})
+
+    assert batched.shape == (4, 3)
+    assert np.array_equal(batched, reference)
+    assert 0 < reference.sum() < reference.size
+
+
+def test_compute_Q_map_batched_requires_batch_map():
+    grids = {
+        "states": (np.array([0.0, 1.0]),),
+        "actions": (np.array([0.0]),),
+    }
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(grids, DummyMap(), batched=True)
+
+
 def test_compute_Q_map_with_check_grid_reports_on_grid_hits():
     grids = {
         "states": (np.array([0.0, 1.0, 2.0]),),
@@ -188,3 +296,350 @@ def test_map_S2Q_uses_on_grid_lookup():
         neighbors = vibly.get_grid_indices(s_idx, grids["states"])
         expected = np.mean([state_measure[n] for n in neighbors])
         assert np.isclose(q_m[idx], expected)
+
+
+def _map_S2Q_reference(Q_map, S_M, s_grid, Q_V, Q_on_grid):
+    # the original per-pair loop of map_S2Q
+    Q_M = np.zeros(Q_map.shape)
+    for qdx, is_viable in np.ndenumerate(Q_V):
+        if is_viable:
+            if Q_on_grid[qdx]:
+                sdx = np.unravel_index(Q_map[qdx], S_M.shape)
+            else:
+                sdx = np.unravel_index(Q_map[qdx], [x + 1 for x in S_M.shape])
+            edge_indices = vibly.get_grid_indices(sdx, s_grid)
+            measure = 0
+            if len(edge_indices) > 0:
+                for idx in edge_indices:
+                    measure += S_M[idx]
+                measure /= len(edge_indices)
+            Q_M[qdx] = measure
+    return Q_M
+
+
+def test_map_S2Q_matches_reference_loop():
+    rng = np.random.default_rng(0)
+    s_grid = (np.linspace(0.0, 1.0, 4), np.linspace(0.0, 1.0, 5))
+    q_shape = (4, 5, 3)
+    S_M = rng.random((4, 5))
+    Q_on_grid = rng.random(q_shape) < 0.3
+    Q_map = rng.integers(0, 5 * 6, size=q_shape)
+    Q_map[Q_on_grid] = rng.integers(0, 4 * 5, size=np.sum(Q_on_grid))
+    Q_V = rng.random(q_shape) < 0.7
+
+    q_m = vibly.map_S2Q(Q_map, S_M, s_grid, Q_V=Q_V, Q_on_grid=Q_on_grid)
+    expected = _map_S2Q_reference(Q_map, S_M, s_grid, Q_V, Q_on_grid)
+    assert np.array_equal(q_m, expected)
+
+
+def test_bitset_roundtrip_and_compute_QV():
+    grids = {
+        "states": (np.array([0.0, 1.0, 2.0]),),
+        "actions": (np.array([-1.0, 1.0]),),
+    }
+    result = vibly.compute_Q_map(grids, DummyMap(), parallel=False)
+    assert result.q_map.dtype == np.int32
+
+    q_fail = vibly.BitSet.from_array(result.q_fail)
+    assert np.array_equal(q_fail.to_array(), result.q_fail)
+    assert q_fail.get(0, 0) and q_fail.get(5)
+    assert (~q_fail).count() == np.sum(~result.q_fail)
+
+    q_fail.set(1, 0)
+    assert q_fail.get(1, 0)
+    q_fail.set(1, 0, value=False)
+    assert not q_fail.get(1, 0)
+
+    q_v, s_v = vibly.compute_QV(result.q_map, grids, ~q_fail)
+    expected_q_v, expected_s_v = vibly.compute_QV(result.q_map, grids, ~result.q_fail)
+    assert np.array_equal(q_v, expected_q_v)
+    assert np.array_equal(s_v, expected_s_v)
+
+
+@pytest.mark.parametrize("check_grid", [False, True])
+def test_compute_viability_measures_matches_separate_passes(check_grid):
+    grids = {
+        "states": (np.linspace(0.0, 2.0, 5),),
+        "actions": (np.array([-1.0, -0.25, 0.0, 0.5, 1.0]),),
+    }
+    result = vibly.compute_Q_map(
+        grids, DummyMap(), check_grid=check_grid, parallel=False
+    )
+    q_map, q_fail, q_on_grid = result.q_map, result.q_fail, result.q_on_grid
+
+    q_v, s_v = vibly.compute_QV(q_map, grids, Q_V=~q_fail, Q_on_grid=q_on_grid)
+    s_m = vibly.project_Q2S(q_v, grids, proj_opt=np.mean)
+    q_m = vibly.map_S2Q(q_map, s_m, grids["states"], Q_V=q_v, Q_on_grid=q_on_grid)
+
+    fused = vibly.compute_viability_measures(q_map, q_fail, grids, Q_on_grid=q_on_grid)
+    for actual, expected in zip(fused, (q_v, s_v, s_m, q_m)):
+        assert np.array_equal(actual, expected)
+
+
+def test_compute_Q_map_uses_precomputed_state_actions():
+    grids = {
+        "states": (np.array([0.0, 1.0, 2.0]),),
+        "actions": (np.array([-1.0, 1.0]),),
+    }
+    expected = vibly.compute_Q_map(grids, DummyMap(), parallel=False)
+
+    grids["sa_flat"] = vibly.get_state_actions(grids)
+    assert grids["sa_flat"].shape == (6, 2)
+    assert grids["sa_flat"].flags.c_contiguous
+    result = vibly.compute_Q_map(grids, DummyMap(), parallel=False)
+    assert np.array_equal(result.q_map, expected.q_map)
+    assert np.array_equal(result.q_fail, expected.q_fail)
+
+    sa_flat = grids["sa_flat"]
+    grids["sa_flat"] = sa_flat[:-1]
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(grids, DummyMap(), parallel=False)
+
+    # * stale: computed for other grids of the same size
+    grids["sa_flat"] = sa_flat + 0.5
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(grids, DummyMap(), parallel=False)
+    grids["sa_flat"] = sa_flat[::-1]
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(grids, DummyMap(), parallel=False)
+
+
+def test_project_Q2S_mean_of_boolean_matches_np_mean():
+    grids = {
+        "states": (np.arange(4), np.arange(3)),
+        "actions": (np.arange(5), np.arange(2)),
+    }
+    q_values = np.random.default_rng(0).random((4, 3, 5, 2)) < 0.5
+
+    projection = vibly.project_Q2S(q_values, grids, proj_opt=np.mean)
+    assert projection.dtype == np.float64
+    assert np.array_equal(projection, np.mean(q_values, axis=(2, 3)))
+
+
+def test_compute_Q_map_index_dtype():
+    grids = {
+        "states": (np.array([0.0, 1.0, 2.0]),),
+        "actions": (np.array([-1.0, 1.0]),),
+    }
+    expected = vibly.compute_Q_map(grids, DummyMap(), parallel=False)
+    result = vibly.compute_Q_map(
+        grids, DummyMap(), parallel=False, index_dtype=np.int16
+    )
+    assert result.q_map.dtype == np.int16
+    assert np.array_equal(result.q_map, expected.q_map)
+
+    grids["states"] = (np.linspace(0.0, 2.0, 200),)
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(grids, DummyMap(), parallel=False, index_dtype=np.int8)
+
+
+def test_compute_Q_map_into_preallocated_outputs():
+    grids = {
+        "states": (np.array([0.0, 1.0, 2.0]),),
+        "actions": (np.array([-1.0, 1.0]),),
+    }
+    expected = vibly.compute_Q_map(grids, DummyMap(), parallel=False, check_grid=True)
+
+    Q_map = np.full((3, 2), 7, dtype=np.int16)
+    Q_F = np.ones((3, 2), dtype=bool)
+    Q_on_grid = np.zeros((3, 2), dtype=bool)
+    for _ in range(2):
+        result = vibly.compute_Q_map(
+            grids,
+            DummyMap(),
+            parallel=False,
+            check_grid=True,
+            out=Q_map,
+            out_F=Q_F,
+            out_on_grid=Q_on_grid,
+        )
+        assert np.shares_memory(result.q_map, Q_map)
+        assert np.array_equal(Q_map, expected.q_map)
+        assert np.array_equal(Q_F, expected.q_fail)
+        assert np.array_equal(Q_on_grid, expected.q_on_grid)
+
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(
+            grids, DummyMap(), parallel=False, out=np.zeros((2, 3), dtype=np.int16)
+        )
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(
+            grids, DummyMap(), parallel=False, out=Q_map, index_dtype=np.int32
+        )
+
+
+def test_compute_Q_map_parallel_reuses_workers():
+    from viability import parallel
+
+    grids = {
+        "states": (np.linspace(0.0, 2.0, 5),),
+        "actions": (np.array([-1.0, 0.0, 1.0]),),
+    }
+    p_map = DummyMap()
+    expected = vibly.compute_Q_map(grids, p_map, parallel=False, keep_coords=True)
+    try:
+        result = vibly.compute_Q_map(grids, p_map, parallel=True, keep_coords=True)
+        executor = parallel.get_executor(p_map)
+        vibly.compute_Q_map(grids, p_map, parallel=True)
+        assert parallel.get_executor(p_map) is executor
+    finally:
+        parallel.shutdown()
+    assert np.array_equal(result.q_map, expected.q_map)
+    assert np.array_equal(result.q_fail, expected.q_fail)
+    assert np.array_equal(result.q_reached, expected.q_reached)
+
+
+def stepping_map(x, params):
+    next_state = x[0] + x[1]
+    return np.array([next_state, x[1]]), not 0.0 <= next_state <= 2.0
+
+
+def test_compute_Q_map_parallel_with_unpicklable_helpers():
+    from viability import parallel
+
+    grids = {
+        "states": (np.linspace(0.0, 2.0, 5),),
+        "actions": (np.array([-1.0, 0.0, 1.0]),),
+    }
+    stepping_map.p = {}
+    stepping_map.sa2xp = lambda state_action, params: (np.array(state_action), params)
+    stepping_map.xp2s = lambda x_next, params: x_next[:1]
+    expected = vibly.compute_Q_map(grids, DummyMap(), parallel=False, keep_coords=True)
+    try:
+        result = vibly.compute_Q_map(
+            grids, stepping_map, parallel=True, keep_coords=True
+        )
+    finally:
+        parallel.shutdown()
+    assert np.array_equal(result.q_map, expected.q_map)
+    assert np.array_equal(result.q_fail, expected.q_fail)
+    assert np.array_equal(result.q_reached, expected.q_reached)
+
+
+INTERACTIVE_SCRIPT = """
+import numpy as np
+from viability import parallel, viability as vibly
+
+
+class StepMap:
+    def __init__(self):
+        self.p = {}
+
+    def sa2xp(self, state_action, params):
+        return np.array(state_action), params
+
+    def xp2s(self, x_next, params):
+        return x_next[:1]
+
+    def __call__(self, x, params):
+        next_state = x[0] + x[1]
+        return np.array([next_state, x[1]]), not 0.0 <= next_state <= 2.0
+
+
+grids = {
+    "states": (np.linspace(0.0, 2.0, 5),),
+    "actions": (np.array([-1.0, 0.0, 1.0]),),
+}
+expected = vibly.compute_Q_map(grids, StepMap(), parallel=False)
+result = vibly.compute_Q_map(grids, StepMap(), parallel=True)
+parallel.shutdown()
+assert np.array_equal(result.q_map, expected.q_map)
+assert np.array_equal(result.q_fail, expected.q_fail)
+print("ok")
+"""
+
+
+def test_compute_Q_map_parallel_with_interactive_map():
+    # * a map defined in a `__main__` without a file, as in a notebook
+    root = pathlib.Path(__file__).resolve().parents[2]
+    completed = subprocess.run(
+        [sys.executable, "-"],
+        input=INTERACTIVE_SCRIPT,
+        capture_output=True,
+        text=True,
+        cwd=root,
+        timeout=600,
+    )
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.strip() == "ok"
+
+
+class CountingMap(DummyMap):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def __call__(self, x, params):
+        self.calls += 1
+        return super().__call__(x, params)
+
+
+def test_compute_Q_map_resume_from_previous_result(tmp_path):
+    coarse = {
+        "states": (np.linspace(0.0, 2.0, 3),),
+        "actions": (np.array([-1.0, 1.0]),),
+    }
+    previous = vibly.compute_Q_map(coarse, DummyMap(), parallel=False, keep_coords=True)
+    saved = {"grids": coarse, "Q_F": previous.q_fail, "Q_reached": previous.q_reached}
+
+    refined = {
+        "states": (np.linspace(0.0, 2.0, 5),),
+        "actions": (np.array([-1.0, 0.0, 1.0]),),
+    }
+    expected = vibly.compute_Q_map(refined, DummyMap(), parallel=False)
+
+    p_map = CountingMap()
+    result = vibly.compute_Q_map(refined, p_map, parallel=False, resume_from=saved)
+    assert p_map.calls == 15 - 6
+    assert np.array_equal(result.q_map, expected.q_map)
+    assert np.array_equal(result.q_fail, expected.q_fail)
+
+    path = tmp_path / "previous.pickle"
+    with open(path, "wb") as outfile:
+        pickle.dump(saved, outfile)
+    p_map = CountingMap()
+    result = vibly.compute_Q_map(refined, p_map, parallel=False, resume_from=path)
+    assert p_map.calls == 9
+    assert np.array_equal(result.q_map, expected.q_map)
+
+    # * resuming on the same grids evaluates nothing
+    p_map = CountingMap()
+    result = vibly.compute_Q_map(coarse, p_map, parallel=False, resume_from=saved)
+    assert p_map.calls == 0
+    assert np.array_equal(result.q_map, previous.q_map)
+
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(
+            refined, p_map, parallel=False, resume_from={"grids": coarse}
+        )
+
+
+def test_compute_Q_map_resume_checks_fingerprint():
+    coarse = {
+        "states": (np.linspace(0.0, 2.0, 3),),
+        "actions": (np.array([-1.0, 1.0]),),
+    }
+    refined = {
+        "states": (np.linspace(0.0, 2.0, 5),),
+        "actions": (np.array([-1.0, 0.0, 1.0]),),
+    }
+    previous = vibly.compute_Q_map(
+        coarse, CountingMap(), parallel=False, keep_coords=True
+    )
+    saved = {
+        "grids": coarse,
+        "Q_F": previous.q_fail,
+        "Q_reached": previous.q_reached,
+        "fingerprint": previous.fingerprint,
+    }
+
+    p_map = CountingMap()
+    vibly.compute_Q_map(refined, p_map, parallel=False, resume_from=saved)
+    assert p_map.calls == 9
+
+    p_map = CountingMap()
+    p_map.p = {"gain": 2.0}
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(refined, p_map, parallel=False, resume_from=saved)
+    with pytest.raises(ValueError):
+        vibly.compute_Q_map(refined, DummyMap(), parallel=False, resume_from=saved)
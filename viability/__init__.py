@@ -1,10 +1,14 @@
 # https://towardsdatascience.com/whats-init-for-me-d70a312da583
 
 from .viability import compute_Q_map
+from .viability import BitSet
 from .viability import project_Q2S
 from .viability import compute_QV
 from .viability import map_S2Q
+from .viability import compute_viability_measures
 from .viability import get_feasibility_mask
 from .viability import get_grid_indices
+from .viability import get_state_actions
 from .viability import is_outside
 from .viability import digitize_s
+from .viability import digitize_s_batch
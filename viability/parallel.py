@@ -0,0 +1,204 @@
+import multiprocessing
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numba
+import numpy as np
+
+"""
+A persistent process pool for evaluating transition maps, used by
+`compute_Q_map(parallel=True)`.
+
+The pool is created on first use and then reused, so repeated calls (e.g.
+sweeping parameters in a notebook) do not pay the process startup again.
+Each worker receives the transition map, its parameters and the helper
+functions once, when it starts. The state-action pairs, next states and
+failures of a call live in shared memory: tasks only carry the range of
+pairs to evaluate, and workers write their results in place. Helpers which
+cannot be pickled (lambdas, local functions) stay in this process instead,
+which then converts the state-action pairs and ships the (x, p) pairs. The
+pool is restarted when the map or its parameters change.
+Workers are forked from this process, so maps defined interactively (in a
+notebook or a script read from stdin) work as before. Once numba's threading
+layer runs (after a parallel kernel was called), forking is no longer safe,
+and workers are started from a fresh server process instead, unless the map
+could only be found in a forked copy of `__main__`.
+"""
+
+_EXECUTOR = None
+_PAYLOAD = None
+_CONTEXT = None
+_WORKER_MAP = None
+
+
+def _threads_running():
+    # * numba starts its threads with the first parallel kernel
+    return numba.np.ufunc.parallel._is_initialized
+
+
+def _get_context():
+    methods = multiprocessing.get_all_start_methods()
+    interactive = not hasattr(sys.modules["__main__"], "__file__")
+    if "fork" in methods and (interactive or not _threads_running()):
+        return multiprocessing.get_context("fork")
+    if "forkserver" in methods:
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _init_worker(payload):
+    global _WORKER_MAP
+    # * the workers already share the cores: one thread each for numba's
+    # * parallel kernels, if the map calls any
+    numba.set_num_threads(1)
+    _WORKER_MAP = pickle.loads(payload)
+
+
+def _shared_arrays(blocks, layout):
+    return [
+        np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        for block, (_, shape, dtype) in zip(blocks, layout)
+    ]
+
+
+def _evaluate_pairs(pairs):
+    p_map = _WORKER_MAP[0]
+    return [p_map(x, params) for x, params in pairs]
+
+
+def _evaluate_chunk(task):
+    layout, start, stop = task
+    p_map, p, sa2xp, xp2s = _WORKER_MAP
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in layout]
+    try:
+        state_actions, s_next, failed = _shared_arrays(blocks, layout)
+        for idx in range(start, stop):
+            x, params = sa2xp(state_actions[idx], p)
+            x_next, failed[idx] = p_map(x, params)
+            s_next[idx] = xp2s(x_next, params)
+        # * the views need to go before the blocks can be closed
+        del state_actions, s_next, failed
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _payload(p_map):
+    # * the attributes are not pickled along with the (module-level) function
+    helpers = (p_map.p, p_map.sa2xp, p_map.xp2s)
+    try:
+        payload = pickle.dumps((p_map,) + helpers, protocol=pickle.HIGHEST_PROTOCOL)
+        return payload, False
+    except (pickle.PicklingError, AttributeError, TypeError):
+        # * e.g. lambdas or local functions: convert the pairs in this process
+        payload = pickle.dumps(
+            (p_map, None, None, None), protocol=pickle.HIGHEST_PROTOCOL
+        )
+        return payload, True
+
+
+def _start(payload, max_workers=None):
+    global _EXECUTOR, _PAYLOAD, _CONTEXT
+    context = _get_context()
+    if _EXECUTOR is not None and payload == _PAYLOAD and context is _CONTEXT:
+        return _EXECUTOR
+    shutdown()
+    _EXECUTOR = ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(payload,),
+    )
+    _PAYLOAD = payload
+    _CONTEXT = context
+    return _EXECUTOR
+
+
+def get_executor(p_map, max_workers=None):
+    """
+    The shared executor, with workers initialized for `p_map` (and its
+    attached `p`, `sa2xp` and `xp2s`, unless these cannot be pickled).
+    """
+    return _start(_payload(p_map)[0], max_workers)
+
+
+def shutdown():
+    """
+    Stop the worker processes of the shared executor, if any.
+    """
+    global _EXECUTOR, _PAYLOAD, _CONTEXT
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown()
+    _EXECUTOR = None
+    _PAYLOAD = None
+    _CONTEXT = None
+
+
+def _chunk_bounds(n_pairs, chunks_per_worker):
+    n_chunks = min(n_pairs, (os.cpu_count() or 1) * chunks_per_worker)
+    bounds = np.linspace(0, n_pairs, n_chunks + 1).astype(int).tolist()
+    return list(zip(bounds, bounds[1:]))
+
+
+def _evaluate_in_parent(executor, p_map, state_actions, n_states, progress, bounds):
+    # * only the (x, params) pairs and the results of `p_map` are shipped
+    converted = [p_map.sa2xp(state_action, p_map.p) for state_action in state_actions]
+    s_next = np.zeros((len(state_actions), n_states))
+    failed = np.zeros(len(state_actions), dtype=bool)
+    chunks = [converted[start:stop] for start, stop in bounds]
+    for (start, stop), results in zip(bounds, executor.map(_evaluate_pairs, chunks)):
+        for idx, (x_next, failed[idx]) in enumerate(results, start):
+            s_next[idx] = p_map.xp2s(x_next, converted[idx][1])
+        if progress is not None:
+            progress(start, stop)
+    return s_next, failed
+
+
+def evaluate(p_map, state_actions, n_states, progress=None, chunks_per_worker=4):
+    """
+    Evaluate `p_map` on an (N, n_states + n_actions) array of state-action
+    pairs in the shared executor.
+    progress: called with the (start, stop) range of each finished chunk
+    returns the next states (N, n_states) and failures (N,)
+    """
+    payload, convert_in_parent = _payload(p_map)
+    executor = _start(payload)
+    state_actions = np.asarray(state_actions)
+    n_pairs = len(state_actions)
+    bounds = _chunk_bounds(n_pairs, chunks_per_worker)
+    if convert_in_parent:
+        return _evaluate_in_parent(
+            executor, p_map, state_actions, n_states, progress, bounds
+        )
+    shapes_dtypes = [
+        (state_actions.shape, state_actions.dtype),
+        ((n_pairs, n_states), np.dtype(float)),
+        ((n_pairs,), np.dtype(bool)),
+    ]
+    blocks = [
+        shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1)
+        )
+        for shape, dtype in shapes_dtypes
+    ]
+    try:
+        layout = tuple(
+            (block.name, shape, dtype.str)
+            for block, (shape, dtype) in zip(blocks, shapes_dtypes)
+        )
+        shared = _shared_arrays(blocks, layout)
+        shared[0][:] = state_actions
+        tasks = [(layout, start, stop) for start, stop in bounds]
+        for (_, start, stop), _ in zip(tasks, executor.map(_evaluate_chunk, tasks)):
+            if progress is not None:
+                progress(start, stop)
+        s_next, failed = shared[1].copy(), shared[2].copy()
+        del shared
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return s_next, failed
@@ -1,9 +1,15 @@
+import hashlib
 import itertools as it
-import multiprocessing as mp
+import math
+import os
+import pickle
 from dataclasses import dataclass
-from typing import Iterable, Iterator, Optional, Sequence, Tuple
+from typing import Iterator, Optional, Sequence
 
 import numpy as np
+from numba import njit, prange
+
+from . import parallel as parallel_map
 
 """
 Tools for computing the viable set (in state-action space) and viability kernel (in
@@ -17,6 +23,60 @@ class TransitionResult:
     q_fail: np.ndarray
     q_on_grid: Optional[np.ndarray] = None
     q_reached: Optional[np.ndarray] = None
+    fingerprint: Optional[str] = None  # of the map and parameters, see `resume_from`
+
+
+class BitSet:
+    """
+    Boolean grid (e.g. Q_F or Q_V) packed into one bit per state-action pair,
+    using an eighth of the memory of a boolean array. Entries are addressed
+    either by flat index or by grid coordinates.
+    """
+
+    def __init__(self, shape, packed=None):
+        self.shape = tuple(shape)
+        self.size = int(np.prod(self.shape))
+        if packed is None:
+            packed = np.zeros((self.size + 7) >> 3, dtype=np.uint8)
+        self.packed = packed
+
+    @classmethod
+    def from_array(cls, mask):
+        mask = np.asarray(mask, dtype=bool)
+        return cls(mask.shape, np.packbits(mask.ravel()))
+
+    def to_array(self):
+        return (
+            np.unpackbits(self.packed, count=self.size).astype(bool).reshape(self.shape)
+        )
+
+    def _flat_index(self, idx):
+        if isinstance(idx, tuple):
+            return int(np.ravel_multi_index(idx, self.shape))
+        return int(idx)
+
+    def get(self, *idx):
+        flat = self._flat_index(idx if len(idx) > 1 else idx[0])
+        # np.packbits stores the first entry in the most significant bit
+        return bool((self.packed[flat >> 3] >> (7 - (flat & 7))) & 1)
+
+    def set(self, *idx, value=True):
+        flat = self._flat_index(idx if len(idx) > 1 else idx[0])
+        bit = np.uint8(1 << (7 - (flat & 7)))
+        if value:
+            self.packed[flat >> 3] |= bit
+        else:
+            self.packed[flat >> 3] &= ~bit
+
+    def count(self):
+        return int(np.unpackbits(self.packed, count=self.size).sum())
+
+    def __invert__(self):
+        inverted = BitSet(self.shape, np.invert(self.packed))
+        # keep the padding bits of the last byte cleared
+        if self.size & 7:
+            inverted.packed[-1] &= np.uint8(0xFF << (8 - (self.size & 7)) & 0xFF)
+        return inverted
 
 
 def digitize_s(s, s_grid, shape=None, to_bin=True):
@@ -33,13 +93,15 @@ def digitize_s(s, s_grid, shape=None, to_bin=True):
     """
     # assert type(s_grid) is tuple or type(s_grid) is list
     s = np.atleast_1d(s)  # make this indexable even if scalar
-    s_idx = np.zeros((len(s_grid)), dtype=int)
-    if to_bin:
-        for dim_idx, grid in enumerate(s_grid):  # TODO: can zip this with s
-            s_idx[dim_idx] = np.digitize(s[dim_idx], grid)
-    else:
-        for dim_idx, grid in enumerate(s_grid):
-            s_idx[dim_idx] = np.argmin(np.abs(grid - s[dim_idx]))
+    # * one compiled call per dimension: packing the grids as for
+    # * digitize_s_batch costs more than it saves for a single state
+    s_idx = np.array(
+        [
+            _digitize_point(np.asarray(grid), float(s[dim_idx]), to_bin)
+            for dim_idx, grid in enumerate(s_grid)
+        ],
+        dtype=int,
+    )
 
     if shape is None:
         return s_idx
@@ -47,10 +109,115 @@ def digitize_s(s, s_grid, shape=None, to_bin=True):
         return np.ravel_multi_index(s_idx, shape)
 
 
+def digitize_s_batch(S, s_grid, shape=None, to_bin=True):
+    """
+    `digitize_s` for all rows of an (N, n_states) array of states at once.
+
+    output:
+    - either an (N, n_states) array of indices
+    - or N raveled indices
+    """
+    S = np.asarray(S, dtype=float).reshape(-1, len(s_grid))
+    s_idx = _digitize_rows(S, *_pack_grids(s_grid), to_bin)
+
+    if shape is None:
+        return s_idx
+    else:
+        return np.ravel_multi_index(tuple(s_idx.T), shape)
+
+
+def _pack_grids(s_grid):
+    """
+    the 1-D grids concatenated into one array, and the offsets of each grid in
+    it, for the compiled kernels
+    """
+    offsets = np.zeros(len(s_grid) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([np.size(grid) for grid in s_grid])
+    grid_flat = np.concatenate([np.ravel(grid) for grid in s_grid]).astype(float)
+    return grid_flat, offsets
+
+
+@njit(cache=True)
+def _digitize_rows(S, grid_flat, offsets, to_bin):
+    s_idx = np.zeros(S.shape, dtype=np.int64)
+    for dim_idx in range(offsets.size - 1):
+        grid = grid_flat[offsets[dim_idx] : offsets[dim_idx + 1]]
+        direction = _grid_direction(grid, to_bin)
+        for row in range(S.shape[0]):
+            s_idx[row, dim_idx] = _digitize_value(
+                grid, S[row, dim_idx], to_bin, direction
+            )
+    return s_idx
+
+
+@njit(cache=True)
+def _digitize_point(grid, value, to_bin):
+    return _digitize_value(grid, value, to_bin, _grid_direction(grid, to_bin))
+
+
+@njit(cache=True)
+def _grid_direction(grid, to_bin):
+    """
+    1 for a non-decreasing grid, -1 for a decreasing one, 0 otherwise
+    """
+    if _is_increasing(grid):
+        return 1
+    for idx in range(1, grid.size):
+        if grid[idx - 1] < grid[idx]:
+            if to_bin:  # as np.digitize
+                raise ValueError("bins must be monotonically increasing or decreasing")
+            return 0
+    return -1
+
+
+@njit(cache=True)
+def _digitize_value(grid, value, to_bin, direction):
+    if not to_bin:
+        return _nearest_index(grid, value, direction > 0)
+    if direction > 0:  # * as np.digitize
+        return np.searchsorted(grid, value, side="right")
+    # * decreasing, as np.digitize
+    return grid.size - np.searchsorted(grid[::-1], value, side="right")
+
+
+@njit(cache=True)
+def _is_increasing(grid):
+    for idx in range(1, grid.size):
+        if grid[idx - 1] > grid[idx]:
+            return False
+    return True
+
+
+@njit(cache=True)
+def _nearest_index(grid, value, increasing):
+    """
+    index of the closest grid point, the first one on ties, as
+    np.argmin(np.abs(grid - value))
+    """
+    if math.isnan(value):
+        return 0
+    if increasing:  # * only the two grid points around value can be closest
+        right = min(np.searchsorted(grid, value), grid.size - 1)
+        left = max(right - 1, 0)
+        if abs(grid[right] - value) < abs(grid[left] - value):
+            return right
+        return left
+    nearest = 0
+    for idx in range(1, grid.size):
+        if abs(grid[idx] - value) < abs(grid[nearest] - value):
+            nearest = idx
+    return nearest
+
+
 def project_Q2S(Q, grids, proj_opt=None):
     if proj_opt is None:
         proj_opt = np.any
     a_axes = tuple(range(Q.ndim - len(grids["actions"]), Q.ndim))
+    if proj_opt is np.mean and Q.dtype == bool:
+        # integer counting avoids casting all of Q to float64 first, and gives
+        # the same result
+        n_actions = int(np.prod([Q.shape[ax] for ax in a_axes]))
+        return Q.sum(axis=a_axes, dtype=np.int32) / n_actions
     return proj_opt(Q, a_axes)
 
 
@@ -60,34 +227,89 @@ def compute_QV(Q_map, grids, Q_V=None, Q_on_grid=None):
     pairs, compute the viable sets. The input Q_V is referred to as Q_N in the
     paper when passing it in, but since it is immediately copied to Q_V, we
     directly use this naming.
+    Q_V may also be passed as a `BitSet`, e.g. `~BitSet.from_array(Q_F)`.
     """
 
     # initialize estimate of Q_V
-    if Q_V is None:
-        Q_V = np.copy(Q_map)
-        Q_V = Q_V.astype(bool)
+    if isinstance(Q_V, BitSet):
+        Q_V = Q_V.to_array()
+    elif Q_V is None:
+        Q_V = Q_map.astype(bool)  # a new array, in one pass
+    s_shape, a_shape = _grid_shapes(grids)
+    n_actions = int(np.prod(a_shape))
+    Q_V_flat = Q_V.reshape(-1)
+    Q_V = Q_V_flat.reshape(Q_V.shape)
+    # * pairs only ever leave Q_V, so only the initially viable ones are
+    # * tracked, by flat index
+    viable_flat = np.flatnonzero(Q_V_flat)
     # if you have no info, treat everything as if in a bin
     if Q_on_grid is None:
-        Q_on_grid = np.zeros(Q_V.shape, dtype=bool)
-    # initialize empty of S_old
+        on_grid = np.zeros(viable_flat.size, dtype=bool)
+    else:
+        on_grid = np.asarray(Q_on_grid, dtype=bool).ravel()[viable_flat]
+
+    # * corners of the bin each pair lands in (or the grid point itself, if it
+    # * lands on the grid), as `is_outside` checks them
+    corners = _corner_table(
+        Q_map.ravel()[viable_flat],
+        s_shape,
+        on_grid,
+        on_grid_as_bin=False,
+    )
+    still_viable, S_V = _viable_fixed_point(
+        viable_flat, corners, n_actions, int(np.prod(s_shape))
+    )
+    Q_V_flat[viable_flat[~still_viable]] = False
+
+    return Q_V, S_V.reshape(s_shape)
+
+
+@njit(parallel=True, cache=True)
+def _viable_fixed_point(viable_flat, corners, n_actions, n_grid_points):
+    """
+    the iteration of `compute_QV` on the flat indices of the initially viable
+    pairs and their corner tables; returns which of them stay viable, and the
+    flat S_V
+    """
+    n_pairs = viable_flat.size
+    still_viable = np.ones(n_pairs, dtype=np.bool_)
+    removed = np.zeros(n_pairs, dtype=np.bool_)
+    # * the number of viable actions of each state; S_V only changes when one
+    # * of these drops to 0, so there is no need to compare S_V and S_old
+    n_viable = np.zeros(n_grid_points, dtype=np.int64)
+    for idx in range(n_pairs):
+        n_viable[viable_flat[idx] // n_actions] += 1
     # initialize estimate of S_V
-    S_V = project_Q2S(Q_V, grids)
-    S_old = np.zeros_like(S_V)
+    S_V = n_viable > 0
 
     # while S_V != S_old
-    while not np.array_equal(S_V, S_old):
-        # iterate over all s in S_V
-        for qdx, is_viable in np.ndenumerate(Q_V):
-            # iterate over all a
-            if is_viable:
-                # if s_k isOutside S_V:
-                if is_outside(Q_map[qdx], grids["states"], S_V, on_grid=Q_on_grid[qdx]):
-                    Q_V[qdx] = False
-                    # remove (s,a) from Q_V
-        S_old = S_V
-        S_V = project_Q2S(Q_V, grids)
-
-    return Q_V, S_V
+    changed = n_pairs > 0
+    while changed:
+        # iterate over all (s, a) still in Q_V; S_V is fixed within a sweep
+        for idx in prange(n_pairs):
+            removed[idx] = False
+            if not still_viable[idx]:
+                continue
+            # if s_k isOutside S_V: remove (s,a) from Q_V
+            inside = False
+            for col in range(corners.shape[1]):
+                corner = corners[idx, col]
+                if corner < 0:  # out of bounds
+                    continue
+                inside = S_V[corner]
+                if not inside:
+                    break
+            still_viable[idx] = inside
+            removed[idx] = not inside
+        changed = False
+        for idx in range(n_pairs):
+            if removed[idx]:
+                sdx = viable_flat[idx] // n_actions
+                n_viable[sdx] -= 1
+                if n_viable[sdx] == 0:
+                    S_V[sdx] = False
+                    changed = True
+    return still_viable, S_V
 
 
 def is_outside(s, s_grid, S_V, already_binned=True, on_grid=False):
@@ -95,30 +317,74 @@ def is_outside(s, s_grid, S_V, already_binned=True, on_grid=False):
     given a level set S, check if s lands in a bin inside of S or not
     """
 
+    s_grid_shape = tuple(map(np.size, s_grid))
     # only checking 1 state vector
     if not already_binned:
         bin_idx = digitize_s(s, s_grid)  # get unraveled indices
     else:
-        bin_idx = np.unravel_index(s, tuple(x + 1 for x in map(np.size, s_grid)))
+        bin_idx = np.unravel_index(s, tuple(x + 1 for x in s_grid_shape))
 
     if on_grid:  # s is already binned in the flat
-        s_grid_shape = list(map(np.size, s_grid))
         sdx = np.unravel_index(s, s_grid_shape)
         if S_V[sdx]:
             return False
         else:
             return True
 
-    edge_indices = get_grid_indices(bin_idx, s_grid)
+    return _is_outside_bin(
+        np.asarray(bin_idx, dtype=np.int64),
+        np.array(s_grid_shape, dtype=np.int64),
+        np.ravel(S_V),
+    )
 
-    if len(edge_indices) > 0:
-        for idx in edge_indices:
-            if not S_V[idx]:
-                return True
-    else:
-        return True
 
-    return False
+@njit(cache=True)
+def _is_outside_bin(bin_idx, grid_sizes, S_V_flat):
+    """
+    whether any in-bounds grid point around a bin is not in the (flat) S_V,
+    or there is none
+    """
+    n_dims = bin_idx.size
+    any_inside = False
+    for corner in range(2**n_dims):
+        flat_idx = 0
+        for dim_idx in range(n_dims):
+            # * bit dim_idx of the corner picks x - 1 or x, as `_grid_neighbors`
+            x = bin_idx[dim_idx] - 1 + ((corner >> (n_dims - 1 - dim_idx)) & 1)
+            if x < 0 or x >= grid_sizes[dim_idx]:
+                flat_idx = -1
+                break
+            flat_idx = flat_idx * grid_sizes[dim_idx] + x
+        if flat_idx < 0:
+            continue
+        if not S_V_flat[flat_idx]:
+            return True
+        any_inside = True
+    return not any_inside
+
+
+@njit(cache=True)
+def _match_grid_rows(S, grid_flat, offsets):
+    """
+    the index of each value of S in its 1-D grid, the first one if repeated,
+    or -1 if it is not exactly a grid point
+    """
+    grid_idx = np.full(S.shape, -1, dtype=np.int64)
+    for dim_idx in range(offsets.size - 1):
+        grid = grid_flat[offsets[dim_idx] : offsets[dim_idx + 1]]
+        increasing = _is_increasing(grid)
+        for row in range(S.shape[0]):
+            value = S[row, dim_idx]
+            if increasing:  # * O(log g), otherwise scan the grid
+                idx = np.searchsorted(grid, value)
+                if idx < grid.size and grid[idx] == value:
+                    grid_idx[row, dim_idx] = idx
+                continue
+            for idx in range(grid.size):
+                if grid[idx] == value:
+                    grid_idx[row, dim_idx] = idx
+                    break
+    return grid_idx
 
 
 def get_grid_indices(bin_idx, s_grid):
@@ -127,16 +393,32 @@ def get_grid_indices(bin_idx, s_grid):
     of tuples.
     """
 
-    grid_coords = list()
-    for neighbor in it.product(*[(x - 1, x) for x in bin_idx]):
-        # check if neighbor is out of bounds
-        for idx, x in enumerate(neighbor):
-            if x < 0 or x >= s_grid[idx].size:
-                break
-        else:  # if for loop completes (not out of bounds)
-            grid_coords.append(neighbor)
+    grid_sizes = np.array([np.size(grid) for grid in s_grid], dtype=np.int64)
+    neighbors = _grid_neighbors(np.asarray(bin_idx, dtype=np.int64), grid_sizes)
+    return [tuple(neighbor) for neighbor in neighbors.tolist()]
+
 
-    return grid_coords
+@njit(cache=True)
+def _grid_neighbors(bin_idx, grid_sizes):
+    """
+    the in-bounds grid points around a bin, in the order of
+    `it.product(*[(x - 1, x) for x in bin_idx])`, as rows of an array
+    """
+    n_dims = bin_idx.size
+    neighbors = np.empty((2**n_dims, n_dims), dtype=np.int64)
+    count = 0
+    for corner in range(2**n_dims):
+        in_bounds = True
+        for dim_idx in range(n_dims):
+            # * the last dimension varies fastest, from x - 1 to x
+            x = bin_idx[dim_idx] - 1 + ((corner >> (n_dims - 1 - dim_idx)) & 1)
+            if x < 0 or x >= grid_sizes[dim_idx]:
+                in_bounds = False
+                break
+            neighbors[count, dim_idx] = x
+        if in_bounds:
+            count += 1
+    return neighbors[:count]
 
 
 def map_S2Q(Q_map, S_M, s_grid, Q_V=None, Q_on_grid=None):
@@ -145,37 +427,131 @@ def map_S2Q(Q_map, S_M, s_grid, Q_V=None, Q_on_grid=None):
     inverse dynamics (using the lookup table).
     """
 
-    # TODO s_grid isn't strictly needed, can be done without it
+    # * s_grid isn't strictly needed: the shape of S_M gives the grid's shape
+
+    if isinstance(Q_V, BitSet):
+        Q_V = Q_V.to_array()
+    elif Q_V is None:
+        Q_V = Q_map.astype(bool)
 
+    # * only viable state-action pairs are mapped, all others are 0
+    viable = np.asarray(Q_V, dtype=bool).ravel()
     if Q_on_grid is None:
-        Q_on_grid = np.zeros_like(Q_map, dtype=bool)
+        on_grid = np.zeros(np.count_nonzero(viable), dtype=bool)
+    else:
+        on_grid = np.asarray(Q_on_grid, dtype=bool).ravel()[viable]
+    Q_M = np.zeros(Q_map.size)
+    # * average the measure of all grid-points enclosing the bin each pair
+    # * lands in; on-grid pairs treat their grid index as a bin index
+    corners = _corner_table(
+        Q_map.ravel()[viable], S_M.shape, on_grid, on_grid_as_bin=True
+    )
+    Q_M[viable] = _average_over_corners(S_M.ravel(), corners)
 
-    if Q_V is None:
-        Q_V = Q_map.astype(bool)
+    return Q_M.reshape(Q_map.shape)
 
-    Q_M = np.zeros(Q_map.shape)
-    # iterate over viable state-action pairs in Q_V
-    for qdx, is_viable in np.ndenumerate(Q_V):
-        if is_viable:  # only check states-action pairs that are viable
-            if Q_on_grid[qdx]:
-                sdx = np.unravel_index(Q_map[qdx], S_M.shape)
-            else:
-                sdx = np.unravel_index(Q_map[qdx], list(x + 1 for x in S_M.shape))
-            edge_indices = get_grid_indices(sdx, s_grid)
 
-            # TODO check that it actually has the right size
-            measure = 0
-            # taking the average measure of all enclosing grid-points
-            if len(edge_indices) > 0:
-                for idx in edge_indices:
-                    measure += S_M[(idx)]
-                measure /= len(edge_indices)
+def compute_viability_measures(Q_map, Q_F, grids, Q_on_grid=None):
+    """
+    Fused version of `compute_QV`, `project_Q2S(..., proj_opt=np.mean)` and
+    `map_S2Q`, computed on whole arrays instead of looping over each
+    state-action pair. Gives the same results as the three separate calls.
+    If Q_F is None, all pairs with a nonzero Q_map are treated as
+    non-failing, as in `compute_QV`.
+    outputs: Q_V, S_V, S_M, Q_M
+    """
+    s_shape, _ = _grid_shapes(grids)
+    q_shape = Q_map.shape
+    q_map_flat = Q_map.ravel()
+
+    if isinstance(Q_F, BitSet):
+        Q_F = Q_F.to_array()
+    if Q_F is None:
+        Q_V = Q_map.astype(bool).ravel()
+    else:
+        Q_V = ~np.asarray(Q_F, dtype=bool).ravel()
+    if Q_on_grid is None:
+        on_grid = np.zeros(q_map_flat.shape, dtype=bool)
+    else:
+        on_grid = np.asarray(Q_on_grid, dtype=bool).ravel()
 
-            # If sdx is on the outer edge, don't map it
+    # * corners of the bin each pair lands in (or the grid point itself, if it
+    # * lands on the grid), which all need to be viable
+    corners = _corner_table(q_map_flat, s_shape, on_grid, on_grid_as_bin=False)
+    has_corners = np.any(corners >= 0, axis=1)
+    n_actions = q_map_flat.size // int(np.prod(s_shape))
 
-            Q_M[qdx] = measure
+    def project(Q_V):
+        return np.any(Q_V.reshape(-1, n_actions), axis=1)
+
+    S_V = project(Q_V)
+    S_old = np.zeros_like(S_V)
+    while not np.array_equal(S_V, S_old):
+        corner_viable = np.where(corners >= 0, S_V[corners], True)
+        Q_V &= has_corners & np.all(corner_viable, axis=1)
+        S_old = S_V
+        S_V = project(Q_V)
 
-    return Q_M
+    Q_V = Q_V.reshape(q_shape)
+    S_V = S_V.reshape(s_shape)
+    S_M = project_Q2S(Q_V, grids, proj_opt=np.mean)
+
+    # * map_S2Q averages the measure of all enclosing grid-points; on-grid pairs
+    # * are treated as if their grid index were a bin index
+    corners = _corner_table(q_map_flat, s_shape, on_grid, on_grid_as_bin=True)
+    Q_M = _average_over_corners(S_M.ravel(), corners)
+    Q_M[~Q_V.ravel()] = 0
+    return Q_V, S_V, S_M, Q_M.reshape(q_shape)
+
+
+def _corner_table(q_map_flat, s_shape, on_grid, on_grid_as_bin):
+    """
+    For each (flat) entry of Q_map, the flat indices into S of all grid points
+    enclosing its bin, in the order of `get_grid_indices`, padded with -1 for
+    out-of-bounds neighbors. The result has shape (Q_map.size, 2**n_states).
+    Entries on the grid either use the grid point itself
+    (`on_grid_as_bin=False`, as `is_outside`), or treat the grid index as a bin
+    index (`on_grid_as_bin=True`, as `map_S2Q`).
+    """
+    s_shape = tuple(s_shape)
+    bin_shape = tuple(dim + 1 for dim in s_shape)
+    bin_idx = np.array(np.unravel_index(q_map_flat, bin_shape))
+    if np.any(on_grid):
+        grid_idx = np.array(np.unravel_index(q_map_flat[on_grid], s_shape))
+        bin_idx[:, on_grid] = grid_idx
+
+    # * as narrow as the grid allows: compute_QV scans this table every sweep
+    index_dtype = np.int32
+    if np.prod(s_shape, dtype=np.int64) > np.iinfo(np.int32).max:
+        index_dtype = np.int64
+    columns = []
+    for offsets in it.product(*[(-1, 0)] * len(s_shape)):
+        neighbor = bin_idx + np.array(offsets)[:, None]
+        in_bounds = np.all(
+            (neighbor >= 0) & (neighbor < np.array(s_shape)[:, None]), axis=0
+        )
+        flat = np.full(q_map_flat.size, -1, dtype=index_dtype)
+        flat[in_bounds] = np.ravel_multi_index(neighbor[:, in_bounds], s_shape)
+        columns.append(flat)
+    corners = np.stack(columns, axis=1)
+
+    if not on_grid_as_bin and np.any(on_grid):
+        corners[on_grid] = -1
+        corners[on_grid, 0] = q_map_flat[on_grid]
+    return corners
+
+
+def _average_over_corners(values, corners):
+    """
+    Average `values` over the valid (non-negative) corners of each row,
+    accumulating in the same order as `map_S2Q`. Rows without corners are 0.
+    """
+    valid = corners >= 0
+    total = np.zeros(corners.shape[0])
+    for col in range(corners.shape[1]):
+        total += np.where(valid[:, col], values[corners[:, col]], 0.0)
+    count = valid.sum(axis=1)
+    return np.divide(total, count, out=np.zeros_like(total), where=count > 0)
 
 
 def get_feasibility_mask(feasible, sa2xp, grids, x0, p0):
@@ -183,7 +559,11 @@ def get_feasibility_mask(feasible, sa2xp, grids, x0, p0):
     cycle through the state and action grids, and check if that state-action
     pair is feasible or nay. Returns an ND array of booleans.
 
-    feasible: function to check if a state and parameter are feasible
+    feasible: function to check if a state and parameter are feasible. If it
+    has a vectorized `feasible.batch(state_actions, p)`, as `p_map.batch` for
+    `compute_Q_map`, that is called once instead on the
+    (N, n_states + n_actions) array of all state-action pairs, returning the
+    (N,) feasibility of each (and doing the work of `sa2xp` itself).
     sa2xp: mapping to go from state-action to x and p
     grids: grids of states and actions
 
@@ -191,13 +571,16 @@ def get_feasibility_mask(feasible, sa2xp, grids, x0, p0):
 
     p: a default parameter dict, used to fill out p
     """
+    s_shape, a_shape = _grid_shapes(grids)
+    if hasattr(feasible, "batch"):
+        Q_feasible = feasible.batch(get_state_actions(grids), p0)
+        return np.asarray(Q_feasible, dtype=bool).reshape(s_shape + a_shape)
+
     # initialize 1D, reshape later
-    s_shape = list(map(np.size, grids["states"]))  # shape of state-space grid
-    a_shape = list(map(np.size, grids["actions"]))
-    Q_feasible = np.zeros(np.prod(s_shape) * np.prod(a_shape), dtype=bool)
+    Q_feasible = np.zeros(_total_gridpoints(grids), dtype=bool)
 
     # state_action_iter = it.product(*grids["states"], *grids["actions"])
-    for idx, state_action in enumerate(it.product(*grids["states"], *grids["actions"])):
+    for idx, state_action in enumerate(_state_action_iter(grids)):
         x, p = sa2xp(state_action, p0)
         Q_feasible[idx] = feasible(x, p)
 
@@ -215,59 +598,155 @@ def _total_gridpoints(grids):
     return int(np.prod(s_shape) * np.prod(a_shape))
 
 
+def get_state_actions(grids):
+    """
+    Cartesian product of all state and action grids, as a C-contiguous
+    (N, n_states + n_actions) array in the same order as
+    `it.product(*grids["states"], *grids["actions"])`.
+    If precomputed, `grids["sa_flat"]` is returned instead.
+    """
+    if "sa_flat" in grids:
+        return grids["sa_flat"]
+    axes = [np.ravel(axis) for axis in (*grids["states"], *grids["actions"])]
+    total = int(np.prod([axis.size for axis in axes]))
+    state_actions = np.empty((total, len(axes)), dtype=np.result_type(*axes))
+    # * fill each column in place, repeating each value `inner` times and the
+    # * whole axis as often as needed: the last axis varies fastest
+    inner = total
+    for col, axis in enumerate(axes):
+        if total == 0:
+            break
+        inner //= axis.size
+        blocks = state_actions.reshape(-1, axis.size, inner, len(axes))
+        blocks[..., col] = axis[:, None]
+    return state_actions
+
+
+def _check_state_actions(grids, total_gridpoints):
+    """
+    Check a precomputed `grids["sa_flat"]` against the state and action grids:
+    its shape, and the rows of the first and last grid point, and of the
+    second point along each axis (which catch stale or reordered grids).
+    """
+    sa_flat = grids["sa_flat"]
+    axes = [np.ravel(axis) for axis in (*grids["states"], *grids["actions"])]
+    if np.shape(sa_flat) != (total_gridpoints, len(axes)):
+        raise ValueError("grids['sa_flat'] does not match the state/action grids")
+    if total_gridpoints == 0:
+        return
+    shape = tuple(axis.size for axis in axes)
+    rows = {0, total_gridpoints - 1}
+    for dim, size in enumerate(shape):
+        if size > 1:
+            rows.add(int(np.prod(shape[dim + 1 :])))
+    for row in sorted(rows):
+        coords = np.unravel_index(row, shape)
+        expected = [axis[idx] for axis, idx in zip(axes, coords)]
+        if not np.array_equal(sa_flat[row], expected):
+            raise ValueError(
+                f"grids['sa_flat'] row {row} does not match the state/action grids"
+            )
+
+
+def _state_action_iter(grids):
+    # rows of the precomputed grid, or lazily generated tuples
+    if "sa_flat" in grids:
+        return iter(grids["sa_flat"])
+    return it.product(*grids["states"], *grids["actions"])
+
+
+def _flat_output(out, shape, dtype):
+    """
+    zeroed flat view of a preallocated output array, or a new one if None
+    """
+    if out is None:
+        return np.zeros(int(np.prod(shape)), dtype=dtype)
+    if out.shape != shape or out.dtype != dtype or not out.flags.c_contiguous:
+        raise ValueError(
+            f"output array must be C-contiguous, of shape {shape} and dtype "
+            f"{np.dtype(dtype)}"
+        )
+    flat = out.reshape(-1)
+    flat[:] = 0
+    return flat
+
+
+def _stack_records(records, count, n_states):
+    """
+    the next states (count, n_states) and failures (count,) of an iterable
+    of (s_next, failed) records
+    """
+    s_next = np.zeros((count, n_states))
+    failed = np.zeros(count, dtype=bool)
+    for idx, (s_vec, failed_pair) in enumerate(records):
+        s_next[idx] = s_vec
+        failed[idx] = failed_pair
+    return s_next, failed
+
+
 def _assemble_transition(
     grids,
-    records: Iterable[Tuple[np.ndarray, bool]],
-    total_count: int,
+    s_next: np.ndarray,
+    failed: np.ndarray,
     *,
     check_grid: bool,
     keep_coords: bool,
     bin_mode: str,
+    index_dtype=None,
+    out=None,
+    out_F=None,
+    out_on_grid=None,
 ) -> TransitionResult:
+    """
+    Bin the next states (N, n_states) of all state-action pairs that do not
+    fail, on whole arrays.
+    """
     s_grid_shape, a_grid_shape = _grid_shapes(grids)
     s_bin_shape = tuple(dim + 1 for dim in s_grid_shape)
 
-    q_map_flat = np.zeros(total_count, dtype=int)
-    q_fail_flat = np.zeros(total_count, dtype=bool)
-    q_on_grid_flat = np.zeros(total_count, dtype=bool) if check_grid else None
-    q_reached = np.zeros((len(grids["states"]), total_count)) if keep_coords else None
+    if index_dtype is None:
+        # bin indices fit in 32 bits for any practical grid, halving the memory
+        index_dtype = np.int32
+        if np.prod(s_bin_shape, dtype=np.int64) > np.iinfo(np.int32).max:
+            index_dtype = np.int64
+    shape = s_grid_shape + a_grid_shape
+    q_map_flat = _flat_output(out, shape, index_dtype)
+    q_fail_flat = _flat_output(out_F, shape, bool)
+    q_on_grid_flat = _flat_output(out_on_grid, shape, bool) if check_grid else None
+    q_reached = np.array(s_next.T, dtype=float) if keep_coords else None
 
     if bin_mode == "nearest":
 
-        def encode(point):
-            return digitize_s(point, grids["states"], shape=s_grid_shape, to_bin=False)
+        def encode(points):
+            return digitize_s_batch(
+                points, grids["states"], shape=s_grid_shape, to_bin=False
+            )
 
-        encode_on_grid = encode
     else:
 
-        def encode(point):
-            return digitize_s(point, grids["states"], s_bin_shape)
-
-        def encode_on_grid(point):
-            return digitize_s(point, grids["states"], s_grid_shape, to_bin=False)
-
-    for idx, (s_next, failed) in enumerate(records):
-        s_vec = np.atleast_1d(s_next)
-        if keep_coords and q_reached is not None:
-            q_reached[:, idx] = s_vec
-        if failed:
-            q_fail_flat[idx] = True
-            continue
-        if check_grid and q_on_grid_flat is not None:
-            for dim_idx, sval in enumerate(s_vec):
-                if not np.isin(sval, grids["states"][dim_idx]):
-                    q_map_flat[idx] = encode(s_vec)
-                    break
-            else:
-                q_on_grid_flat[idx] = True
-                q_map_flat[idx] = encode_on_grid(s_vec)
-        else:
-            q_map_flat[idx] = encode(s_vec)
-
-    q_map = q_map_flat.reshape(s_grid_shape + a_grid_shape)
-    q_fail = q_fail_flat.reshape(s_grid_shape + a_grid_shape)
+        def encode(points):
+            return digitize_s_batch(points, grids["states"], s_bin_shape)
+
+    q_fail_flat[:] = failed
+    binned = ~failed
+    if check_grid and q_on_grid_flat is not None:
+        grid_idx = _match_grid_rows(
+            np.asarray(s_next, dtype=float).reshape(-1, len(s_grid_shape)),
+            *_pack_grids(grids["states"]),
+        )
+        on_grid = binned & np.all(grid_idx >= 0, axis=1)
+        binned &= ~on_grid
+        q_on_grid_flat[:] = on_grid
+        q_map_flat[on_grid] = np.ravel_multi_index(
+            tuple(grid_idx[on_grid].T), s_grid_shape
+        )
+    q_map_flat[binned] = encode(s_next[binned])
+
+    # * reshaping the flat (views of the) outputs does not copy
+    q_map = q_map_flat.reshape(shape)
+    q_fail = q_fail_flat.reshape(shape)
     q_on_grid = (
-        q_on_grid_flat.reshape(s_grid_shape + a_grid_shape)
+        q_on_grid_flat.reshape(shape)
         if check_grid and q_on_grid_flat is not None
         else None
     )
@@ -288,35 +767,104 @@ def compute_Q_map(
     keep_coords=False,
     parallel=True,
     bin_mode="bin",
+    batched=False,
+    index_dtype=None,
+    resume_from=None,
+    out=None,
+    out_F=None,
+    out_on_grid=None,
 ):
-    """Compute the transition map of a system."""
+    """
+    Compute the transition map of a system.
+
+    batched: evaluate all state-action pairs with a single call to
+    `p_map.batch(state_actions, p)`, which takes an (N, n_states + n_actions)
+    array and returns the next states (N, n_states) and failures (N,). Only
+    available for models which implement a vectorized transition map.
+    index_dtype: integer dtype of Q_map, e.g. np.int16 for grids with fewer
+    than 2**15 state bins. Defaults to int32 (int64 for huge grids).
+    resume_from: a previous result, to only evaluate state-action pairs which
+    are not on its grids. Either a dict (or path to a pickled dict) with the
+    previous "grids", "Q_F" and "Q_reached" (`q_reached`, computed with
+    keep_coords=True), such as saved by the demos. If it also holds the
+    "fingerprint" of the previous result, it must have been computed with
+    the same map, parameters `p_map.p`, `sa2xp` and `xp2s`, or a ValueError
+    is raised. Without it, this cannot be checked, and the previous next
+    states are reused as they are.
+    out, out_F, out_on_grid: optional preallocated (C-contiguous) arrays of
+    the grid's state-action shape, to hold Q_map, Q_F and Q_on_grid. Their
+    contents are overwritten, so repeated runs reuse the same memory. The
+    dtype of `out` sets the index dtype of Q_map.
+    """
 
     if bin_mode not in {"bin", "nearest"}:
         raise ValueError(f"Unsupported bin_mode '{bin_mode}'")
+    if out is not None:
+        if not np.issubdtype(out.dtype, np.integer):
+            raise ValueError("out must have an integer dtype")
+        if index_dtype is not None and np.dtype(index_dtype) != out.dtype:
+            raise ValueError("index_dtype does not match the dtype of out")
+        index_dtype = out.dtype
+    if index_dtype is not None:
+        n_bins = np.prod([dim + 1 for dim in _grid_shapes(grids)[0]])
+        if n_bins > np.iinfo(index_dtype).max:
+            raise ValueError(
+                f"{n_bins} state bins do not fit in index_dtype {np.dtype(index_dtype)}"
+            )
+    if batched and not hasattr(p_map, "batch"):
+        raise ValueError("batched=True requires a vectorized `p_map.batch`")
 
     total_gridpoints = _total_gridpoints(grids)
+    if "sa_flat" in grids:
+        _check_state_actions(grids, total_gridpoints)
+
+    pending_count = total_gridpoints
+    fingerprint = _map_fingerprint(p_map)
+    if resume_from is not None:
+        todo, s_previous, failed_previous = _resume_records(
+            grids, resume_from, fingerprint
+        )
+        pending = get_state_actions(grids)[todo]
+        pending_count = len(pending)
+        if verbose > 0:
+            print("reusing " + str(total_gridpoints - pending_count) + " points.")
+
     if verbose > 0:
-        print("computing a total of " + str(total_gridpoints) + " points.")
+        print("computing a total of " + str(pending_count) + " points.")
 
     progress_mod = None
-    if verbose > 1 and total_gridpoints >= 10:
-        progress_mod = max(total_gridpoints // 10, 1)
-
-    if parallel:
-        state_actions = list(it.product(*grids["states"], *grids["actions"]))
-        base_params = p_map.p.copy()
-        args = [p_map.sa2xp(sa, base_params) for sa in state_actions]
-        with mp.Pool() as pool:
-            results = pool.starmap(p_map, args)
-
-        records = []
-        for idx, ((x_next, failed), (_, params)) in enumerate(zip(results, args)):
-            if progress_mod and idx % progress_mod == 0:
+    if verbose > 1 and pending_count >= 10:
+        progress_mod = max(pending_count // 10, 1)
+
+    n_states = len(grids["states"])
+    if pending_count == 0:  # everything was reused
+        s_next, failed = _stack_records([], 0, n_states)
+    elif batched:
+        if resume_from is not None:
+            state_actions = pending
+        else:
+            state_actions = get_state_actions(grids)
+        s_next, failed = p_map.batch(state_actions, p_map.p)
+        s_next = np.asarray(s_next).reshape(pending_count, -1)
+        failed = np.asarray(failed, dtype=bool)
+    elif parallel:
+        if resume_from is not None:
+            state_actions = pending
+        else:
+            state_actions = get_state_actions(grids)
+
+        def progress(start, stop):
+            if progress_mod and start // progress_mod != stop // progress_mod:
                 print(".", end=" ")
-            s_next = p_map.xp2s(x_next, params)
-            records.append((np.atleast_1d(s_next), bool(failed)))
+
+        # * the workers of the shared pool persist across calls, and write the
+        # * next states and failures to shared memory
+        s_next, failed = parallel_map.evaluate(p_map, state_actions, n_states, progress)
     else:
-        state_actions = it.product(*grids["states"], *grids["actions"])
+        if resume_from is not None:
+            state_actions = iter(pending)
+        else:
+            state_actions = _state_action_iter(grids)
 
         def record_iter():
             for idx, state_action in enumerate(state_actions):
@@ -327,14 +875,103 @@ def compute_Q_map(
                 s_next = p_map.xp2s(x_next, params)
                 yield np.atleast_1d(s_next), bool(failed)
 
-        records = record_iter()
+        s_next, failed = _stack_records(record_iter(), pending_count, n_states)
+
+    if resume_from is not None:
+        # * fill in the newly computed pairs among those of the previous result
+        s_previous = np.array(s_previous, dtype=np.result_type(s_previous, s_next))
+        s_previous[todo] = s_next
+        failed_previous = np.array(failed_previous, dtype=bool)
+        failed_previous[todo] = failed
+        s_next, failed = s_previous, failed_previous
 
     result = _assemble_transition(
         grids,
-        records,
-        total_gridpoints,
+        s_next,
+        failed,
         check_grid=check_grid,
         keep_coords=keep_coords,
         bin_mode=bin_mode,
+        index_dtype=index_dtype,
+        out=out,
+        out_F=out_F,
+        out_on_grid=out_on_grid,
     )
+    result.fingerprint = fingerprint
     return result
+
+
+def _map_fingerprint(p_map):
+    """
+    hash of the transition map, its parameters and conversions, to recognize
+    a previous result computed with the same ones
+    """
+    names = []
+    for func in (p_map, getattr(p_map, "sa2xp", None), getattr(p_map, "xp2s", None)):
+        name = getattr(func, "__qualname__", type(func).__qualname__)
+        names.append(f"{getattr(func, '__module__', '')}.{name}")
+    try:
+        params = pickle.dumps(getattr(p_map, "p", None), protocol=4)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        params = repr(p_map.p).encode()
+    return hashlib.sha256(";".join(names).encode() + params).hexdigest()
+
+
+def _match_grid(grid, previous_grid):
+    """
+    index of each value of `grid` in `previous_grid`, or -1 if not present
+    (up to floating point round-off)
+    """
+    grid = np.atleast_1d(np.asarray(grid, dtype=float))
+    previous_grid = np.atleast_1d(np.asarray(previous_grid, dtype=float))
+    order = np.argsort(previous_grid)
+    sorted_grid = previous_grid[order]
+    right = np.clip(np.searchsorted(sorted_grid, grid), 0, sorted_grid.size - 1)
+    left = np.clip(right - 1, 0, sorted_grid.size - 1)
+    nearest = np.where(
+        np.abs(sorted_grid[left] - grid) < np.abs(sorted_grid[right] - grid),
+        left,
+        right,
+    )
+    found = np.isclose(sorted_grid[nearest], grid, rtol=1e-12, atol=1e-12)
+    return np.where(found, order[nearest], -1)
+
+
+def _resume_records(grids, resume_from, fingerprint=None):
+    """
+    Look up the state-action pairs of `grids` in a previous result, computed
+    with the map of the given fingerprint.
+    Returns a mask of the pairs still to compute, and the previous next states
+    and failures of all pairs (only meaningful where the mask is False).
+    """
+    if isinstance(resume_from, (str, os.PathLike)):
+        with open(resume_from, "rb") as infile:
+            resume_from = pickle.load(infile)
+    if resume_from.get("Q_reached") is None:
+        raise ValueError(
+            "resume_from requires the previously reached states 'Q_reached', "
+            "computed with keep_coords=True"
+        )
+    previous_fingerprint = resume_from.get("fingerprint")
+    if previous_fingerprint is not None and previous_fingerprint != fingerprint:
+        raise ValueError(
+            "resume_from was computed with another map, parameters or conversions"
+        )
+    previous_grids = resume_from["grids"]
+    axes = (*grids["states"], *grids["actions"])
+    previous_axes = (*previous_grids["states"], *previous_grids["actions"])
+    if len(axes) != len(previous_axes):
+        raise ValueError("resume_from was computed on grids of other dimensions")
+
+    matches = [_match_grid(grid, prev) for grid, prev in zip(axes, previous_axes)]
+    mesh = [idx.ravel() for idx in np.meshgrid(*matches, indexing="ij")]
+    found = np.all([idx >= 0 for idx in mesh], axis=0)
+    previous_shape = tuple(np.size(grid) for grid in previous_axes)
+    previous_idx = np.zeros(found.size, dtype=np.int64)
+    previous_idx[found] = np.ravel_multi_index(
+        tuple(idx[found] for idx in mesh), previous_shape
+    )
+
+    s_previous = np.asarray(resume_from["Q_reached"])[:, previous_idx].T
+    failed_previous = np.asarray(resume_from["Q_F"]).ravel()[previous_idx]
+    return ~found, s_previous, failed_previous
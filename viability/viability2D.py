@@ -11,8 +11,9 @@ import numpy as np
 def compute_Q_2D(s_grid, a_grid, p_map):
     """Compute the transition map of a system with 1D state and 1D action."""
 
-    Q_map = np.zeros((s_grid.size * a_grid.size, 1))
-    Q_F = np.zeros((s_grid.size * a_grid.size, 1))
+    # flat, reshaped (without copying) at the end
+    Q_map = np.zeros(s_grid.size * a_grid.size)
+    Q_F = np.zeros(s_grid.size * a_grid.size, dtype=bool)
 
     n = len(s_grid) * len(a_grid)
     for idx, state_action in enumerate(it.product(s_grid, a_grid)):
@@ -25,9 +26,9 @@ def compute_Q_2D(s_grid, a_grid, p_map):
             # note: Q_map is implicitly already excluding transitions that
             # move straight to a failure. While this is not equivalent to the
             # algorithm in the paper, for our systems it is a bit faster
-            Q_map[idx] = s_next
+            Q_map[idx] = np.squeeze(s_next)
         else:
-            Q_F[idx] = 1
+            Q_F[idx] = True
 
     return (
         Q_map.reshape((s_grid.size, a_grid.size)),  # only 2D
@@ -45,10 +46,11 @@ def project_Q2S_2D(Q):
 
 def is_outside_2D(s, S_V, s_grid):
     """Given a level set S, check if s is inside S or not."""
-    if sum(S_V) <= 1:
+    viable_idx = np.flatnonzero(S_V)
+    if viable_idx.size <= 1:
         return True
 
-    s_min, s_max = s_grid[S_V > 0][[0, -1]]
+    s_min, s_max = s_grid[viable_idx[0]], s_grid[viable_idx[-1]]
     if s > s_max or s < s_min:
         return True
     return False